@@ -1,5 +1,4 @@
 from django.core.exceptions import PermissionDenied
-from django.core.mail import send_mail
 from django.template.response import TemplateResponse
 from django import forms
 from django.conf import settings
@@ -11,6 +10,7 @@ from django.contrib.admin import helpers
 
 from froide.foirequest.models import FoiRequest
 from froide.helper.csv_utils import export_csv_response
+from froide.helper.email_sending import send_mail, mail_queue
 
 from .models import User, AccountManager
 
@@ -97,21 +97,22 @@ class UserAdmin(DjangoUserAdmin):
             mails_sent = 0
             subject = request.POST.get('subject', '')
             body = request.POST.get('body', '')
-            for user in queryset:
-                if not user.is_active and not user.email:
-                    continue
-                mail_context = {
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                    'name': user.get_full_name(),
-                }
-                user_subject = subject.format(**mail_context)
-                user_body = body.format(**mail_context)
-                send_mail(
-                    user_subject,
-                    user_body, settings.DEFAULT_FROM_EMAIL, [user.email]
-                )
-                mails_sent += 1
+            with mail_queue():
+                for user in queryset:
+                    if not user.is_active and not user.email:
+                        continue
+                    mail_context = {
+                        'first_name': user.first_name,
+                        'last_name': user.last_name,
+                        'name': user.get_full_name(),
+                    }
+                    user_subject = subject.format(**mail_context)
+                    user_body = body.format(**mail_context)
+                    send_mail(
+                        user_subject,
+                        user_body, settings.DEFAULT_FROM_EMAIL, [user.email]
+                    )
+                    mails_sent += 1
             self.message_user(request, _("%d mails sent." % mails_sent))
             # Return None to display the change list page again.
             return None
@@ -1,9 +1,13 @@
+import threading
+
 from django.core.management.base import BaseCommand
-from django.core.mail import send_mail
 from django.utils import translation
 from django.conf import settings
 
 from froide.account.models import User
+from froide.helper.email_sending import send_mail, mail_queue
+
+MASS_MAIL_CHUNK_SIZE = 500
 
 
 class Command(BaseCommand):
@@ -17,17 +21,38 @@ class Command(BaseCommand):
             content = fd.read()
 
         subject, content = self.get_content(content)
-        for user_pk in self.send_mail(subject, content):
-            self.stdout.write('%s' % user_pk)
-
-    def send_mail(self, subject, content):
+        lock = threading.Lock()
+
+        def write_sent(user_pk):
+            # Printed as soon as the mail is out, so an interrupted run
+            # shows who already got it
+            with lock:
+                self.stdout.write('%s' % user_pk)
+                self.stdout.flush()
+
+        self.send_mail(subject, content, write_sent)
+
+    def send_mail(self, subject, content, on_sent,
+                  chunk_size=MASS_MAIL_CHUNK_SIZE):
+        """
+        Sends the mail in chunks of users and calls on_sent with the pk
+        of every user right after their mail was sent, possibly from
+        another thread
+        """
         users = User.objects.filter(is_active=True)
-        users = users.exclude(email='')
-
-        for user in users.iterator():
-            send_mail(subject, content, settings.DEFAULT_FROM_EMAIL,
-                [user.email], fail_silently=False)
-            yield user.pk
+        users = users.exclude(email='').order_by('pk')
+
+        last_pk = 0
+        while True:
+            chunk = list(users.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            with mail_queue():
+                for user in chunk:
+                    send_mail(subject, content, settings.DEFAULT_FROM_EMAIL,
+                        [user.email], fail_silently=False,
+                        on_sent=lambda message, pk=user.pk: on_sent(pk))
+            last_pk = chunk[-1].pk
 
     def get_content(self, content):
         content = content.splitlines()
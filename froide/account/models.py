@@ -9,7 +9,7 @@ from django.utils.six import text_type as str
 from django.db import models, transaction, IntegrityError
 from django.conf import settings
 from django import dispatch
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import ugettext_lazy as _, get_language
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import slugify
 from django.template.loader import render_to_string
@@ -18,7 +18,8 @@ from django.utils.crypto import constant_time_compare
 from django.contrib.auth.forms import SetPasswordForm
 from django.contrib.auth.models import AbstractUser, UserManager
 
-from froide.helper.text_utils import replace_greetings, replace_word
+from froide.helper.text_utils import (replace_greetings, Redactor,
+        get_redactor)
 from froide.helper.csv_utils import export_csv, get_dict
 
 user_activated_signal = dispatch.Signal(providing_args=[])
@@ -45,7 +46,10 @@ class User(AbstractUser):
 
     def get_dict(self, fields):
         d = get_dict(self, fields)
-        d['request_count'] = self.foirequest_set.all().count()
+        request_count = getattr(self, 'request_count', None)
+        if request_count is None:
+            request_count = self.foirequest_set.all().count()
+        d['request_count'] = request_count
         return d
 
     @classmethod
@@ -57,6 +61,7 @@ class User(AbstractUser):
             "address", "terms", "newsletter",
             "request_count",
         )
+        queryset = queryset.annotate(request_count=models.Count('foirequest'))
         return export_csv(queryset, fields)
 
     def display_name(self):
@@ -68,42 +73,59 @@ class User(AbstractUser):
             else:
                 return self.get_full_name()
 
-    def apply_message_redaction(self, content, replacements=None):
+    def get_redaction_key(self, replacements=None):
+        """ Everything that changes the outcome of message redaction """
+        if replacements is None:
+            replacements = {}
+        return (get_language(), tuple(sorted(replacements.items())),
+                tuple(settings.FROIDE_CONFIG['greetings']),
+                self.address, self.email, self.private, self.first_name,
+                self.last_name, self.organization)
+
+    def add_message_redaction(self, redactor, replacements=None):
         if replacements is None:
             replacements = {}
 
         if self.address and replacements.get('address') is not False:
+            address_replacement = replacements.get('address',
+                    str(_("<< Address removed >>")))
             for line in self.address.splitlines():
                 if line.strip():
-                    content = content.replace(line,
-                            replacements.get('address',
-                                str(_("<< Address removed >>")))
-                    )
+                    redactor.replace(line, address_replacement)
 
         if self.email and replacements.get('email') is not False:
-            content = content.replace(self.email,
+            redactor.replace(self.email,
                     replacements.get('email',
                     str(_("<< Email removed >>")))
             )
 
         if not self.private or replacements.get('name') is False:
-            return content
+            return redactor
 
         name_replacement = replacements.get('name',
                 str(_("<< Name removed >>")))
 
-        content = replace_greetings(content,
-                settings.FROIDE_CONFIG['greetings'],
-                name_replacement)
+        greetings = settings.FROIDE_CONFIG['greetings']
+        redactor.add_step(lambda content: replace_greetings(content,
+                greetings, name_replacement))
 
-        content = replace_word(self.last_name, name_replacement, content)
-        content = replace_word(self.first_name, name_replacement, content)
-        content = replace_word(self.get_full_name(), name_replacement, content)
+        redactor.replace_word(self.last_name, name_replacement)
+        redactor.replace_word(self.first_name, name_replacement)
+        redactor.replace_word(self.get_full_name(), name_replacement)
 
         if self.organization:
-            content = replace_word(self.organization, name_replacement, content)
+            redactor.replace_word(self.organization, name_replacement)
 
-        return content
+        return redactor
+
+    def get_message_redactor(self, replacements=None):
+        return get_redactor(
+            ('user',) + self.get_redaction_key(replacements),
+            lambda: self.add_message_redaction(Redactor(), replacements)
+        )
+
+    def apply_message_redaction(self, content, replacements=None):
+        return self.get_message_redactor(replacements)(content)
 
     def get_autologin_url(self, url):
         account_manager = AccountManager(self)
@@ -595,12 +595,26 @@ class AccountTest(TestCase):
     def test_send_mass_mail(self):
         from froide.account.management.commands.send_mass_mail import Command
 
-        user_count = User.objects.all().count()
+        users = User.objects.filter(is_active=True).exclude(email='')
         mail.outbox = []
         command = Command()
         subject, content = 'Test', 'Testing-Content'
-        list(command.send_mail(subject, content))
-        self.assertEqual(len(mail.outbox), user_count)
+        emails = dict(users.values_list('pk', 'email'))
+        sent = []
+        outbox_sizes = []
+
+        def on_sent(user_pk):
+            outbox = [message.to[0] for message in mail.outbox]
+            self.assertIn(emails[user_pk], outbox)
+            outbox_sizes.append(len(outbox))
+            sent.append(user_pk)
+
+        command.send_mail(subject, content, on_sent, chunk_size=2)
+        self.assertEqual(len(mail.outbox), users.count())
+        # Marked right after its own chunk, not after all mails
+        self.assertLessEqual(outbox_sizes[0], 2)
+        self.assertEqual(sorted(sent),
+                         sorted(users.values_list('pk', flat=True)))
 
 
 class AdminActionTest(TestCase):
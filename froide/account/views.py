@@ -12,6 +12,7 @@ from django.utils.http import urlsafe_base64_decode, is_safe_url
 
 from froide.foirequestfollower.models import FoiRequestFollower
 from froide.foirequest.models import FoiRequest, FoiEvent
+from froide.foirequest.utils import prefetch_event_texts
 from froide.helper.auth import login_user
 from froide.helper.utils import render_403
 
@@ -84,10 +85,11 @@ def show(request, context=None, status=200):
     if followed_foirequest_ids:
         following = len(followed_foirequest_ids)
         since = datetime.utcnow() - timedelta(days=14)
-        events = FoiEvent.objects.filter(public=True,
+        events = list(FoiEvent.objects.filter(public=True,
                 request__in=followed_foirequest_ids,
-                timestamp__gte=since).order_by(
-                    'request', 'timestamp')
+                timestamp__gte=since).select_related('request').order_by(
+                    'request', 'timestamp'))
+        prefetch_event_texts(events)
     context.update({
         'own_requests': own_foirequests,
         'followed_requests': followed_requests,
@@ -103,7 +105,11 @@ def profile(request, slug):
     if user.private:
         raise Http404
     foirequests = FoiRequest.published.filter(user=user).order_by('-first_message')
-    foievents = FoiEvent.objects.filter(public=True, user=user)[:20]
+    foievents = list(FoiEvent.objects.filter(public=True, user=user
+            ).select_related('request')[:20])
+    for event in foievents:
+        event.user = user
+    prefetch_event_texts(foievents)
     return render(request, 'account/profile.html', {
         'profile_user': user,
         'requests': foirequests,
@@ -1,10 +1,13 @@
 import re
+import uuid
 
+from django.conf.urls import url
 from django.contrib import admin
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
 from django.db import router
+from django.http import Http404
 from django.template.response import TemplateResponse
 from django.utils.safestring import mark_safe
 from django.contrib.admin import helpers
@@ -15,14 +18,19 @@ import floppyforms as forms
 from froide.helper.admin_utils import NullFilterSpec, AdminTagAllMixIn
 from froide.helper.widgets import TagAutocompleteTagIt
 from froide.helper.email_utils import EmailParser
+from froide.helper.document_conversion import PRIORITY_LOW
 
 from .models import (FoiRequest, FoiMessage,
         FoiAttachment, FoiEvent, PublicBodySuggestion,
         DeferredMessage)
-from .tasks import count_same_foirequests, convert_attachment_task
+from .tasks import (count_same_foirequests, queue_attachment_conversions,
+        approve_attachments_task, convert_attachments_task)
+from .utils import approve_attachments, get_attachment_job, set_attachment_job
 
 
 SUBJECT_REQUEST_ID = re.compile(r' \[#(\d+)\]')
+# Larger selections are handled in a background job
+ATTACHMENT_JOB_SIZE = 500
 
 
 class FoiMessageInline(admin.StackedInline):
@@ -203,9 +211,46 @@ class FoiAttachmentAdmin(admin.ModelAdmin):
     search_fields = ['name']
     actions = ['approve', 'cannot_approve', 'convert']
 
+    def get_urls(self):
+        urls = super(FoiAttachmentAdmin, self).get_urls()
+        return [
+            url(r'^job/(?P<job_id>[0-9a-f]+)/$',
+                self.admin_site.admin_view(self.job_status),
+                name='foirequest_foiattachment_job'),
+        ] + urls
+
+    def start_job(self, request, task, action, attachment_ids, **kwargs):
+        job_id = uuid.uuid4().hex
+        set_attachment_job(job_id, action, 0, len(attachment_ids))
+        task.delay(job_id, attachment_ids, **kwargs)
+        self.message_user(request, mark_safe(
+            _('%(count)d attachments are processed in the background, '
+              '<a href="%(url)s">see progress</a>.') % {
+                'count': len(attachment_ids),
+                'url': reverse('admin:foirequest_foiattachment_job',
+                               kwargs={'job_id': job_id})
+            }))
+
+    def job_status(self, request, job_id):
+        job = get_attachment_job(job_id)
+        if job is None:
+            raise Http404
+        context = {
+            'opts': self.model._meta,
+            'media': self.media,
+            'job': job,
+            'applabel': self.model._meta.app_label
+        }
+        return TemplateResponse(request, 'foirequest/admin_attachment_job.html',
+            context, current_app=self.admin_site.name)
+
     def approve(self, request, queryset):
-        rows_updated = queryset.update(approved=True)
-        self.message_user(request, _("%d attachment(s) successfully approved." % rows_updated))
+        attachment_ids = list(queryset.values_list('id', flat=True))
+        if len(attachment_ids) > ATTACHMENT_JOB_SIZE:
+            return self.start_job(request, approve_attachments_task,
+                                  'approve', attachment_ids)
+        approved = approve_attachments(attachment_ids)
+        self.message_user(request, _("%d attachment(s) successfully approved.") % approved)
     approve.short_description = _("Mark selected as approved")
 
     def cannot_approve(self, request, queryset):
@@ -214,13 +259,16 @@ class FoiAttachmentAdmin(admin.ModelAdmin):
     cannot_approve.short_description = _("Mark selected as NOT approvable")
 
     def convert(self, request, queryset):
-        if not queryset:
+        attachment_ids = list(queryset.values_list('id', flat=True))
+        if not attachment_ids:
             return
-        for instance in queryset:
-            if (instance.filetype in FoiAttachment.CONVERTABLE_FILETYPES or
-                    instance.name.endswith(FoiAttachment.CONVERTABLE_FILETYPES)):
-                convert_attachment_task.delay(instance.pk)
-        self.message_user(request, _("Conversion tasks started."))
+        if len(attachment_ids) > ATTACHMENT_JOB_SIZE:
+            return self.start_job(request, convert_attachments_task,
+                                  'convert', attachment_ids,
+                                  priority=PRIORITY_LOW)
+        queued = queue_attachment_conversions(attachment_ids,
+                                              priority=PRIORITY_LOW)
+        self.message_user(request, _("%d conversion task(s) started.") % queued)
     convert.short_description = _("Convert to PDF")
 
 
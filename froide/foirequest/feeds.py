@@ -4,13 +4,19 @@ from django.utils.feedgenerator import Atom1Feed
 from django.utils.translation import ugettext_lazy as _
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404
+from django.http import Http404
+
+from froide.helper.paginator import KeysetPaginator, InvalidCursor
 
 from .models import FoiRequest
+from .utils import prefetch_event_texts
 
 
 class LatestFoiRequestsFeed(Feed):
-    def __init__(self, items, topic=None, jurisdiction=None, public_body=None, tag=None, status=None):
-        self.items = items
+    def __init__(self, items, topic=None, jurisdiction=None, public_body=None,
+            tag=None, status=None, after=None):
+        self.item_queryset = items
+        self.after = after
         self.topic = topic
         self.jurisdiction = jurisdiction
         self.tag = tag
@@ -77,7 +83,12 @@ class LatestFoiRequestsFeed(Feed):
         return reverse('foirequest-list_feed', kwargs=self.get_link_kwargs())
 
     def items(self):
-        return self.items.order_by("-first_message")[:15]
+        paginator = KeysetPaginator(self.item_queryset, 15,
+                                    field='first_message')
+        try:
+            return paginator.page(after=self.after).object_list
+        except InvalidCursor:
+            raise Http404
 
     def item_title(self, item):
         if item.public_body:
@@ -118,7 +129,11 @@ class FoiRequestFeed(Feed):
         return obj.description
 
     def items(self, obj):
-        return obj.foievent_set.order_by("-timestamp")[:15]
+        events = list(obj.foievent_set.order_by("-timestamp")[:15])
+        for event in events:
+            event.request = obj
+        prefetch_event_texts(events)
+        return events
 
     def item_title(self, item):
         return item.as_text()
@@ -1,27 +1,91 @@
+import hashlib
 import os
+import shutil
 import tempfile
 import subprocess
 import logging
 
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
 
-def convert_to_pdf(filepath, binary_name=None, construct_call=None):
+from froide.helper.document_conversion import (get_conversion_pool,
+        ConversionError, PRIORITY_NORMAL)
+
+BLOB_DIRECTORY = 'blobs'
+BLOB_CHUNK_SIZE = 64 * 1024
+
+
+def get_blob_name(content_hash, filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return '%s/%s/%s/%s/%s%s' % (settings.FOI_MEDIA_PATH, BLOB_DIRECTORY,
+                                 content_hash[:2], content_hash[2:4],
+                                 content_hash, extension)
+
+
+def is_blob_name(name):
+    return name.startswith('%s/%s/' % (settings.FOI_MEDIA_PATH,
+                                       BLOB_DIRECTORY))
+
+
+def iter_blob_directories(storage=default_storage):
+    """
+    Yields (directory, filenames) for every directory of the blob store
+    """
+    top = '%s/%s' % (settings.FOI_MEDIA_PATH, BLOB_DIRECTORY)
+    try:
+        first_levels = storage.listdir(top)[0]
+    except OSError:
+        return
+    for first in first_levels:
+        for second in storage.listdir('%s/%s' % (top, first))[0]:
+            directory = '%s/%s/%s' % (top, first, second)
+            yield directory, storage.listdir(directory)[1]
+
+
+def store_blob(content, filename, storage=default_storage):
+    """
+    Hashes the content while copying it to a temporary file and stores
+    it under its SHA-1 unless a blob with that hash is already stored.
+    Returns (name, content_hash, size).
+    """
+    if not isinstance(content, File):
+        content = File(content)
+    checksum = hashlib.sha1()
+    size = 0
+    with tempfile.TemporaryFile() as temp:
+        for chunk in content.chunks(BLOB_CHUNK_SIZE):
+            checksum.update(chunk)
+            size += len(chunk)
+            temp.write(chunk)
+        content_hash = checksum.hexdigest()
+        name = get_blob_name(content_hash, filename)
+        if not storage.exists(name):
+            temp.seek(0)
+            name = storage.save(name, File(temp))
+    return name, content_hash, size
+
+
+def convert_to_pdf(filepath, binary_name=None, construct_call=None,
+                   priority=PRIORITY_NORMAL):
+    """
+    Returns the path of the PDF in a new temporary directory or None.
+    Without construct_call the document is converted by the conversion
+    pool of this process.
+    """
     if binary_name is None and construct_call is None:
         return
     outpath = tempfile.mkdtemp()
-    path, filename = os.path.split(filepath)
-    name, extension = filename.rsplit('.', 1)
-    output_file = os.path.join(outpath, '%s.pdf' % name)
-    arguments = [
-        binary_name,
-        "--headless",
-        "--convert-to",
-        "pdf",
-        "--outdir",
-        outpath,
-        filepath
-    ]
-    if construct_call is not None:
-        arguments, output_file = construct_call(filepath, outpath)
+    if construct_call is None:
+        try:
+            return get_conversion_pool(binary_name).convert(filepath, outpath,
+                                                            priority=priority)
+        except ConversionError as e:
+            logging.error("Error during Doc to PDF conversion of %s: %s",
+                          filepath, e)
+            shutil.rmtree(outpath, ignore_errors=True)
+            return None
+    arguments, output_file = construct_call(filepath, outpath)
 
     # Set different HOME so libreoffice can write to it
     env = dict(os.environ)
@@ -43,4 +107,5 @@ def convert_to_pdf(filepath, binary_name=None, construct_call=None):
             return output_file
     else:
         logging.error("Error during Doc to PDF conversion: %s", err)
+    shutil.rmtree(outpath, ignore_errors=True)
     return None
@@ -1,24 +1,39 @@
 import base64
+import hashlib
 import json
+import logging
+import os
+import shutil
+import tempfile
 import zipfile
 from email.utils import parseaddr
 import random
 
 from django.conf import settings
-from django.core.mail import get_connection, EmailMessage, mail_managers
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMessage, mail_managers
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.utils.translation import override, ugettext, ugettext_lazy as _
-from django.utils.six import BytesIO, string_types
+from django.utils.six import BytesIO, binary_type, string_types
 
-from froide.helper.email_utils import (EmailParser, get_unread_mails,
+from froide.helper.email_utils import (EmailParser, ImapMailFetcher,
                                        make_address)
+from froide.helper.email_sending import send_message
 from froide.helper.name_generator import get_name_from_number
 
+logger = logging.getLogger(__name__)
+
 
 unknown_foimail_message = _('''We received an FoI mail to this address: %(address)s.
 No corresponding request could be identified, please investigate! %(url)s
 ''')
 
+failed_message = _('''A fetched FoI mail could not be processed and was stored as undelivered.
+Please investigate! %(address)s %(url)s
+''')
+
 spam_message = _('''We received a possible spam mail to this address: %(address)s.
 Please investigate! %(url)s
 ''')
@@ -26,14 +41,13 @@ Please investigate! %(url)s
 
 def send_foi_mail(subject, message, from_email, recipient_list,
                   attachments=None, fail_silently=False, **kwargs):
-    connection = get_connection(
+    connection_kwargs = dict(
         backend=getattr(settings, 'FOI_EMAIL_BACKEND', settings.EMAIL_BACKEND),
         username=settings.FOI_EMAIL_HOST_USER,
         password=settings.FOI_EMAIL_HOST_PASSWORD,
         host=settings.FOI_EMAIL_HOST,
         port=settings.FOI_EMAIL_PORT,
-        use_tls=settings.FOI_EMAIL_USE_TLS,
-        fail_silently=fail_silently
+        use_tls=settings.FOI_EMAIL_USE_TLS
     )
     headers = {}
     if "message_id" in kwargs:
@@ -46,20 +60,29 @@ def send_foi_mail(subject, message, from_email, recipient_list,
     else:
         headers['Reply-To'] = from_email
     email = EmailMessage(subject, message, from_email, recipient_list,
-                        connection=connection, headers=headers)
+                        headers=headers)
     if attachments is not None:
         for name, data, mime_type in attachments:
+            if hasattr(data, 'read'):
+                # Spooled file, read only when building the mail
+                data.seek(0)
+                data = data.read()
             email.attach(name, data, mime_type)
-    return email.send()
+    return send_message(email, connection_kwargs=connection_kwargs,
+                        fail_silently=fail_silently)
 
 
 def _process_mail(mail_string, mail_type=None, manual=False):
-    parser = EmailParser()
+    parser = EmailParser(max_memory_size=settings.FOI_EMAIL_MAX_MEMORY_SIZE)
     if mail_type is None:
-        email = parser.parse(BytesIO(mail_string))
+        email = parser.parse_stream(BytesIO(mail_string))
     elif mail_type == 'postmark':
         email = parser.parse_postmark(json.loads(mail_string.decode('utf-8')))
-    return _deliver_mail(email, mail_string=mail_string, manual=manual)
+    try:
+        return _deliver_mail(email, mail_string=mail_string, manual=manual)
+    finally:
+        for attachment in email['attachments']:
+            attachment.close()
 
 
 def create_deferred(secret_mail, mail_string, b64_encoded=False, spam=False,
@@ -68,7 +91,10 @@ def create_deferred(secret_mail, mail_string, b64_encoded=False, spam=False,
 
     if mail_string is not None:
         if not b64_encoded:
-            mail_string = base64.b64encode(mail_string.encode('utf-8')).decode("utf-8")
+            # The raw mail is only encoded when it has to be stored
+            if not isinstance(mail_string, binary_type):
+                mail_string = mail_string.encode('utf-8')
+            mail_string = base64.b64encode(mail_string).decode("utf-8")
     DeferredMessage.objects.create(
         recipient=secret_mail,
         mail=mail_string,
@@ -138,15 +164,6 @@ def _deliver_mail(email, mail_string=None, manual=False):
     received_list = [(x[0], '@'.join(
         (x[1].split('@')[0], domains[0]))) for x in received_list]
 
-    if mail_string is not None:
-        # make original mail storeable as unicode
-        b64_encoded = False
-        try:
-            mail_string = mail_string.decode("utf-8")
-        except UnicodeDecodeError:
-            b64_encoded = True
-            mail_string = base64.b64encode(mail_string).decode("utf-8")
-
     already = set()
     for received in received_list:
         secret_mail = received[1]
@@ -159,54 +176,113 @@ def _deliver_mail(email, mail_string=None, manual=False):
             deferred = DeferredMessage.objects.filter(recipient=secret_mail, request__isnull=False)
             if len(deferred) == 0 or len(deferred) > 1:
                 # Can't do automatic matching!
-                create_deferred(secret_mail, mail_string, b64_encoded=b64_encoded, spam=False)
+                create_deferred(secret_mail, mail_string, spam=False)
                 continue
             else:
                 deferred = deferred[0]
                 foi_request = deferred.request
 
         # Check for spam
-        if not manual:
-            messages = foi_request.response_messages()
-            reply_domains = set(m.sender_email.split('@')[1] for m in messages
-                             if m.sender_email and '@' in m.sender_email)
-            reply_domains.add(foi_request.public_body.email.split('@')[1])
-            strip_subdomains = lambda x: '.'.join(x.split('.')[-2:])
-            # Strip subdomains
-            reply_domains = set([strip_subdomains(x) for x in reply_domains])
-
-            sender_email = email['from'][1]
-            if len(messages) > 0 and sender_email and '@' in sender_email:
-                email_domain = strip_subdomains(sender_email.split('@')[1])
-                if email_domain not in reply_domains:
-                    create_deferred(secret_mail, mail_string, b64_encoded=b64_encoded,
-                        spam=True, subject=_('Possible Spam Mail received'), body=spam_message)
-                    continue
+        if not manual and not foi_request.is_known_sender(email['from'][1]):
+            create_deferred(secret_mail, mail_string, spam=True,
+                subject=_('Possible Spam Mail received'), body=spam_message)
+            continue
 
         foi_request.add_message_from_email(email, mail_string)
 
 
-def _fetch_mail():
-    for rfc_data in get_unread_mails(settings.FOI_EMAIL_HOST_IMAP,
+def get_mail_fetcher(**kwargs):
+    return ImapMailFetcher(settings.FOI_EMAIL_HOST_IMAP,
             settings.FOI_EMAIL_PORT_IMAP,
             settings.FOI_EMAIL_ACCOUNT_NAME,
             settings.FOI_EMAIL_ACCOUNT_PASSWORD,
-            ssl=settings.FOI_EMAIL_USE_SSL):
-        yield rfc_data
-
-
-def fetch_and_process():
+            ssl=settings.FOI_EMAIL_USE_SSL,
+            batch_size=settings.FOI_EMAIL_FETCH_BATCH_SIZE,
+            connections=settings.FOI_EMAIL_FETCH_CONNECTIONS,
+            **kwargs)
+
+
+def get_fetch_checkpoint(uidvalidity):
+    from .models import MailFetchCheckpoint
+
+    try:
+        checkpoint = MailFetchCheckpoint.objects.get(
+            account=settings.FOI_EMAIL_ACCOUNT_NAME)
+    except MailFetchCheckpoint.DoesNotExist:
+        return 0
+    if checkpoint.uidvalidity != uidvalidity:
+        return 0
+    return checkpoint.uid
+
+
+def set_fetch_checkpoint(uidvalidity, uid):
+    from .models import MailFetchCheckpoint
+
+    MailFetchCheckpoint.objects.update_or_create(
+        account=settings.FOI_EMAIL_ACCOUNT_NAME,
+        defaults={'uidvalidity': uidvalidity, 'uid': uid})
+
+
+def _process_fetched_mail(rfc_data, uidvalidity=None, uid=None):
+    """
+    Processes the mail and, when a UID is given, moves the
+    checkpoint to it in the same transaction
+    """
+    try:
+        with transaction.atomic():
+            _process_mail(rfc_data)
+            if uid is not None:
+                set_fetch_checkpoint(uidvalidity, uid)
+    except Exception:
+        logger.exception('Could not process fetched mail')
+        with transaction.atomic():
+            create_deferred('', base64.b64encode(rfc_data).decode('utf-8'),
+                b64_encoded=True, subject=_('Could not process FoI-Mail'),
+                body=failed_message)
+            if uid is not None:
+                set_fetch_checkpoint(uidvalidity, uid)
+
+
+def fetch_and_process(fetcher=None):
+    """
+    Processes unseen mails in UID order and only flags them as seen
+    after they have been committed. The last processed UID is kept as
+    a checkpoint so mails that were processed but could not be flagged
+    are not delivered twice.
+    """
+    if fetcher is None:
+        fetcher = get_mail_fetcher()
     count = 0
-    for rfc_data in _fetch_mail():
-        _process_mail(rfc_data)
-        count += 1
+    try:
+        uidvalidity = fetcher.get_uidvalidity()
+        checkpoint = get_fetch_checkpoint(uidvalidity)
+        uids = fetcher.get_unread_uids()
+        fetcher.mark_seen([uid for uid in uids if uid <= checkpoint])
+        uids = [uid for uid in uids if uid > checkpoint]
+        for mails in fetcher.fetch_batches(uids):
+            for uid, rfc_data in mails:
+                _process_fetched_mail(rfc_data, uidvalidity, uid)
+                count += 1
+            fetcher.mark_seen([uid for uid, _ in mails])
+    finally:
+        fetcher.close()
     return count
 
 
-def package_foirequest(foirequest):
-    zfile_obj = BytesIO()
+PACKAGE_CHUNK_SIZE = 64 * 1024
+ARCHIVE_DIRECTORY = 'archives'
+
+
+def get_package_members(foirequest):
+    """
+    Returns the planned ZIP members of a request as a list of
+    (arcname, key, data, path) tuples. Message texts are given as data,
+    attachments as path so they are only read when actually written.
+    The key identifies the member content and is stored as the
+    member comment in the archive.
+    """
+    members = []
     with override(settings.LANGUAGE_CODE):
-        zfile = zipfile.ZipFile(zfile_obj, 'w')
         last_date = None
         date_count = 1
         for message in foirequest.messages:
@@ -219,21 +295,191 @@ def package_foirequest(foirequest):
             date_prefix += '_%d' % date_count
             last_date = current_date
 
-            att_queryset = message.foiattachment_set.filter(
+            attachments = list(message.foiattachment_set.filter(
                 is_redacted=False,
                 is_converted=False
-            )
+            ))
             if message.is_response:
                 filename = '%s_%s.txt' % (date_prefix, ugettext('publicbody'))
             else:
                 filename = '%s_%s.txt' % (date_prefix, ugettext('requester'))
 
-            zfile.writestr(filename, message.get_formated(att_queryset).encode('utf-8'))
+            data = message.get_formated(attachments).encode('utf-8')
+            members.append((filename, hashlib.sha1(data).hexdigest(),
+                            data, None))
 
-            for attachment in att_queryset:
+            for attachment in attachments:
                 if not attachment.file:
                     continue
                 filename = '%s-%s' % (date_prefix, attachment.name)
-                zfile.write(attachment.file.path, arcname=filename)
+                key = u'%s#%s#%s#%s#%s' % (attachment.id, attachment.size,
+                    attachment.file.name, attachment.approved,
+                    attachment.redacted_id)
+                key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+                members.append((filename, key, None, attachment.file.path))
+    return members
+
+
+def write_package_members(zfile, members):
+    for arcname, key, data, path in members:
+        if data is not None:
+            zfile.writestr(arcname, data)
+        else:
+            zfile.write(path, arcname=arcname)
+        zfile.infolist()[-1].comment = key.encode('ascii')
+
+
+def write_foirequest_package(foirequest, fileobj, members=None):
+    """
+    Write the ZIP package of a request to the given file object.
+    Attachments are copied from their files in chunks by zipfile,
+    so memory usage does not depend on the size of the request.
+    """
+    if members is None:
+        members = get_package_members(foirequest)
+    zfile = zipfile.ZipFile(fileobj, 'w')
+    write_package_members(zfile, members)
+    zfile.close()
+    return fileobj
+
+
+def spool_foirequest_package(foirequest):
+    """
+    Returns an open temporary file containing the ZIP package,
+    positioned at the start. The caller needs to close it.
+    """
+    package_file = tempfile.TemporaryFile()
+    try:
+        write_foirequest_package(foirequest, package_file)
+    except Exception:
+        package_file.close()
+        raise
+    package_file.seek(0)
+    return package_file
+
+
+def iter_file_chunks(fileobj, chunk_size=PACKAGE_CHUNK_SIZE):
+    try:
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fileobj.close()
+
+
+def iter_foirequest_package(foirequest, chunk_size=PACKAGE_CHUNK_SIZE):
+    """
+    Yields the ZIP package in chunks, suitable for StreamingHttpResponse
+    """
+    package_file = spool_foirequest_package(foirequest)
+    return iter_file_chunks(package_file, chunk_size=chunk_size)
+
+
+def package_foirequest(foirequest):
+    package_file = spool_foirequest_package(foirequest)
+    try:
+        return package_file.read()
+    finally:
+        package_file.close()
+
+
+def get_members_fingerprint(members):
+    fingerprint = hashlib.sha1()
+    for member in members:
+        fingerprint.update(member[1].encode('ascii'))
+    return fingerprint.hexdigest()
+
+
+def get_archive_directory(foirequest):
+    return '%s/%s/%s' % (settings.FOI_MEDIA_PATH, ARCHIVE_DIRECTORY,
+                         foirequest.pk)
+
+
+def get_stored_archives(foirequest):
+    directory = get_archive_directory(foirequest)
+    if not default_storage.exists(directory):
+        return []
+    _, filenames = default_storage.listdir(directory)
+    return ['%s/%s' % (directory, f) for f in filenames if f.endswith('.zip')]
+
+
+def delete_foirequest_archives(foirequest, keep=None):
+    """
+    Deletes the stored archives of the request except keep, without
+    keep also their directory
+    """
+    for name in get_stored_archives(foirequest):
+        if name != keep:
+            default_storage.delete(name)
+    if keep is not None:
+        return
+    try:
+        # File system storages keep the empty directory
+        os.rmdir(default_storage.path(get_archive_directory(foirequest)))
+    except (NotImplementedError, OSError):
+        pass
+
+
+def _append_package_members(package_file, members):
+    """
+    Appends the missing members to the archive in package_file if it
+    holds a prefix of members. Returns False if the archive is stale.
+    """
+    try:
+        zfile = zipfile.ZipFile(package_file, 'a')
+    except zipfile.BadZipfile:
+        return False
+    old_keys = [info.comment for info in zfile.infolist()]
+    new_keys = [m[1].encode('ascii') for m in members]
+    if old_keys != new_keys[:len(old_keys)]:
         zfile.close()
-    return zfile_obj.getvalue()
+        return False
+    write_package_members(zfile, members[len(old_keys):])
+    zfile.close()
+    return True
+
+
+def get_foirequest_archive(foirequest):
+    """
+    Returns the storage name of an up to date ZIP package of the request.
+
+    Archives are stored under a fingerprint of their members.
+    If the fingerprint matches the stored archive it is returned as is,
+    if messages were only added the stored archive is copied and
+    the new members are appended. Otherwise it is rebuilt.
+    """
+    members = get_package_members(foirequest)
+    fingerprint = get_members_fingerprint(members)
+    name = '%s/%s.zip' % (get_archive_directory(foirequest), fingerprint)
+    if default_storage.exists(name):
+        return name
+
+    previous = get_stored_archives(foirequest)
+    package_file = tempfile.TemporaryFile()
+    try:
+        appended = False
+        if previous:
+            with default_storage.open(previous[0], 'rb') as old_file:
+                shutil.copyfileobj(old_file, package_file, PACKAGE_CHUNK_SIZE)
+            package_file.seek(0)
+            appended = _append_package_members(package_file, members)
+            if not appended:
+                package_file.seek(0)
+                package_file.truncate()
+        if not appended:
+            write_foirequest_package(foirequest, package_file,
+                                     members=members)
+        package_file.seek(0)
+        saved_name = default_storage.save(name, File(package_file))
+    finally:
+        package_file.close()
+
+    if saved_name != name:
+        # Written at the same time by another request, the storage
+        # saved this copy under another name
+        default_storage.delete(saved_name)
+    # Older fingerprints and copies of other requests
+    delete_foirequest_archives(foirequest, keep=name)
+    return name
@@ -142,6 +142,7 @@ class MessagePublicBodySenderForm(forms.Form):
             widget=PublicBodySelect, min_value=1)
 
     def __init__(self, message, *args, **kwargs):
+        jurisdictions = kwargs.pop('jurisdictions', None)
         if "initial" not in kwargs:
             if message.sender_public_body:
                 kwargs['initial'] = {"sender": message.sender_public_body.id}
@@ -149,6 +150,11 @@ class MessagePublicBodySenderForm(forms.Form):
             kwargs['prefix'] = "m%d" % message.id
         self.message = message
         super(MessagePublicBodySenderForm, self).__init__(*args, **kwargs)
+        widget = self.fields['sender'].widget
+        if message.sender_public_body:
+            widget.set_initial_public_body(message.sender_public_body)
+        if jurisdictions is not None:
+            widget.set_jurisdictions(jurisdictions)
 
     def clean_sender(self):
         pk = self.cleaned_data['sender']
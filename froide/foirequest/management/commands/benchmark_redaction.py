@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import translation
+from django.conf import settings
+
+from froide.foirequest.models import FoiMessage
+
+
+class Command(BaseCommand):
+    help = ("Compares compiled and step by step redaction of message "
+            "plaintext and reports timings and mismatches")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000,
+            help='Number of latest responses to use')
+        parser.add_argument('--rounds', type=int, default=5,
+            help='Number of times to redact each message')
+
+    def handle(self, *args, **options):
+        translation.activate(settings.LANGUAGE_CODE)
+
+        messages = list(FoiMessage.objects.filter(is_response=True)
+                        .select_related('request', 'request__user')
+                        .order_by('-timestamp')[:options['count']])
+        redactors = [m.get_plaintext_redactor() for m in messages]
+        total_size = sum(len(m.plaintext) for m in messages)
+
+        timings = {}
+        for name in ('sequential', 'compiled'):
+            start = time.time()
+            for _ in range(options['rounds']):
+                for message, redactor in zip(messages, redactors):
+                    if name == 'compiled':
+                        redactor(message.plaintext)
+                    else:
+                        redactor.apply_sequential(message.plaintext)
+            timings[name] = time.time() - start
+
+        mismatches = [m.pk for m, r in zip(messages, redactors)
+                      if r(m.plaintext) != r.apply_sequential(m.plaintext)]
+
+        self.stdout.write('%d messages, %d characters, %d rounds\n' % (
+            len(messages), total_size, options['rounds']))
+        for name in ('sequential', 'compiled'):
+            self.stdout.write('%s: %.3fs\n' % (name, timings[name]))
+        if mismatches:
+            self.stdout.write('Mismatching messages: %s\n' % ', '.join(
+                str(pk) for pk in mismatches))
+        else:
+            self.stdout.write('Output identical for all messages\n')
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from froide.foirequest.utils import (move_attachments_to_blobs,
+        ATTACHMENT_CHUNK_SIZE)
+
+
+class Command(BaseCommand):
+    help = ("Moves attachment files into the blob store, where identical "
+            "files are only stored once.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int,
+            default=ATTACHMENT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        def progress(moved, missing, last_id):
+            self.stdout.write('Moved %d, missing %d attachments (last id %d)\n' % (
+                moved, missing, last_id))
+
+        moved, missing = move_attachments_to_blobs(
+            chunk_size=options['chunk_size'],
+            callback=progress
+        )
+        self.stdout.write('Moved %d attachments, %d files were missing\n' % (
+            moved, missing))
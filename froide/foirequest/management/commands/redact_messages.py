@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.utils import translation
+from django.conf import settings
+
+from froide.foirequest.utils import redact_messages, REDACTION_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the redacted subject and text of messages. "
+            "Note that manual changes to redacted texts are overwritten "
+            "and redactions of old names or addresses are removed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, dest='user_id',
+            help='Only messages of requests by this user id')
+        parser.add_argument('--only-missing', action='store_true',
+            default=False,
+            help='Only messages that have not been redacted yet')
+        parser.add_argument('--restart', action='store_true', default=False,
+            help='Ignore the checkpoint of an interrupted run')
+        parser.add_argument('--chunk-size', type=int,
+            default=REDACTION_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        translation.activate(settings.LANGUAGE_CODE)
+
+        def progress(checked, updated, last_id):
+            self.stdout.write('Checked %d, updated %d messages (last id %d)\n' % (
+                checked, updated, last_id))
+
+        checked, updated = redact_messages(
+            user_id=options['user_id'],
+            only_missing=options['only_missing'],
+            restart=options['restart'],
+            chunk_size=options['chunk_size'],
+            callback=progress
+        )
+        self.stdout.write('Redacted %d of %d messages\n' % (updated, checked))
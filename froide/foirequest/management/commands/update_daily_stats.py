@@ -0,0 +1,33 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from froide.foirequest.utils import update_daily_stats, STATS_START_DATE
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError('Invalid date %r, use YYYY-MM-DD' % value)
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the daily statistics of the staff dashboard. "
+            "Without arguments all days since the start are recomputed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=parse_date,
+            default=STATS_START_DATE, help='First day (YYYY-MM-DD)')
+        parser.add_argument('--end', type=parse_date,
+            help='Last day (YYYY-MM-DD), defaults to today')
+
+    def handle(self, *args, **options):
+        def progress(start_date, end_date):
+            self.stdout.write('Updated %s to %s\n' % (
+                start_date.isoformat(), end_date.isoformat()))
+
+        count = update_daily_stats(start_date=options['start'],
+                                   end_date=options['end'],
+                                   callback=progress)
+        self.stdout.write('%d days with statistics\n' % count)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+def get_base_domain(domain):
+    return '.'.join(domain.split('.')[-2:])
+
+
+def create_addresses(apps, schema_editor):
+    FoiMessage = apps.get_model('foirequest', 'FoiMessage')
+    FoiRequestAddress = apps.get_model('foirequest', 'FoiRequestAddress')
+
+    current_request = None
+    addresses = {}
+
+    def flush():
+        FoiRequestAddress.objects.bulk_create(list(addresses.values()))
+        addresses.clear()
+
+    messages = FoiMessage.objects.order_by('request', 'timestamp').values_list(
+        'request_id', 'timestamp', 'is_response',
+        'sender_email', 'sender_public_body_id',
+        'recipient_email', 'recipient_public_body_id')
+    for (request_id, timestamp, is_response, sender_email, sender_pb_id,
+            recipient_email, recipient_pb_id) in messages.iterator():
+        if request_id != current_request:
+            flush()
+            current_request = request_id
+        if is_response:
+            email, public_body_id = sender_email, sender_pb_id
+        else:
+            email, public_body_id = recipient_email, recipient_pb_id
+        if not email or '@' not in email:
+            continue
+        email = email.strip().lower()[:255]
+        key = (email, is_response)
+        address = addresses.get(key)
+        if address is None:
+            domain = email.split('@')[1]
+            addresses[key] = FoiRequestAddress(
+                request_id=request_id, email=email,
+                domain=domain, base_domain=get_base_domain(domain),
+                is_response=is_response, public_body_id=public_body_id,
+                timestamp=timestamp)
+        elif public_body_id is not None:
+            address.public_body_id = public_body_id
+            address.timestamp = timestamp
+    flush()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publicbody', '0002_auto_20151127_1754'),
+        ('foirequest', '0002_auto_20150728_1829'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FoiRequestAddress',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('email', models.CharField(max_length=255, verbose_name='Email')),
+                ('domain', models.CharField(max_length=255, verbose_name='Domain')),
+                ('base_domain', models.CharField(max_length=255, verbose_name='Base domain')),
+                ('is_response', models.BooleanField(default=True, verbose_name='Is sender of a response?')),
+                ('timestamp', models.DateTimeField(verbose_name='Timestamp')),
+                ('public_body', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, verbose_name='Public Body', blank=True, to='publicbody.PublicBody', null=True)),
+                ('request', models.ForeignKey(verbose_name='Freedom of Information Request', to='foirequest.FoiRequest')),
+            ],
+            options={
+                'verbose_name': 'Request Address',
+                'verbose_name_plural': 'Request Addresses',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='foirequestaddress',
+            unique_together=set([('request', 'email', 'is_response')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='foirequestaddress',
+            index_together=set([('request', 'is_response', 'base_domain'), ('public_body', 'is_response', 'base_domain'), ('request', 'is_response', 'domain')]),
+        ),
+        migrations.RunPython(create_addresses, migrations.RunPython.noop),
+    ]
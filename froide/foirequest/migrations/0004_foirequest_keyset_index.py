@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foirequest', '0003_foirequestaddress'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='foirequest',
+            index_together=set([('last_message', 'id'), ('first_message', 'id')]),
+        ),
+    ]
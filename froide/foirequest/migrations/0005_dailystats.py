@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foirequest', '0004_foirequest_keyset_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField(unique=True, verbose_name='Date')),
+                ('users', models.IntegerField(default=0, verbose_name='New users')),
+                ('requests', models.IntegerField(default=0, verbose_name='New requests')),
+                ('requests_public', models.IntegerField(default=0, verbose_name='New public requests')),
+                ('requests_not_same_as', models.IntegerField(default=0, verbose_name='New requests that are not identical to others')),
+                ('requests_public_not_same_as', models.IntegerField(default=0, verbose_name='New public requests that are not identical to others')),
+            ],
+            options={
+                'ordering': ('date',),
+                'verbose_name': 'Daily statistics',
+                'verbose_name_plural': 'Daily statistics',
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foirequest', '0005_dailystats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foimessage',
+            name='redaction_spans',
+            field=models.TextField(null=True, verbose_name='redaction spans', blank=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foirequest', '0006_foimessage_redaction_spans'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foimessage',
+            name='rendered_key',
+            field=models.CharField(default='', max_length=40, verbose_name='rendered content key', blank=True),
+        ),
+        migrations.AddField(
+            model_name='foimessage',
+            name='rendered_owner',
+            field=models.TextField(null=True, verbose_name='rendered content for the owner', blank=True),
+        ),
+        migrations.AddField(
+            model_name='foimessage',
+            name='rendered_public',
+            field=models.TextField(null=True, verbose_name='rendered public content', blank=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foirequest', '0007_foimessage_rendered_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='foiattachment',
+            name='content_hash',
+            field=models.CharField(db_index=True, max_length=40, verbose_name='Content hash', blank=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foirequest', '0008_foiattachment_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailFetchCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('account', models.CharField(unique=True, max_length=255, verbose_name='Account')),
+                ('uidvalidity', models.BigIntegerField(null=True, verbose_name='UIDVALIDITY')),
+                ('uid', models.BigIntegerField(verbose_name='UID')),
+                ('timestamp', models.DateTimeField(auto_now=True, verbose_name='Timestamp')),
+            ],
+            options={
+                'verbose_name': 'Mail fetch checkpoint',
+                'verbose_name_plural': 'Mail fetch checkpoints',
+            },
+        ),
+    ]
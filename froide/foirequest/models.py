@@ -1,4 +1,5 @@
 import base64
+import hashlib
 import random
 from datetime import timedelta
 import json
@@ -9,16 +10,18 @@ from django.db import models
 from django.db.models import Q
 from django.db import transaction, IntegrityError
 from django.conf import settings
-from django.utils.translation import ugettext_lazy as _, ungettext_lazy
+from django.core.cache import cache
+from django.utils.translation import (ugettext_lazy as _, ungettext_lazy,
+        get_language)
 from django.contrib.sites.models import Site
 from django.contrib.sites.managers import CurrentSiteManager
 from django.core.urlresolvers import reverse
-from django.core.files import File
+from django.core.files.storage import default_storage
 import django.dispatch
 from django.template.defaultfilters import slugify
 from django.template.loader import render_to_string
 from django.utils.timesince import timesince
-from django.core.mail import send_mail, mail_managers
+from django.core.mail import mail_managers
 from django.utils.safestring import mark_safe
 from django.utils.html import escape, strip_tags
 from django.utils.crypto import salted_hmac, constant_time_compare
@@ -30,11 +33,14 @@ from taggit.models import TaggedItemBase
 
 from froide.publicbody.models import PublicBody, FoiLaw, Jurisdiction
 from froide.helper.email_utils import make_address
+from froide.helper.email_sending import send_mail
 from froide.helper.text_utils import (replace_email_name,
-        replace_email, remove_closing, replace_greetings)
+        replace_email, remove_closing, replace_greetings, Redactor,
+        get_redactor, get_differences, split_text_by_separator)
 
 
-from .foi_mail import send_foi_mail, package_foirequest
+from .foi_mail import send_foi_mail, get_foirequest_archive
+from .file_utils import store_blob
 
 
 class FoiRequestManager(CurrentSiteManager):
@@ -317,6 +323,10 @@ class FoiRequest(models.Model):
     class Meta:
         ordering = ('last_message',)
         get_latest_by = 'last_message'
+        index_together = [
+            ('last_message', 'id'),
+            ('first_message', 'id'),
+        ]
         verbose_name = _('Freedom of Information Request')
         verbose_name_plural = _('Freedom of Information Requests')
         permissions = (
@@ -371,6 +381,7 @@ class FoiRequest(models.Model):
             self._messages = list(self.foimessage_set.select_related(
                 "sender_user",
                 "sender_public_body",
+                "sender_public_body__jurisdiction",
                 "recipient_public_body").order_by("timestamp"))
         return self._messages
 
@@ -573,30 +584,31 @@ class FoiRequest(models.Model):
     def find_public_body_for_email(self, email):
         if not email or '@' not in email:
             return self.public_body
-        messages = list(reversed(self.messages))
-        domain = email.split('@', 1)[1]
-        for m in messages:
-            if m.is_response:
-                if not m.sender_public_body or not m.sender_email:
-                    continue
-                sender_email = m.sender_email.lower()
-                if sender_email == email:
-                    return m.sender_public_body
-                if ('@' in sender_email and
-                        sender_email.split('@')[1] == domain):
-                    return m.sender_public_body
-        for m in messages:
-            if not m.is_response:
-                if not m.recipient_public_body or not m.recipient_email:
-                    continue
-                recipient_email = m.recipient_email.lower()
-                if recipient_email == email:
-                    return m.recipient_public_body
-                if ('@' in recipient_email and
-                        recipient_email.split('@')[1] == domain):
-                    return m.recipient_public_body
+        domain = email.split('@', 1)[1].lower()
+        for is_response in (True, False):
+            address = FoiRequestAddress.objects.get_latest_for_domain(
+                self, domain, is_response=is_response)
+            if address is not None:
+                return address.public_body
         return self.public_body
 
+    def is_known_sender(self, email):
+        """
+        Spam check for incoming mail: once a reply was received,
+        mail is only accepted from domains that replied before
+        or belong to the public body.
+        """
+        if not email or '@' not in email:
+            return True
+        if not self.foimessage_set.filter(is_response=True).exists():
+            return True
+        domain = get_base_domain(email.split('@', 1)[1])
+        if (self.public_body and self.public_body.email and
+                '@' in self.public_body.email and
+                get_base_domain(self.public_body.email.split('@')[1]) == domain):
+            return True
+        return FoiRequestAddress.objects.is_known_domain(self, domain)
+
     def get_send_message_form(self):
         from .forms import SendMessageForm
         last_message = list(self.messages)[-1]
@@ -678,8 +690,7 @@ class FoiRequest(models.Model):
             att.name = att.name[:255]
             if att.name.endswith('pdf') or 'pdf' in att.filetype:
                 has_pdf = True
-            attachment._committed = False
-            att.file = File(attachment)
+            att.store_file(attachment)
             att.save()
         if (has_pdf and
                 settings.FROIDE_CONFIG.get("mail_managers_on_pdf_attachment",
@@ -729,9 +740,12 @@ class FoiRequest(models.Model):
             send_address=send_address)
         message.plaintext_redacted = message.redact_plaintext()
         filename = _('request_%(num)s.zip') % {'num': self.pk}
-        zip_bytes = package_foirequest(self)
-        attachments = [(filename, zip_bytes, 'application/zip')]
-        message.send(attachments=attachments)
+        zip_file = default_storage.open(get_foirequest_archive(self), 'rb')
+        try:
+            attachments = [(filename, zip_file, 'application/zip')]
+            message.send(attachments=attachments)
+        finally:
+            zip_file.close()
         self.escalated.send(sender=self)
 
     @classmethod
@@ -1014,6 +1028,44 @@ class FoiRequest(models.Model):
         self.save()
         self.became_asleep.send(sender=self)
 
+    def send_overdue_notification(self):
+        if not self.user.is_active:
+            return
+        if not self.user.email:
+            return
+        send_mail(u'{0} [#{1}]'.format(
+                    _("%(site_name)s: Request became overdue") % {
+                        "site_name": settings.SITE_NAME
+                    },
+                    self.pk),
+                render_to_string("foirequest/emails/became_overdue.txt", {
+                    "request": self,
+                    "go_url": self.user.get_autologin_url(self.get_absolute_short_url()),
+                    "site_name": settings.SITE_NAME
+                }),
+                settings.DEFAULT_FROM_EMAIL,
+                [self.user.email])
+
+    def send_asleep_notification(self):
+        if not self.user.is_active:
+            return
+        if not self.user.email:
+            return
+        send_mail(u'{0} [#{1}]'.format(
+                    _("%(site_name)s: Request became asleep") % {
+                        "site_name": settings.SITE_NAME
+                    },
+                    self.pk),
+                render_to_string("foirequest/emails/became_asleep.txt", {
+                    "request": self,
+                    "go_url": self.user.get_autologin_url(
+                        self.get_absolute_short_url()
+                    ),
+                    "site_name": settings.SITE_NAME
+                }),
+                settings.DEFAULT_FROM_EMAIL,
+                [self.user.email])
+
     def send_classification_reminder(self):
         if self.user is None:
             return
@@ -1103,6 +1155,13 @@ class PublicBodySuggestion(models.Model):
         verbose_name_plural = _('Public Body Suggestions')
 
 
+REDACTION_SPANS_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+# Saving any of these fields refreshes the stored redaction spans
+REDACTION_SPAN_FIELDS = set(['plaintext', 'plaintext_redacted', 'redaction_spans'])
+# Increase when the rendering of message contents changes
+MESSAGE_RENDER_VERSION = 1
+
+
 @python_2_unicode_compatible
 class FoiMessage(models.Model):
     request = models.ForeignKey(FoiRequest,
@@ -1146,6 +1205,13 @@ class FoiMessage(models.Model):
     subject_redacted = models.CharField(_("Redacted Subject"), blank=True, max_length=255)
     plaintext = models.TextField(_("plain text"), blank=True, null=True)
     plaintext_redacted = models.TextField(_("redacted plain text"), blank=True, null=True)
+    redaction_spans = models.TextField(_("redaction spans"), blank=True, null=True)
+    rendered_key = models.CharField(_("rendered content key"), blank=True,
+            default='', max_length=40)
+    rendered_owner = models.TextField(_("rendered content for the owner"),
+            blank=True, null=True)
+    rendered_public = models.TextField(_("rendered public content"),
+            blank=True, null=True)
     html = models.TextField(_("HTML"), blank=True, null=True)
     original = models.TextField(_("Original"), blank=True)
     redacted = models.BooleanField(_("Was Redacted?"), default=False)
@@ -1190,9 +1256,9 @@ class FoiMessage(models.Model):
         return "%s#%s" % (self.request.get_accessible_link(),
                 self.get_html_id())
 
-    def get_public_body_sender_form(self):
+    def get_public_body_sender_form(self, **kwargs):
         from froide.foirequest.forms import MessagePublicBodySenderForm
-        return MessagePublicBodySenderForm(self)
+        return MessagePublicBodySenderForm(self, **kwargs)
 
     def get_recipient(self):
         if self.recipient_public_body:
@@ -1277,8 +1343,8 @@ class FoiMessage(models.Model):
 
     def get_subject(self, user=None):
         if self.subject_redacted is None:
+            # Not saved here, the redact_messages command fills these in
             self.subject_redacted = self.redact_subject()
-            self.save()
         return self.subject_redacted
 
     def redact_subject(self):
@@ -1292,39 +1358,160 @@ class FoiMessage(models.Model):
 
     def get_content(self, user=None):
         if self.plaintext_redacted is None:
+            # Not saved here, the redact_messages command fills these in
             self.plaintext_redacted = self.redact_plaintext()
-            self.save()
         return self.plaintext_redacted
 
-    def redact_plaintext(self):
-        content = self.plaintext
-
-        content = replace_email_name(content, _("<<name and email address>>"))
-        content = replace_email(content, _("<<email address>>"))
-
-        greeting_replacement = str(_("<< Greeting >>"))
-
-        if not settings.FROIDE_CONFIG.get('public_body_officials_public'):
-            if self.is_response:
-                if settings.FROIDE_CONFIG.get('closings'):
-                    content = remove_closing(content,
-                                settings.FROIDE_CONFIG['closings'])
-
-            else:
-                if settings.FROIDE_CONFIG.get('greetings'):
-                    content = replace_greetings(content,
-                            settings.FROIDE_CONFIG['greetings'],
-                            greeting_replacement)
-
-        if self.request.user:
-            content = self.request.user.apply_message_redaction(content)
+    def get_plaintext_redactor(self):
+        user = self.request.user
+        officials_public = settings.FROIDE_CONFIG.get(
+            'public_body_officials_public')
+        closings = settings.FROIDE_CONFIG.get('closings')
+        greetings = settings.FROIDE_CONFIG.get('greetings')
+
+        def build():
+            redactor = Redactor()
+            redactor.replace_emails(_("<<name and email address>>"),
+                                    _("<<email address>>"))
+
+            greeting_replacement = str(_("<< Greeting >>"))
+
+            if not officials_public:
+                if self.is_response:
+                    if closings:
+                        redactor.add_step(lambda content: remove_closing(
+                            content, closings))
+                else:
+                    if greetings:
+                        redactor.add_step(lambda content: replace_greetings(
+                            content, greetings, greeting_replacement))
+
+            if user:
+                user.add_message_redaction(redactor)
+            return redactor
+
+        key = ('plaintext', get_language(), self.is_response,
+               bool(officials_public), tuple(closings or ()),
+               tuple(greetings or ()),
+               user.get_redaction_key() if user else None)
+        return get_redactor(key, build)
 
-        return content
+    def redact_plaintext(self):
+        return self.get_plaintext_redactor()(self.plaintext)
 
     def get_real_content(self):
         content = self.content
         return content
 
+    def get_redaction_contents(self):
+        real_content = self.get_real_content().replace("\r\n", "\n")
+        redacted_content = self.get_content().replace("\r\n", "\n")
+        return real_content, redacted_content
+
+    def get_redaction_spans_key(self, real_content, redacted_content):
+        checksum = hashlib.sha1(real_content.encode('utf-8'))
+        checksum.update(b'\0')
+        checksum.update(redacted_content.encode('utf-8'))
+        return checksum.hexdigest()
+
+    def compute_redaction_spans(self, real_content, redacted_content):
+        return [get_differences(real, redacted) for real, redacted in zip(
+            split_text_by_separator(real_content),
+            split_text_by_separator(redacted_content))]
+
+    def load_redaction_spans(self, key):
+        """
+        Returns the stored spans if they were recorded for
+        the contents with this key, otherwise None
+        """
+        if not self.redaction_spans:
+            return None
+        try:
+            data = json.loads(self.redaction_spans)
+        except ValueError:
+            return None
+        if data.get('key') != key:
+            return None
+        return data['parts']
+
+    def get_redaction_spans_json(self):
+        real_content, redacted_content = self.get_redaction_contents()
+        key = self.get_redaction_spans_key(real_content, redacted_content)
+        if self.load_redaction_spans(key) is not None:
+            return self.redaction_spans
+        return json.dumps({
+            'key': key,
+            'parts': self.compute_redaction_spans(real_content,
+                                                  redacted_content)
+        })
+
+    def get_redaction_parts(self):
+        """
+        Returns (real, redacted, spans) for the parts of the content before
+        and after the quote separator, spans are the (i1, i2, j1, j2)
+        ranges in which real[i1:i2] was redacted to redacted[j1:j2].
+        Spans are recorded on save, messages saved before that get them
+        computed once and kept in the cache.
+        """
+        real_content, redacted_content = self.get_redaction_contents()
+        key = self.get_redaction_spans_key(real_content, redacted_content)
+        spans = self.load_redaction_spans(key)
+        if spans is None:
+            cache_key = 'froide:foimessage:redaction_spans:%s' % key
+            spans = cache.get(cache_key)
+            if spans is None:
+                spans = self.compute_redaction_spans(real_content,
+                                                     redacted_content)
+                cache.set(cache_key, spans, REDACTION_SPANS_CACHE_TIMEOUT)
+        return list(zip(split_text_by_separator(real_content),
+                        split_text_by_separator(redacted_content),
+                        spans))
+
+    def is_first_message(self):
+        first_ids = FoiMessage.objects.filter(
+            request_id=self.request_id).order_by('timestamp').values_list(
+            'id', flat=True)[:1]
+        return list(first_ids) == [self.id]
+
+    def get_render_key(self, highlight=False):
+        """
+        Changes whenever the rendered content of the message would change,
+        the first message of a request is rendered with the request
+        description highlighted
+        """
+        checksum = hashlib.sha1(('%s:%s:%s' % (
+            MESSAGE_RENDER_VERSION, get_language(), highlight)).encode('utf-8'))
+        contents = [self.get_real_content() or '', self.get_content() or '']
+        if highlight:
+            contents.append(self.request.description)
+        for content in contents:
+            checksum.update(b'\0')
+            checksum.update(content.encode('utf-8'))
+        return checksum.hexdigest()
+
+    def get_rendered_content(self, show_real, highlight=False):
+        """
+        Returns the stored rendered content for the owner or the
+        public, None if it is missing or outdated
+        """
+        if not self.rendered_key:
+            return None
+        if self.rendered_key != self.get_render_key(highlight=highlight):
+            return None
+        if show_real:
+            return mark_safe(self.rendered_owner)
+        return mark_safe(self.rendered_public)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        # Saves of other fields do not write the spans, skip the diff
+        needs_spans = (update_fields is None or
+                       bool(REDACTION_SPAN_FIELDS & set(update_fields)))
+        if (needs_spans and self.plaintext is not None and
+                self.plaintext_redacted is not None):
+            self.redaction_spans = self.get_redaction_spans_json()
+        super(FoiMessage, self).save(*args, **kwargs)
+
     def clean(self):
         from django.core.exceptions import ValidationError
         if self.sender_user and self.sender_public_body:
@@ -1374,6 +1561,8 @@ class FoiAttachment(models.Model):
         null=True, blank=True, on_delete=models.SET_NULL,
         related_name='original_set')
     is_converted = models.BooleanField(_("Is converted"), default=False)
+    content_hash = models.CharField(_("Content hash"), blank=True,
+            max_length=40, db_index=True)
 
     CONVERTABLE_FILETYPES = (
         'application/msword',
@@ -1406,6 +1595,9 @@ class FoiAttachment(models.Model):
     )
 
     attachment_published = django.dispatch.Signal(providing_args=[])
+    # Sent once per request after approving attachments in bulk
+    attachments_published = django.dispatch.Signal(
+        providing_args=["foirequest", "attachment_ids", "message_ids"])
 
     class Meta:
         ordering = ('name',)
@@ -1441,21 +1633,54 @@ class FoiAttachment(models.Model):
 
     def get_absolute_url(self):
         if settings.USE_X_ACCEL_REDIRECT:
-            return '%s%s' % (settings.SITE_URL,
-                reverse('foirequest-auth_message_attachment',
-                    kwargs={
-                        'message_id': self.belongs_to_id,
-                        'attachment_name': self.name
-                    }
-                )
-            )
+            url_name = 'foirequest-auth_message_attachment'
+        elif self.file:
+            # Stored files are named by their content hash, this view
+            # serves them under the attachment name
+            url_name = 'foirequest-download_message_attachment'
         else:
-            if self.file:
-                return self.file.url
+            return None
+        return '%s%s' % (settings.SITE_URL,
+            reverse(url_name,
+                kwargs={
+                    'message_id': self.belongs_to_id,
+                    'attachment_name': self.name
+                }
+            )
+        )
 
     def get_absolute_domain_url(self):
         return self.get_absolute_url()
 
+    def save(self, *args, **kwargs):
+        super(FoiAttachment, self).save(*args, **kwargs)
+        stored = getattr(self, '_stored_content', None)
+        if stored is not None:
+            self._stored_content = None
+            # An existing unreferenced blob may have been swept before
+            # this attachment referred to it
+            if not default_storage.exists(self.file.name):
+                store_blob(*stored)
+
+    def set_file(self, name, content_hash, size):
+        self.file = name
+        self.content_hash = content_hash
+        self.size = size
+
+    def store_file(self, content, filename=None):
+        """
+        Stores the content in the shared blob store, attachments
+        with identical content share one stored file. The content
+        must stay readable until the attachment is saved.
+        """
+        if filename is None:
+            filename = self.name
+        self.set_file(*store_blob(content, filename))
+        self._stored_content = (content, filename)
+
+    def share_file(self, other):
+        self.set_file(other.file.name, other.content_hash, other.size)
+
     def approve_and_save(self):
         self.approved = True
         self.save()
@@ -1604,12 +1829,25 @@ class FoiEvent(models.Model):
         self._html_context = context
         return context
 
-    def as_text(self):
+    def render_text(self):
         return self.event_texts[self.event_name] % self.get_context()
 
-    def as_html(self):
+    def render_html(self):
         return mark_safe(self.event_texts[self.event_name] % self.get_html_context())
 
+    def as_text(self):
+        # Set by prefetch_event_texts from the cache
+        texts = getattr(self, '_texts', None)
+        if texts is not None:
+            return texts[0]
+        return self.render_text()
+
+    def as_html(self):
+        texts = getattr(self, '_texts', None)
+        if texts is not None:
+            return mark_safe(texts[1])
+        return self.render_html()
+
 
 @python_2_unicode_compatible
 class DeferredMessage(models.Model):
@@ -1645,6 +1883,186 @@ class DeferredMessage(models.Model):
         process_mail.delay(mail, manual=True)
 
 
+def get_base_domain(domain):
+    """ Strip subdomains """
+    return '.'.join(domain.lower().split('.')[-2:])
+
+
+class FoiRequestAddressManager(models.Manager):
+    def get_latest_for_domain(self, request, domain, is_response=True):
+        addresses = self.get_queryset().filter(request=request,
+            is_response=is_response, domain=domain,
+            public_body__isnull=False
+        ).select_related('public_body').order_by('-timestamp')[:1]
+        if addresses:
+            return addresses[0]
+        return None
+
+    def is_known_domain(self, request, base_domain):
+        known = self.get_queryset().filter(is_response=True,
+                                           base_domain=base_domain)
+        if known.filter(request=request).exists():
+            return True
+        if request.public_body_id is None:
+            return False
+        return known.filter(public_body_id=request.public_body_id).exists()
+
+    def get_message_address(self, message):
+        """
+        Returns (email, public_body_id) of the other side of the message
+        or None if it has no usable email address
+        """
+        if message.is_response:
+            email = message.sender_email
+            public_body_id = message.sender_public_body_id
+        else:
+            email = message.recipient_email
+            public_body_id = message.recipient_public_body_id
+        if not email or '@' not in email:
+            return None
+        return email.strip().lower()[:255], public_body_id
+
+    def add_message(self, message):
+        address = self.get_message_address(message)
+        if address is None:
+            return None
+        email, public_body_id = address
+        domain = email.split('@')[1]
+        address, created = self.get_or_create(
+            request_id=message.request_id,
+            email=email,
+            is_response=message.is_response,
+            defaults={
+                'domain': domain,
+                'base_domain': get_base_domain(domain),
+                'public_body_id': public_body_id,
+                'timestamp': message.timestamp
+            }
+        )
+        if created or public_body_id is None:
+            return address
+        if (address.public_body_id is None or
+                address.timestamp <= message.timestamp):
+            if (address.public_body_id != public_body_id or
+                    address.timestamp != message.timestamp):
+                address.public_body_id = public_body_id
+                address.timestamp = message.timestamp
+                address.save()
+        return address
+
+    def remove_message(self, message):
+        """
+        Updates only the address of a deleted message from the remaining
+        messages with that address, like add_message would have set it
+        """
+        address = self.get_message_address(message)
+        if address is None:
+            return
+        email = address[0]
+        if message.is_response:
+            field, public_body_field = 'sender_email', 'sender_public_body'
+        else:
+            field, public_body_field = ('recipient_email',
+                                        'recipient_public_body')
+        messages = FoiMessage.objects.filter(request_id=message.request_id,
+            is_response=message.is_response, **{
+                '%s__iexact' % field: email})
+        # The latest message with a public body sets it, without any the
+        # address keeps the timestamp of the first message
+        latest = messages.filter(**{
+            '%s__isnull' % public_body_field: False
+        }).order_by('-timestamp').values_list(public_body_field,
+                                              'timestamp').first()
+        if latest is None:
+            latest = messages.order_by('timestamp').values_list(
+                public_body_field, 'timestamp').first()
+        addresses = self.get_queryset().filter(request_id=message.request_id,
+            email=email, is_response=message.is_response)
+        if latest is None:
+            addresses.delete()
+        else:
+            addresses.update(public_body=latest[0], timestamp=latest[1])
+
+
+@python_2_unicode_compatible
+class FoiRequestAddress(models.Model):
+    """
+    Addresses that took part in a request with the public body they
+    were last seen with. Kept up to date when messages are saved so
+    looking up senders does not need to scan all messages.
+    """
+    request = models.ForeignKey(FoiRequest,
+            verbose_name=_("Freedom of Information Request"))
+    email = models.CharField(_("Email"), max_length=255)
+    domain = models.CharField(_("Domain"), max_length=255)
+    base_domain = models.CharField(_("Base domain"), max_length=255)
+    is_response = models.BooleanField(_("Is sender of a response?"),
+            default=True)
+    public_body = models.ForeignKey(PublicBody, null=True, blank=True,
+            on_delete=models.SET_NULL, verbose_name=_("Public Body"))
+    timestamp = models.DateTimeField(_("Timestamp"))
+
+    objects = FoiRequestAddressManager()
+
+    class Meta:
+        unique_together = (('request', 'email', 'is_response'),)
+        index_together = (
+            ('request', 'is_response', 'domain'),
+            ('request', 'is_response', 'base_domain'),
+            ('public_body', 'is_response', 'base_domain'),
+        )
+        verbose_name = _('Request Address')
+        verbose_name_plural = _('Request Addresses')
+
+    def __str__(self):
+        return u"%s (%s)" % (self.email, self.request_id)
+
+
+@python_2_unicode_compatible
+class DailyStats(models.Model):
+    """
+    Number of new users and requests per day for the staff dashboard.
+    Days without any new users or requests have no row.
+    """
+    date = models.DateField(_("Date"), unique=True)
+    users = models.IntegerField(_("New users"), default=0)
+    requests = models.IntegerField(_("New requests"), default=0)
+    requests_public = models.IntegerField(_("New public requests"),
+            default=0)
+    requests_not_same_as = models.IntegerField(
+            _("New requests that are not identical to others"), default=0)
+    requests_public_not_same_as = models.IntegerField(
+            _("New public requests that are not identical to others"),
+            default=0)
+
+    class Meta:
+        ordering = ('date',)
+        verbose_name = _('Daily statistics')
+        verbose_name_plural = _('Daily statistics')
+
+    def __str__(self):
+        return self.date.isoformat()
+
+
+@python_2_unicode_compatible
+class MailFetchCheckpoint(models.Model):
+    """
+    UID of the last processed mail of a fetched IMAP account, only
+    valid for the mailbox with the same UIDVALIDITY
+    """
+    account = models.CharField(_("Account"), max_length=255, unique=True)
+    uidvalidity = models.BigIntegerField(_("UIDVALIDITY"), null=True)
+    uid = models.BigIntegerField(_("UID"))
+    timestamp = models.DateTimeField(_("Timestamp"), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Mail fetch checkpoint')
+        verbose_name_plural = _('Mail fetch checkpoints')
+
+    def __str__(self):
+        return u"%s %s:%s" % (self.account, self.uidvalidity, self.uid)
+
+
 # Import Signals here so models are available
 import froide.foirequest.signals  # noqa
 froide.foirequest.signals
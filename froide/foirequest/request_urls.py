@@ -7,6 +7,7 @@ urlpatterns = patterns("froide.foirequest.views",
     url(r"^(?P<obj_id>\d+)$", 'shortlink', name="foirequest-notsolonglink"),
     url(r"^(?P<obj_id>\d+)/auth/(?P<code>[0-9a-f]+)/$", 'auth', name="foirequest-longerauth"),
     url(r"^(?P<slug>[-\w]+)/$", 'show', name="foirequest-show"),
+    url(r"^attachment/(?P<message_id>\d+)/(?P<attachment_name>.+)$", 'download_message_attachment', name="foirequest-download_message_attachment"),
     url(r"^(?P<slug>[-\w]+)/suggest/public-body/$", 'suggest_public_body', name="foirequest-suggest_public_body"),
     url(r"^(?P<slug>[-\w]+)/set/public-body/$", 'set_public_body', name="foirequest-set_public_body"),
     url(r"^(?P<slug>[-\w]+)/set/status/$", 'set_status', name="foirequest-set_status"),
@@ -29,6 +30,7 @@ urlpatterns = patterns("froide.foirequest.views",
     url(r"^(?P<slug>[-\w]+)/download/$", 'download_foirequest', name="foirequest-download"),
     # Redaction
     url(r"^(?P<slug>[-\w]+)/redact/(?P<attachment_id>\d+)/$", 'redact_attachment', name="foirequest-redact_attachment"),
+    url(r"^(?P<slug>[-\w]+)/redact/(?P<attachment_id>\d+)/status/(?P<task_id>[-\w]+)/$", 'redact_attachment_status', name="foirequest-redact_attachment_status"),
 )
 
 # Feed
@@ -1,13 +1,24 @@
 from django.db.models import signals
 from django.dispatch import receiver
-from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.auth import get_user_model
+
 from haystack.utils import get_identifier
+from django_comments.models import Comment
+
+from froide.helper.cache import bump_cache_version
+from froide.helper.email_sending import send_mail
+from froide.publicbody.models import PublicBody
 
-from .models import FoiRequest, FoiMessage, FoiAttachment, FoiEvent
+from .models import (FoiRequest, FoiMessage, FoiAttachment, FoiEvent,
+        FoiRequestAddress)
+from .foi_mail import delete_foirequest_archives
+from .utils import (invalidate_request_cache, get_user_cache_version_key,
+        get_publicbody_cache_version_key)
 
 
 def trigger_index_update(klass, instance_pk):
@@ -22,45 +33,13 @@ def trigger_index_update(klass, instance_pk):
 @receiver(FoiRequest.became_overdue,
         dispatch_uid="send_notification_became_overdue")
 def send_notification_became_overdue(sender, **kwargs):
-    if not sender.user.is_active:
-        return
-    if not sender.user.email:
-        return
-    send_mail(u'{0} [#{1}]'.format(
-                _("%(site_name)s: Request became overdue") % {
-                    "site_name": settings.SITE_NAME
-                },
-                sender.pk),
-            render_to_string("foirequest/emails/became_overdue.txt", {
-                "request": sender,
-                "go_url": sender.user.get_autologin_url(sender.get_absolute_short_url()),
-                "site_name": settings.SITE_NAME
-            }),
-            settings.DEFAULT_FROM_EMAIL,
-            [sender.user.email])
+    sender.send_overdue_notification()
 
 
 @receiver(FoiRequest.became_asleep,
         dispatch_uid="send_notification_became_asleep")
 def send_notification_became_asleep(sender, **kwargs):
-    if not sender.user.is_active:
-        return
-    if not sender.user.email:
-        return
-    send_mail(u'{0} [#{1}]'.format(
-                _("%(site_name)s: Request became asleep") % {
-                    "site_name": settings.SITE_NAME
-                },
-                sender.pk),
-            render_to_string("foirequest/emails/became_asleep.txt", {
-                "request": sender,
-                "go_url": sender.user.get_autologin_url(
-                    sender.get_absolute_short_url()
-                ),
-                "site_name": settings.SITE_NAME
-            }),
-            settings.DEFAULT_FROM_EMAIL,
-            [sender.user.email])
+    sender.send_asleep_notification()
 
 
 @receiver(FoiRequest.message_received,
@@ -165,7 +144,7 @@ def increment_request_count(sender, **kwargs):
     if not sender.public_body:
         return
     sender.public_body.number_of_requests += 1
-    sender.public_body.save()
+    sender.public_body.save(update_fields=['number_of_requests'])
 
 
 @receiver(signals.pre_delete, sender=FoiRequest,
@@ -176,7 +155,139 @@ def decrement_request_count(sender, instance=None, **kwargs):
     instance.public_body.number_of_requests -= 1
     if instance.public_body.number_of_requests < 0:
         instance.public_body.number_of_requests = 0
-    instance.public_body.save()
+    instance.public_body.save(update_fields=['number_of_requests'])
+
+
+@receiver(signals.post_delete, sender=FoiRequest,
+        dispatch_uid="foirequest_delete_archives")
+def foirequest_delete_archives(sender, instance=None, **kwargs):
+    delete_foirequest_archives(instance)
+
+
+# Keeping known addresses of a request up to date
+
+@receiver(signals.post_save, sender=FoiMessage,
+        dispatch_uid='foimessage_update_request_address')
+def foimessage_update_request_address(instance=None, created=False, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    FoiRequestAddress.objects.add_message(instance)
+
+
+@receiver(signals.post_delete, sender=FoiMessage,
+        dispatch_uid='foimessage_remove_request_address')
+def foimessage_remove_request_address(instance, **kwargs):
+    FoiRequestAddress.objects.remove_message(instance)
+
+
+# Invalidating cached request pages
+
+@receiver([FoiRequest.message_received, FoiRequest.message_sent,
+           FoiRequest.status_changed, FoiRequest.made_public,
+           FoiRequest.became_overdue, FoiRequest.became_asleep,
+           FoiRequest.set_concrete_law, FoiRequest.escalated,
+           FoiRequest.add_postal_reply],
+        dispatch_uid='foirequest_invalidate_cache')
+def foirequest_invalidate_cache(sender, **kwargs):
+    invalidate_request_cache(sender.id)
+
+
+@receiver(signals.post_save, sender=FoiRequest,
+        dispatch_uid='foirequest_saved_invalidate_cache')
+def foirequest_saved_invalidate_cache(instance=None, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    invalidate_request_cache(instance.id)
+
+
+@receiver(signals.post_save, sender=FoiMessage,
+        dispatch_uid='foimessage_saved_invalidate_cache')
+@receiver(signals.post_delete, sender=FoiMessage,
+        dispatch_uid='foimessage_deleted_invalidate_cache')
+def foimessage_invalidate_cache(instance=None, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    invalidate_request_cache(instance.request_id, [instance.id])
+
+
+@receiver(FoiAttachment.attachment_published,
+        dispatch_uid='foiattachment_published_invalidate_cache')
+def foiattachment_published_invalidate_cache(sender, **kwargs):
+    foiattachment_invalidate_cache(instance=sender)
+
+
+@receiver(FoiAttachment.attachments_published,
+        dispatch_uid='foiattachments_published_invalidate_cache')
+def foiattachments_published_invalidate_cache(sender, foirequest=None,
+                                              message_ids=(), **kwargs):
+    invalidate_request_cache(foirequest.id, message_ids)
+
+
+@receiver(signals.post_save, sender=FoiAttachment,
+        dispatch_uid='foiattachment_saved_invalidate_cache')
+@receiver(signals.post_delete, sender=FoiAttachment,
+        dispatch_uid='foiattachment_deleted_invalidate_cache')
+def foiattachment_invalidate_cache(instance=None, **kwargs):
+    if kwargs.get('raw', False) or instance.belongs_to_id is None:
+        return
+    try:
+        request_id = instance.belongs_to.request_id
+    except FoiMessage.DoesNotExist:
+        return
+    invalidate_request_cache(request_id, [instance.belongs_to_id])
+
+
+@receiver(signals.post_save, sender=FoiEvent,
+        dispatch_uid='foievent_invalidate_cache')
+def foievent_invalidate_cache(instance=None, created=False, **kwargs):
+    if not created or kwargs.get('raw', False):
+        return
+    invalidate_request_cache(instance.request_id)
+
+
+@receiver(signals.post_save, sender=Comment,
+        dispatch_uid='comment_saved_invalidate_cache')
+@receiver(signals.post_delete, sender=Comment,
+        dispatch_uid='comment_deleted_invalidate_cache')
+def comment_invalidate_cache(instance=None, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    if instance.content_type != ContentType.objects.get_for_model(FoiMessage):
+        return
+    request_ids = FoiMessage.objects.filter(
+        id=instance.object_pk).values_list('request_id', flat=True)
+    for request_id in request_ids:
+        invalidate_request_cache(request_id, [int(instance.object_pk)])
+
+
+@receiver(signals.post_save, sender=get_user_model(),
+        dispatch_uid='user_invalidate_event_texts')
+def user_invalidate_event_texts(instance=None, update_fields=None, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    # Logging in only updates last_login
+    if update_fields and set(update_fields) <= set(['last_login']):
+        return
+    bump_cache_version(get_user_cache_version_key(instance.id))
+
+
+@receiver(signals.post_save, sender=PublicBody,
+        dispatch_uid='publicbody_invalidate_event_texts')
+def publicbody_invalidate_event_texts(instance=None, update_fields=None,
+        **kwargs):
+    if kwargs.get('raw', False):
+        return
+    # Request counts are not shown in event texts or messages
+    if update_fields and set(update_fields) <= set(['number_of_requests']):
+        return
+    bump_cache_version(get_publicbody_cache_version_key(instance.id))
+
+
+@receiver(PublicBody.bulk_changed,
+        dispatch_uid='publicbody_bulk_invalidate_event_texts')
+def publicbody_bulk_invalidate_event_texts(public_body_ids=None, **kwargs):
+    for public_body_id in public_body_ids:
+        bump_cache_version(get_publicbody_cache_version_key(public_body_id))
 
 
 # Indexing
@@ -239,6 +350,16 @@ def create_event_followers_attachments_approved(sender, **kwargs):
             public_body=sender.belongs_to.request.public_body)
 
 
+@receiver(FoiAttachment.attachments_published,
+    dispatch_uid="create_event_followers_attachments_bulk_approved")
+def create_event_followers_attachments_bulk_approved(sender, foirequest=None,
+                                                     **kwargs):
+    FoiEvent.objects.create_event("attachment_published",
+            foirequest,
+            user=foirequest.user,
+            public_body=foirequest.public_body)
+
+
 @receiver(FoiRequest.status_changed,
         dispatch_uid="create_event_status_changed")
 def create_event_status_changed(sender, **kwargs):
@@ -303,15 +424,26 @@ def create_event_escalated(sender, **kwargs):
             user=sender.user, public_body=sender.law.mediator)
 
 
+@receiver(signals.post_save, sender=FoiMessage,
+        dispatch_uid="foimessage_render_content")
+def foimessage_render_content(instance=None, **kwargs):
+    if kwargs.get('raw', False):
+        return
+
+    from .tasks import render_message_task
+
+    render_message_task.delay(instance.id)
+
+
 @receiver(signals.post_save, sender=FoiAttachment,
         dispatch_uid="foiattachment_convert_attachment")
 def foiattachment_convert_attachment(instance=None, created=False, **kwargs):
     if kwargs.get('raw', False):
         return
 
-    from .tasks import convert_attachment_task
+    from .tasks import queue_attachment_conversion
 
     if (instance.filetype in FoiAttachment.CONVERTABLE_FILETYPES or
             instance.name.endswith(FoiAttachment.CONVERTABLE_FILETYPES)):
         if instance.converted_id is None:
-            convert_attachment_task.delay(instance.id)
+            queue_attachment_conversion(instance.id)
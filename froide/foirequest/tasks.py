@@ -1,15 +1,47 @@
 import os
+import logging
+import re
+import shutil
+import time
 
 from django.conf import settings
 from django.utils import translation
+from django.utils.translation import ugettext as _
 from django.db import transaction
 from django.core.files import File
+from django.core.cache import cache
 
 from froide.celery import app as celery_app
+from froide.helper.email_sending import mail_queue
+from froide.helper.document_conversion import PRIORITY_NORMAL, PRIORITY_LOW
+from froide.redaction.utils import (convert_to_pdf as convert_images_to_pdf,
+        make_redaction_dir, remove_redaction_dir, fetch_pages,
+        remove_redaction_job, remove_stale_redaction_jobs)
 
-from .models import FoiRequest, FoiAttachment
-from .foi_mail import _process_mail, _fetch_mail
+from .models import FoiRequest, FoiMessage, FoiAttachment
+from .foi_mail import _process_mail, fetch_and_process
 from .file_utils import convert_to_pdf
+from .signals import trigger_index_update
+from .utils import (redact_messages, update_daily_stats,
+        create_request_events, invalidate_request_cache, approve_attachments,
+        get_convertable_attachments, set_attachment_job,
+        remove_unreferenced_blobs,
+        ATTACHMENT_CHUNK_SIZE, ATTACHMENT_JOB_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+FETCH_MAIL_LOCK = 'froide:fetch_mail_lock'
+FETCH_MAIL_LOCK_TIMEOUT = 60 * 60
+REDACT_MESSAGES_LOCK = 'froide:redact_messages_lock:%s'
+REDACT_MESSAGES_LOCK_TIMEOUT = 6 * 60 * 60
+SWEEP_CHUNK_SIZE = 500
+CONVERSION_QUEUED_KEY = 'froide:foiattachment:%s:conversion_queued'
+
+REQUEST_NOTIFICATIONS = {
+    'became_overdue': 'send_overdue_notification',
+    'became_asleep': 'send_asleep_notification',
+    'classification_reminder': 'send_classification_reminder',
+}
 
 
 @celery_app.task(acks_late=True, time_limit=60)
@@ -22,29 +54,108 @@ def process_mail(*args, **kwargs):
 
 @celery_app.task(expires=60)
 def fetch_mail():
-    for rfc_data in _fetch_mail():
-        process_mail.delay(rfc_data)
+    translation.activate(settings.LANGUAGE_CODE)
+
+    # Don't let overlapping runs fetch the same unseen mails
+    if not cache.add(FETCH_MAIL_LOCK, True, FETCH_MAIL_LOCK_TIMEOUT):
+        return
+    try:
+        return fetch_and_process()
+    finally:
+        cache.delete(FETCH_MAIL_LOCK)
+
+
+@celery_app.task(ignore_result=True)
+def redact_messages_task(user_id=None, only_missing=False):
+    translation.activate(settings.LANGUAGE_CODE)
+
+    # Runs with the same scope would share the same checkpoint
+    lock = REDACT_MESSAGES_LOCK % ('all' if user_id is None else user_id)
+    if not cache.add(lock, True, REDACT_MESSAGES_LOCK_TIMEOUT):
+        return
+    try:
+        return redact_messages(user_id=user_id, only_missing=only_missing)
+    finally:
+        cache.delete(lock)
+
+
+@celery_app.task(ignore_result=True)
+def update_daily_stats_task():
+    update_daily_stats()
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def finish_sweep(name, count, start):
+    duration = time.time() - start
+    rate = count / duration if duration else 0.0
+    logger.info('%s: %d requests in %.2fs (%.1f/s)', name, count,
+                duration, rate)
+    return {'count': count, 'duration': duration, 'rate': rate}
 
 
 @celery_app.task
 def detect_overdue():
     translation.activate(settings.LANGUAGE_CODE)
-    for foirequest in FoiRequest.objects.get_to_be_overdue():
-        foirequest.set_overdue()
+    start = time.time()
+    foi_requests = list(FoiRequest.objects.get_to_be_overdue().values_list(
+        'id', 'visibility'))
+    for chunk in chunks(foi_requests, SWEEP_CHUNK_SIZE):
+        request_ids = [request_id for request_id, _ in chunk]
+        create_request_events('became_overdue', chunk)
+        for request_id in request_ids:
+            invalidate_request_cache(request_id)
+        send_request_notifications.delay('became_overdue', request_ids)
+    return finish_sweep('detect_overdue', len(foi_requests), start)
 
 
 @celery_app.task
 def detect_asleep():
     translation.activate(settings.LANGUAGE_CODE)
-    for foirequest in FoiRequest.objects.get_to_be_asleep():
-        foirequest.set_asleep()
+    start = time.time()
+    request_ids = list(FoiRequest.objects.get_to_be_asleep().values_list(
+        'id', flat=True))
+    count = 0
+    for chunk in chunks(request_ids, SWEEP_CHUNK_SIZE):
+        # Only requests that still await a response at update time
+        # count and get notified
+        with transaction.atomic():
+            chunk = list(FoiRequest.objects.filter(id__in=chunk,
+                status='awaiting_response').select_for_update(
+                ).values_list('id', flat=True))
+            FoiRequest.objects.filter(id__in=chunk).update(status='asleep')
+        count += len(chunk)
+        for request_id in chunk:
+            invalidate_request_cache(request_id)
+            trigger_index_update(FoiRequest, request_id)
+        if chunk:
+            send_request_notifications.delay('became_asleep', chunk)
+    return finish_sweep('detect_asleep', count, start)
 
 
 @celery_app.task
 def classification_reminder():
     translation.activate(settings.LANGUAGE_CODE)
-    for foirequest in FoiRequest.objects.get_unclassified():
-        foirequest.send_classification_reminder()
+    start = time.time()
+    request_ids = list(FoiRequest.objects.get_unclassified().values_list(
+        'id', flat=True))
+    for chunk in chunks(request_ids, SWEEP_CHUNK_SIZE):
+        send_request_notifications.delay('classification_reminder', chunk)
+    return finish_sweep('classification_reminder', len(request_ids), start)
+
+
+@celery_app.task(ignore_result=True)
+def send_request_notifications(notification, request_ids):
+    translation.activate(settings.LANGUAGE_CODE)
+    method = REQUEST_NOTIFICATIONS[notification]
+    foi_requests = FoiRequest.objects.filter(
+        id__in=request_ids).select_related('user')
+    with mail_queue():
+        for foirequest in foi_requests:
+            getattr(foirequest, method)()
 
 
 @celery_app.task
@@ -57,16 +168,166 @@ def count_same_foirequests(instance_id):
         pass
 
 
-@celery_app.task(time_limit=60)
-def convert_attachment_task(instance_id):
+@celery_app.task(ignore_result=True)
+def render_message_task(message_id):
+    from .templatetags.foirequest_tags import store_rendered_message
+
+    # Stored renditions are for the language of the site, override
+    # keeps the language of a request that runs this eagerly
+    with translation.override(settings.LANGUAGE_CODE):
+        try:
+            message = FoiMessage.objects.select_related(
+                'request', 'request__user').get(id=message_id)
+        except FoiMessage.DoesNotExist:
+            return
+        store_rendered_message(message)
+
+
+@celery_app.task(time_limit=60 * 60)
+def redact_attachment_task(instance_id, job_id):
+    """
+    Builds the redacted version of the attachment from the pages stored
+    for the redaction job and returns its anchor URL or None
+    """
+    translation.activate(settings.LANGUAGE_CODE)
+    path = make_redaction_dir()
     try:
-        att = FoiAttachment.objects.get(pk=instance_id)
-    except FoiAttachment.DoesNotExist:
-        return
-    return convert_attachment(att)
+        if not fetch_pages(job_id, path):
+            return None
+        try:
+            att = FoiAttachment.objects.get(pk=instance_id)
+        except FoiAttachment.DoesNotExist:
+            return None
+        redacted = redact_attachment(att, path)
+    finally:
+        remove_redaction_dir(path)
+        remove_redaction_job(job_id)
+    if redacted is None:
+        return None
+    return redacted.get_anchor_url()
+
+
+@celery_app.task
+def remove_stale_redactions():
+    return remove_stale_redaction_jobs()
 
 
-def convert_attachment(att):
+@celery_app.task
+def remove_unused_blobs():
+    return remove_unreferenced_blobs()
+
+
+def redact_attachment(att, path):
+    pdf_path = convert_images_to_pdf(path)
+    if pdf_path is None:
+        return None
+    if att.redacted:
+        redacted = att.redacted
+    elif att.is_redacted:
+        redacted = att
+    else:
+        name = att.name.rsplit('.', 1)[0]
+        name = re.sub('[^\w\.\-]', '', name)
+        redacted = FoiAttachment(
+            belongs_to=att.belongs_to,
+            name=_('%s_redacted.pdf') % name,
+            is_redacted=True,
+            filetype='application/pdf',
+            approved=True,
+            can_approve=True
+        )
+    with open(pdf_path, 'rb') as f:
+        redacted.store_file(File(f))
+        redacted.approve_and_save()
+    if not att.is_redacted:
+        att.redacted = redacted
+        att.can_approve = False
+        att.approved = False
+        att.save()
+    return redacted
+
+
+@celery_app.task(time_limit=settings.DOC_CONVERSION_TIMEOUT + 60)
+def convert_attachment_task(instance_id, priority=PRIORITY_NORMAL):
+    try:
+        try:
+            att = FoiAttachment.objects.get(pk=instance_id)
+        except FoiAttachment.DoesNotExist:
+            return
+        return convert_attachment(att, priority=priority)
+    finally:
+        cache.delete(CONVERSION_QUEUED_KEY % instance_id)
+
+
+def queue_attachment_conversion(attachment_id, priority=PRIORITY_NORMAL):
+    """
+    Queues the conversion of the attachment unless one is
+    already queued, returns if it was queued
+    """
+    if not cache.add(CONVERSION_QUEUED_KEY % attachment_id, True,
+                     ATTACHMENT_JOB_TIMEOUT):
+        return False
+    options = {}
+    if priority >= PRIORITY_LOW and settings.DOC_CONVERSION_LOW_PRIORITY_QUEUE:
+        # Bulk conversions must not hold up conversions of new mail
+        options['queue'] = settings.DOC_CONVERSION_LOW_PRIORITY_QUEUE
+    convert_attachment_task.apply_async((attachment_id,),
+                                        {'priority': priority}, **options)
+    return True
+
+
+def queue_attachment_conversions(attachment_ids, priority=PRIORITY_LOW,
+                                 chunk_size=ATTACHMENT_CHUNK_SIZE,
+                                 callback=None):
+    """
+    Queues conversions of the attachments that can be converted, skips
+    converted ones and ones already queued. Returns the number of
+    queued conversions.
+    """
+    attachment_ids = sorted(set(attachment_ids))
+    queued = 0
+    for i in range(0, len(attachment_ids), chunk_size):
+        chunk = attachment_ids[i:i + chunk_size]
+        convertable = get_convertable_attachments(
+            FoiAttachment.objects.filter(id__in=chunk)).values_list(
+            'id', flat=True)
+        for attachment_id in convertable:
+            if queue_attachment_conversion(attachment_id, priority=priority):
+                queued += 1
+        if callback is not None:
+            callback(i + len(chunk), len(attachment_ids))
+    return queued
+
+
+@celery_app.task(ignore_result=True)
+def approve_attachments_task(job_id, attachment_ids):
+    def progress(done, total):
+        set_attachment_job(job_id, 'approve', done, total)
+
+    approved = approve_attachments(attachment_ids, callback=progress)
+    total = len(set(attachment_ids))
+    set_attachment_job(job_id, 'approve', total, total, result=approved)
+
+
+@celery_app.task(ignore_result=True)
+def convert_attachments_task(job_id, attachment_ids, priority=PRIORITY_LOW):
+    def progress(done, total):
+        set_attachment_job(job_id, 'convert', done, total)
+
+    queued = queue_attachment_conversions(attachment_ids, priority=priority,
+                                          callback=progress)
+    total = len(set(attachment_ids))
+    set_attachment_job(job_id, 'convert', total, total, result=queued)
+
+
+def convert_attachment(att, priority=PRIORITY_NORMAL):
+    identical = get_identical_converted_attachment(att)
+    if identical is not None:
+        # Identical documents give identical PDFs
+        name = att.name.rsplit('.', 1)[0]
+        return save_converted_attachment(att, '%s.pdf' % name,
+                                         same_as=identical.converted)
+
     result_file = convert_to_pdf(
         att.file.path,
         binary_name=settings.FROIDE_CONFIG.get(
@@ -74,14 +335,36 @@ def convert_attachment(att):
         ),
         construct_call=settings.FROIDE_CONFIG.get(
             'doc_conversion_call_func'
-        )
+        ),
+        priority=priority
     )
     if result_file is None:
         return
 
     path, filename = os.path.split(result_file)
-    new_file = File(open(result_file, 'rb'))
+    try:
+        with open(result_file, 'rb') as f:
+            save_converted_attachment(att, filename, File(f))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
 
+def get_identical_converted_attachment(att):
+    if not att.content_hash:
+        return None
+    identical = FoiAttachment.objects.filter(
+        content_hash=att.content_hash,
+        converted__isnull=False,
+        converted__content_hash__gt=''
+    ).exclude(id=att.id).select_related('converted')
+    return identical.first()
+
+
+def save_converted_attachment(att, filename, new_file=None, same_as=None):
+    """
+    Stores new_file as converted version of att or,
+    if given, shares the file of the attachment same_as
+    """
     if att.converted:
         new_att = att.converted
     else:
@@ -99,9 +382,10 @@ def convert_attachment(att):
         )
 
     new_att.name = filename
-    new_att.file = new_file
-    new_att.size = new_file.size
-    new_att.file.save(filename, new_file)
+    if same_as is not None:
+        new_att.share_file(same_as)
+    else:
+        new_att.store_file(new_file, filename)
     new_att.save()
     att.converted = new_att
     att.save()
@@ -1,29 +1,33 @@
 # -*- encoding: utf-8 -*-
-from difflib import SequenceMatcher
 import re
 
 from django import template
+from django.core.cache import cache
 from django.utils.safestring import mark_safe
 from django.utils.html import escape
 from django.template.defaultfilters import urlizetrunc
 from django.utils.translation import ugettext_lazy as _
 
-from froide.helper.text_utils import unescape, split_text_by_separator
+from froide.helper.text_utils import unescape, get_differences
 
-from froide.foirequest.models import FoiRequest
+from froide.foirequest.models import FoiRequest, FoiMessage
 from froide.foirequest.foi_mail import get_alternative_mail
 
 register = template.Library()
 
 
-def highlight_request(message):
+MESSAGE_RENDER_QUEUED_KEY = 'froide:foimessage:%s:render_queued'
+MESSAGE_RENDER_QUEUED_TIMEOUT = 5 * 60
+
+
+def render_highlight_request(message):
     content = unescape(message.get_content().replace("\r\n", "\n"))
     description = message.request.description
     description = description.replace("\r\n", "\n")
     try:
         index = content.index(description)
     except ValueError:
-        return content
+        return escape(content)
     offset = index + len(description)
     return mark_safe('<div class="foldin">%s</div><div class="highlight">%s</div><div class="foldin-bottom print-show" style="display:none" id="letter_end">%s</div>' % (
             escape(content[:index]),
@@ -38,7 +42,22 @@ def remove_space_lines(content):
     return ONLY_SPACE_LINE.sub('', content)
 
 
-def mark_differences(content_a, content_b,
+def get_span_parts(length, spans):
+    """
+    Yields (redact, start, end) for the parts of a content of
+    the given length, spans are the sorted redacted ranges
+    """
+    position = 0
+    for start, end in spans:
+        if start > position:
+            yield False, position, start
+        yield True, start, end
+        position = end
+    if position < length:
+        yield False, position, length
+
+
+def render_differences(content, spans,
         start_tag=u'<span{attrs}> ',
         end_tag=' </span>',
         attrs=None,
@@ -49,15 +68,13 @@ def mark_differences(content_a, content_b,
     opened = False
     redact = False
     new_content = []
-    matcher = SequenceMatcher(None, content_a, content_b)
     last_start_tag = None
 
     full_tag_check = lambda content, last_start_tag: \
         [x for x in content[(last_start_tag + 1):] if x.strip()]
 
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+    for redact, i1, i2 in get_span_parts(len(content), spans):
         long_enough = i2 - i1 > min_part_len
-        redact = tag != 'equal'
         if not redact and opened and long_enough:
             if full_tag_check(new_content, last_start_tag):
                 new_content.append(end_tag)
@@ -68,7 +85,7 @@ def mark_differences(content_a, content_b,
             opened = True
             last_start_tag = len(new_content)
             new_content.append(start_tag)
-        new_content.append(escape(remove_space_lines(content_a[i1:i2])))
+        new_content.append(escape(remove_space_lines(content[i1:i2])))
     if opened:
         if full_tag_check(new_content, last_start_tag):
             new_content.append(end_tag)
@@ -78,30 +95,27 @@ def mark_differences(content_a, content_b,
     return mark_safe(''.join(new_content))
 
 
-def redact_message(message, user):
-    real_content = message.get_real_content().replace("\r\n", "\n")
-    redacted_content = message.get_content().replace("\r\n", "\n")
-
-    c_1, c_2 = split_text_by_separator(real_content)
-    r_1, r_2 = split_text_by_separator(redacted_content)
-
-    if message.request.user == user or user.is_staff:
-        content_1 = mark_differences(c_1, r_1,
-            attrs=u' class="redacted redacted-hover"'
-            ' data-toggle="tooltip" title="{title}"'.format(
-                title=_('Only visible to you')
-            ))
-        content_2 = mark_differences(c_2, r_2,
-            attrs=u' class="redacted redacted-hover"'
-            ' data-toggle="tooltip" title="{title}"'.format(
-                title=_('Only visible to you')
-            ))
-    else:
-        content_1 = mark_differences(r_1, c_1)
-        content_2 = mark_differences(r_2, c_2)
+def mark_differences(content_a, content_b, **kwargs):
+    spans = [(i1, i2) for i1, i2, j1, j2 in
+             get_differences(content_a, content_b)]
+    return render_differences(content_a, spans, **kwargs)
 
-    content_1 = urlizetrunc(content_1, 40, autoescape=False)
-    content_2 = urlizetrunc(content_2, 40, autoescape=False)
+
+def render_redacted_message(message, show_real):
+    contents = []
+    for real, redacted, spans in message.get_redaction_parts():
+        if show_real:
+            content = render_differences(real,
+                [(i1, i2) for i1, i2, j1, j2 in spans],
+                attrs=u' class="redacted redacted-hover"'
+                ' data-toggle="tooltip" title="{title}"'.format(
+                    title=_('Only visible to you')
+                ))
+        else:
+            content = render_differences(redacted,
+                [(j1, j2) for i1, i2, j1, j2 in spans])
+        contents.append(urlizetrunc(content, 40, autoescape=False))
+    content_1, content_2 = contents
 
     if content_2:
         return u''.join([
@@ -114,6 +128,52 @@ def redact_message(message, user):
     return content_1
 
 
+def render_message_content(message, show_real, highlight=False):
+    if highlight:
+        return render_highlight_request(message)
+    return render_redacted_message(message, show_real)
+
+
+def store_rendered_message(message):
+    """
+    Renders the content of the message for its owner and for the public
+    and stores both together with the key they were rendered for
+    """
+    highlight = message.is_first_message()
+    key = message.get_render_key(highlight=highlight)
+    if message.rendered_key == key:
+        return
+    FoiMessage.objects.filter(id=message.id).update(
+        rendered_key=key,
+        rendered_owner=render_message_content(message, True, highlight),
+        rendered_public=render_message_content(message, False, highlight)
+    )
+
+
+def get_message_content(message, show_real, highlight=False):
+    """
+    Returns the stored rendition of the message content, missing or
+    outdated ones are rendered here and queued to be stored
+    """
+    content = message.get_rendered_content(show_real, highlight=highlight)
+    if content is not None:
+        return content
+    from froide.foirequest.tasks import render_message_task
+    if cache.add(MESSAGE_RENDER_QUEUED_KEY % message.id, True,
+                 MESSAGE_RENDER_QUEUED_TIMEOUT):
+        render_message_task.delay(message.id)
+    return render_message_content(message, show_real, highlight)
+
+
+def highlight_request(message):
+    return get_message_content(message, False, highlight=True)
+
+
+def redact_message(message, user):
+    show_real = message.request.user == user or user.is_staff
+    return get_message_content(message, show_real)
+
+
 def check_same_request(context, foirequest, user, var_name):
     if foirequest.same_as_id:
         foirequest_id = foirequest.same_as_id
@@ -1,15 +1,23 @@
 from __future__ import with_statement
 
+import re
+
+from mock import patch
+
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.cache import cache
 from django.contrib.admin.sites import AdminSite
 from django.test.client import RequestFactory
 from django.contrib.auth import get_user_model
 from django.contrib.messages.storage import default_storage
 
 from froide.foirequest.tests import factories
-from froide.foirequest.models import FoiRequest, FoiAttachment, DeferredMessage
+from froide.foirequest.models import (FoiRequest, FoiAttachment, FoiEvent,
+    DeferredMessage)
 from froide.foirequest.admin import (FoiRequestAdmin,
     FoiAttachmentAdmin, DeferredMessageAdmin)
+from froide.foirequest.utils import get_attachment_job
 
 User = get_user_model()
 
@@ -137,6 +145,84 @@ class AdminActionTest(TestCase):
             'approved', False, True
         )
 
+    def test_approve_sends_one_event_per_request(self):
+        message = factories.FoiMessageFactory.create(
+            request=FoiRequest.objects.all()[0])
+        attachments = [factories.FoiAttachmentFactory.create(
+            belongs_to=message, approved=False) for _ in range(3)]
+        other = factories.FoiAttachmentFactory.create(approved=False)
+        events = FoiEvent.objects.filter(event_name='attachment_published')
+        request_events = events.filter(request=message.request).count()
+        other_events = events.filter(
+            request=other.belongs_to.request).count()
+
+        req = self.factory.post('/', {})
+        req.user = self.user
+        req._messages = default_storage(req)
+        self.attachment_admin.approve(req, FoiAttachment.objects.filter(
+            id__in=[a.id for a in attachments] + [other.id]))
+
+        self.assertFalse(FoiAttachment.objects.filter(
+            id__in=[a.id for a in attachments] + [other.id],
+            approved=False).exists())
+        self.assertEqual(events.filter(request=message.request).count(),
+                         request_events + 1)
+        self.assertEqual(events.filter(
+            request=other.belongs_to.request).count(), other_events + 1)
+
+    @patch('froide.foirequest.admin.ATTACHMENT_JOB_SIZE', 1)
+    def test_approve_in_background(self):
+        attachments = [factories.FoiAttachmentFactory.create(approved=False)
+                       for _ in range(3)]
+        req = self.factory.post('/', {})
+        req.user = self.user
+        req._messages = default_storage(req)
+        self.attachment_admin.approve(req, FoiAttachment.objects.filter(
+            id__in=[a.id for a in attachments]))
+
+        message = list(req._messages)[0].message
+        job_id = re.search(r'/job/([0-9a-f]+)/', message).group(1)
+        job = get_attachment_job(job_id)
+        self.assertTrue(job['finished'])
+        self.assertEqual(job['total'], 3)
+        self.assertEqual(job['result'], 3)
+        response = self.attachment_admin.job_status(req, job_id)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(DOC_CONVERSION_LOW_PRIORITY_QUEUE='convert_low')
+    @patch('froide.foirequest.tasks.convert_attachment_task.apply_async')
+    def test_convert_skips_converted(self, apply_async):
+        doc = factories.FoiAttachmentFactory.create(name='answer.doc',
+            filetype='application/msword')
+        converted = factories.FoiAttachmentFactory.create(name='old.doc',
+            filetype='application/msword', converted=doc)
+        pdf = factories.FoiAttachmentFactory.create()
+        queryset = FoiAttachment.objects.filter(
+            id__in=[doc.id, converted.id, pdf.id])
+        # Forget the conversion queued on creation
+        cache.clear()
+        apply_async.reset_mock()
+
+        req = self.factory.post('/', {})
+        req.user = self.user
+        req._messages = default_storage(req)
+        self.attachment_admin.convert(req, queryset)
+        self.assertEqual(apply_async.call_count, 1)
+        self.assertEqual(apply_async.call_args[0][0], (doc.id,))
+        # Bulk conversions go to the low priority queue
+        self.assertEqual(apply_async.call_args[1]['queue'], 'convert_low')
+
+        # Already queued conversions are not queued again
+        self.attachment_admin.convert(req, queryset)
+        self.assertEqual(apply_async.call_count, 1)
+
+        # Without a low priority queue the default queue is used
+        cache.clear()
+        with self.settings(DOC_CONVERSION_LOW_PRIORITY_QUEUE=''):
+            self.attachment_admin.convert(req, queryset)
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertNotIn('queue', apply_async.call_args[1])
+
     def test_cannot_approve(self):
         self.check_attribute_change_action(
             FoiAttachment,
@@ -2,6 +2,9 @@
 from __future__ import with_statement
 
 from datetime import datetime
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 import json
 import os
 
@@ -14,10 +17,15 @@ from django.utils.six import BytesIO
 from django.core.urlresolvers import reverse
 from django.test.utils import override_settings
 
-from froide.helper.email_utils import EmailParser
+from django.core.cache import cache
+
+from froide.helper.email_utils import EmailParser, ImapMailFetcher
+from froide.helper.tests import FakeIMAP
 
 from froide.foirequest.tasks import process_mail
-from froide.foirequest.models import (FoiRequest, FoiMessage, DeferredMessage)
+from froide.foirequest.foi_mail import fetch_and_process
+from froide.foirequest.models import (FoiRequest, FoiMessage, DeferredMessage,
+    FoiRequestAddress, MailFetchCheckpoint)
 from froide.foirequest.tests import factories
 
 TEST_DATA_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), 'testdata'))
@@ -73,6 +81,33 @@ class MailTest(TestCase):
             messages[1].attachments[1]
         )
 
+    def test_fetch_and_process(self):
+        with open(p("test_mail_01.txt"), 'rb') as f:
+            mailbox = {7: [f.read(), False], 9: [b'', True]}
+        imap = FakeIMAP(mailbox)
+        fetcher = ImapMailFetcher('localhost', 143, 'user', 'password',
+                                  ssl=False, connection_factory=imap)
+        count = fetch_and_process(fetcher=fetcher)
+        self.assertEqual(count, 1)
+        self.assertTrue(mailbox[7][1])
+        request = FoiRequest.objects.get_by_secret_mail("sw+yurpykc1hr@fragdenstaat.de")
+        self.assertEqual(len(request.messages), 2)
+
+        # Processed but not flagged mails are not delivered again
+        mailbox[7][1] = False
+        count = fetch_and_process(fetcher=fetcher)
+        self.assertEqual(count, 0)
+        self.assertTrue(mailbox[7][1])
+        request = FoiRequest.objects.get_by_secret_mail("sw+yurpykc1hr@fragdenstaat.de")
+        self.assertEqual(len(request.messages), 2)
+
+        # The checkpoint is kept in the database, not in the cache
+        cache.clear()
+        mailbox[7][1] = False
+        count = fetch_and_process(fetcher=fetcher)
+        self.assertEqual(count, 0)
+        self.assertEqual(MailFetchCheckpoint.objects.get().uid, 7)
+
     def test_wrong_address(self):
         request = FoiRequest.objects.get_by_secret_mail(
                 u"sw+yurpykc1hr@fragdenstaat.de")
@@ -92,6 +127,75 @@ class MailTest(TestCase):
             email = parser.parse(f)
         self.assertEqual(len(email['attachments']), 1)
 
+    def test_streaming_parser(self):
+        for i in range(1, 8):
+            with open(p("test_mail_%02d.txt" % i), 'rb') as f:
+                email = EmailParser().parse(f)
+            with open(p("test_mail_%02d.txt" % i), 'rb') as f:
+                streamed = EmailParser(max_memory_size=1024).parse_stream(f)
+            for key in ('subject', 'body', 'html', 'from', 'to', 'cc', 'date'):
+                self.assertEqual(streamed[key], email[key])
+            self.assertEqual(len(streamed['attachments']),
+                             len(email['attachments']))
+            for attachment, streamed_attachment in zip(email['attachments'],
+                                                       streamed['attachments']):
+                self.assertEqual(streamed_attachment.name, attachment.name)
+                self.assertEqual(streamed_attachment.size, attachment.size)
+                self.assertEqual(streamed_attachment.content_type,
+                                 attachment.content_type)
+                self.assertEqual(streamed_attachment.read(),
+                                 attachment.getvalue())
+
+    def test_streaming_parser_crlf(self):
+        body = {
+            '8bit': u'Hallo Welt\r\nGrüße\r\n'.encode('utf-8'),
+            'quoted-printable': b'Hallo Welt\r\nGr=C3=BC=C3=9Fe mit soft=\r\nbreak\r\n'
+        }
+        for encoding, payload in body.items():
+            mail_string = (
+                b'From: sender@example.org\r\n'
+                b'To: sw+yurpykc1hr@fragdenstaat.de\r\n'
+                b'Subject: Line endings\r\n'
+                b'MIME-Version: 1.0\r\n'
+                b'Content-Type: multipart/alternative; boundary="b"\r\n\r\n'
+                b'--b\r\n'
+                b'Content-Type: text/plain; charset=utf-8\r\n'
+                b'Content-Transfer-Encoding: ' + encoding.encode('ascii') +
+                b'\r\n\r\n' + payload + b'\r\n--b\r\n'
+                b'Content-Type: text/html; charset=utf-8\r\n'
+                b'Content-Transfer-Encoding: ' + encoding.encode('ascii') +
+                b'\r\n\r\n' + payload + b'\r\n--b--\r\n')
+            email = EmailParser().parse(BytesIO(mail_string))
+            streamed = EmailParser().parse_stream(BytesIO(mail_string))
+            self.assertEqual(streamed['body'], email['body'])
+            self.assertEqual(streamed['html'], email['html'])
+            self.assertNotIn(u'\r', streamed['body'])
+            self.assertIn(u'Grüße', streamed['body'])
+
+    def test_streaming_parser_spools_attachments(self):
+        content = os.urandom(200 * 1024)
+        msg = MIMEMultipart()
+        msg['Subject'] = 'Scan'
+        msg.attach(MIMEText('Text', 'plain', 'utf-8'))
+        part = MIMEApplication(content, 'pdf')
+        part.add_header('Content-Disposition', 'attachment',
+                        filename='scan.pdf')
+        msg.attach(part)
+        mail_string = msg.as_string().encode('ascii')
+
+        email = EmailParser(max_memory_size=1024).parse_stream(
+            BytesIO(mail_string))
+        self.assertEqual(email['body'], u'Text')
+        self.assertEqual(len(email['attachments']), 1)
+        attachment = email['attachments'][0]
+        self.assertEqual(attachment.name, 'scan.pdf')
+        self.assertEqual(attachment.size, len(content))
+        self.assertTrue(attachment.file._rolled)
+        self.assertEqual(attachment.read(), content)
+
+        email = EmailParser().parse_stream(BytesIO(mail_string))
+        self.assertFalse(email['attachments'][0].file._rolled)
+
     def test_long_attachment_names(self):
         request = FoiRequest.objects.get_by_secret_mail("sw+yurpykc1hr@fragdenstaat.de")
         with open(p("test_mail_04.txt"), 'rb') as f:
@@ -265,6 +369,54 @@ class SpamMailTest(TestCase):
         dms = DeferredMessage.objects.filter(recipient=recipient, spam=True)
         self.assertEqual(len(dms), 1)
 
+    def test_known_sender_of_public_body(self):
+        self.assertFalse(self.req.is_known_sender('hb@bad-example.com'))
+        other_req = factories.FoiRequestFactory.create(site=self.site,
+            public_body=self.req.public_body)
+        factories.FoiMessageFactory.create(request=other_req,
+            is_response=True, sender_email='info@press.bad-example.com',
+            sender_public_body=self.req.public_body)
+        address = FoiRequestAddress.objects.get(request=other_req,
+                                                is_response=True)
+        self.assertEqual(address.base_domain, 'bad-example.com')
+        self.assertTrue(self.req.is_known_sender('hb@bad-example.com'))
+        count_messages = len(self.req.messages)
+        with open(p("test_mail_01.txt"), 'rb') as f:
+            mail = f.read().decode('ascii').replace('hb@example.com', 'hb@bad-example.com')
+        process_mail.delay(mail.encode('ascii'))
+        self.assertEqual(count_messages + 1,
+            FoiMessage.objects.filter(request=self.req).count())
+        self.assertFalse(DeferredMessage.objects.filter(spam=True).exists())
+
+    def test_request_address_message_deleted(self):
+        other_pb = factories.PublicBodyFactory.create(site=self.site,
+            jurisdiction=self.req.public_body.jurisdiction)
+        first = factories.FoiMessageFactory.create(request=self.req,
+            is_response=True, sender_email='info@bad-example.com',
+            sender_public_body=self.req.public_body,
+            timestamp=datetime(2010, 6, 1, tzinfo=timezone.utc))
+        latest = factories.FoiMessageFactory.create(request=self.req,
+            is_response=True, sender_email='Info@bad-example.com',
+            sender_public_body=other_pb,
+            timestamp=datetime(2010, 6, 2, tzinfo=timezone.utc))
+        address = FoiRequestAddress.objects.get(request=self.req,
+            email='info@bad-example.com')
+        self.assertEqual(address.public_body, other_pb)
+
+        latest.delete()
+        address = FoiRequestAddress.objects.get(request=self.req,
+            email='info@bad-example.com')
+        self.assertEqual(address.public_body, self.req.public_body)
+        self.assertEqual(address.timestamp, first.timestamp)
+
+        first.delete()
+        self.assertFalse(FoiRequestAddress.objects.filter(request=self.req,
+            email='info@bad-example.com').exists())
+
+        self.req.delete()
+        self.assertFalse(FoiRequestAddress.objects.filter(
+            request_id=self.req.id).exists())
+
 
 class PostMarkMailTest(TestCase):
     def setUp(self):
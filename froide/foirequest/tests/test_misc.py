@@ -1,14 +1,26 @@
 from datetime import timedelta
 
+from mock import patch
+
+from django.conf import settings
 from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.core import mail
-from django.utils import timezone
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone, translation
 
 from froide.foirequest.tests import factories
-from froide.foirequest.templatetags.foirequest_tags import check_same_request
-from froide.foirequest.models import FoiRequest
+from froide.foirequest.templatetags.foirequest_tags import (
+    check_same_request, redact_message, highlight_request)
+from froide.foirequest.models import (FoiRequest, FoiMessage, FoiEvent,
+    FoiAttachment)
+from froide.foirequest.file_utils import is_blob_name
+from froide.foirequest.utils import (prefetch_event_texts,
+        remove_unreferenced_blobs)
 from froide.foirequest.tasks import (detect_asleep, detect_overdue,
-    classification_reminder)
+    classification_reminder, redact_messages_task, convert_attachment)
 
 
 class TemplateTagTest(TestCase):
@@ -39,6 +51,115 @@ class TemplateTagTest(TestCase):
         check_same_request(context, same_2, user_1, var_name)
         self.assertEqual(context[var_name], False)
 
+    def test_redact_message(self):
+        user = factories.UserFactory.create(first_name='Vera',
+                                            last_name='Vertraulich',
+                                            private=True)
+        req = factories.FoiRequestFactory.create(user=user, site=self.site)
+        message = factories.FoiMessageFactory.create(request=req,
+            plaintext='Dear Vera Vertraulich,\nhere is the answer.\n' * 50)
+        message.plaintext_redacted = message.redact_plaintext()
+        message.save()
+        message = FoiMessage.objects.get(pk=message.pk)
+        self.assertIsNotNone(message.redaction_spans)
+
+        owner_content = redact_message(message, user)
+        self.assertEqual(owner_content.count(
+            '<span class="redacted redacted-hover"'), 50)
+        self.assertIn('Vertraulich', owner_content)
+        public_content = redact_message(message, AnonymousUser())
+        self.assertEqual(public_content.count('<span class="redacted">'), 50)
+        self.assertNotIn('Vertraulich', public_content)
+
+        # Messages without recorded spans or renditions render the same
+        FoiMessage.objects.filter(pk=message.pk).update(redaction_spans=None,
+                                                        rendered_key='')
+        message = FoiMessage.objects.get(pk=message.pk)
+        self.assertEqual(redact_message(message, user), owner_content)
+        self.assertEqual(redact_message(message, AnonymousUser()),
+                         public_content)
+
+    def test_redaction_spans_skipped_for_other_fields(self):
+        req = factories.FoiRequestFactory.create(site=self.site)
+        message = factories.FoiMessageFactory.create(request=req,
+            plaintext='Dear Vera,\nhere is the answer.')
+        message.plaintext_redacted = message.plaintext
+        with patch.object(FoiMessage, 'get_redaction_spans_json',
+                          return_value='[]') as spans:
+            message.save(update_fields=['subject'])
+            self.assertFalse(spans.called)
+            message.save(update_fields=['plaintext_redacted'])
+            self.assertEqual(spans.call_count, 1)
+            message.save()
+            self.assertEqual(spans.call_count, 2)
+
+    def test_stored_message_rendering(self):
+        user = factories.UserFactory.create(first_name='Vera',
+                                            last_name='Vertraulich',
+                                            private=True)
+        req = factories.FoiRequestFactory.create(user=user, site=self.site)
+        factories.FoiMessageFactory.create(request=req,
+            timestamp=timezone.now() - timedelta(days=1))
+        message = factories.FoiMessageFactory.create(request=req,
+            timestamp=timezone.now(),
+            plaintext='Dear Vera Vertraulich, here is the answer.')
+        message.plaintext_redacted = message.redact_plaintext()
+        message.save()
+
+        with translation.override(settings.LANGUAGE_CODE):
+            message = FoiMessage.objects.get(pk=message.pk)
+            self.assertFalse(message.is_first_message())
+            self.assertEqual(message.rendered_key, message.get_render_key())
+            self.assertIn('Vertraulich', message.rendered_owner)
+            self.assertNotIn('Vertraulich', message.rendered_public)
+
+            FoiMessage.objects.filter(pk=message.pk).update(
+                rendered_owner='owner', rendered_public='public')
+            message = FoiMessage.objects.get(pk=message.pk)
+            self.assertEqual(redact_message(message, user), 'owner')
+            self.assertEqual(redact_message(message, AnonymousUser()),
+                             'public')
+            # The stored first message is not highlighted
+            self.assertNotEqual(highlight_request(message), 'public')
+
+            # Outdated renditions are not used
+            FoiMessage.objects.filter(pk=message.pk).update(
+                plaintext='Another answer')
+            message = FoiMessage.objects.get(pk=message.pk)
+            self.assertIn('Another answer', redact_message(message, user))
+
+
+class EventTextTest(TestCase):
+    def setUp(self):
+        self.site = factories.make_world()
+        cache.clear()
+
+    def test_prefetch_event_texts(self):
+        req = factories.FoiRequestFactory.create(site=self.site)
+        for _ in range(5):
+            FoiEvent.objects.create_event('message_received', req,
+                user=req.user, public_body=req.public_body)
+        expected = [event.render_html()
+                    for event in FoiEvent.objects.filter(request=req)]
+
+        events = list(FoiEvent.objects.filter(request=req))
+        # request, user and public body in one query each
+        with self.assertNumQueries(3):
+            prefetch_event_texts(events)
+        self.assertEqual([event.as_html() for event in events], expected)
+
+        events = list(FoiEvent.objects.filter(request=req))
+        with self.assertNumQueries(0):
+            prefetch_event_texts(events)
+            texts = [event.as_html() for event in events]
+        self.assertEqual(texts, expected)
+
+        req.public_body.name = 'Renamed Public Body'
+        req.public_body.save()
+        events = list(FoiEvent.objects.filter(request=req))
+        prefetch_event_texts(events)
+        self.assertIn('Renamed Public Body', events[0].as_text())
+
 
 class TaskTest(TestCase):
     def setUp(self):
@@ -72,6 +193,40 @@ class TaskTest(TestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn('Request became overdue', mail.outbox[0].subject)
 
+    def test_detect_overdue_many(self):
+        FoiRequest.objects.all().update(due_date=timezone.now() + timedelta(days=10))
+        user = factories.UserFactory.create()
+        reqs = [factories.FoiRequestFactory.create(user=user, site=self.site,
+                    status='awaiting_response', visibility=i % 2 + 1,
+                    due_date=timezone.now() - timedelta(hours=5))
+                for i in range(5)]
+        mail.outbox = []
+        with patch('froide.foirequest.tasks.SWEEP_CHUNK_SIZE', 2):
+            result = detect_overdue.delay().get()
+        self.assertEqual(result['count'], 5)
+        self.assertEqual(len(mail.outbox), 5)
+        for req in reqs:
+            events = FoiEvent.objects.filter(request=req,
+                                             event_name='became_overdue')
+            self.assertEqual(len(events), 1)
+            self.assertEqual(events[0].public, req.visibility == 2)
+
+    def test_detect_asleep_many(self):
+        user = factories.UserFactory.create()
+        last_message = timezone.now() - timedelta(days=31 * 6)
+        reqs = [factories.FoiRequestFactory.create(user=user, site=self.site,
+                    status='awaiting_response', last_message=last_message)
+                for i in range(5)]
+        mail.outbox = []
+        with patch('froide.foirequest.tasks.SWEEP_CHUNK_SIZE', 2):
+            result = detect_asleep.delay().get()
+        self.assertEqual(result['count'],
+                         FoiRequest.objects.filter(status='asleep').count())
+        self.assertEqual(len(mail.outbox), result['count'])
+        for req in reqs:
+            self.assertEqual(FoiRequest.objects.get(pk=req.pk).status,
+                             'asleep')
+
     def test_classification_reminder(self):
         fr = FoiRequest.objects.all()[0]
         fr.last_message = timezone.now() - timedelta(days=5)
@@ -84,3 +239,137 @@ class TaskTest(TestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn('Please classify the reply to your request',
                       mail.outbox[0].subject)
+
+    def test_redact_messages(self):
+        user = factories.UserFactory.create(first_name='Vera',
+                                            last_name='Vertraulich',
+                                            private=True)
+        req = factories.FoiRequestFactory.create(user=user, site=self.site)
+        message = factories.FoiMessageFactory.create(request=req,
+            plaintext='Dear Mr Smith, this is Vera Vertraulich.',
+            plaintext_redacted='Dear Mr Smith, this is Vera Vertraulich.')
+        other = FoiMessage.objects.exclude(request__user=user)[0]
+        other_redacted = other.plaintext_redacted
+
+        redact_messages_task.delay(user_id=user.id)
+
+        message = FoiMessage.objects.get(pk=message.pk)
+        self.assertNotIn('Vertraulich', message.plaintext_redacted)
+        self.assertEqual(message.plaintext_redacted,
+                         message.redact_plaintext())
+        other = FoiMessage.objects.get(pk=other.pk)
+        self.assertEqual(other.plaintext_redacted, other_redacted)
+
+    def test_redact_messages_only_missing(self):
+        user = factories.UserFactory.create(first_name='Vera',
+                                            last_name='Vertraulich',
+                                            private=True)
+        req = factories.FoiRequestFactory.create(user=user, site=self.site)
+        message = factories.FoiMessageFactory.create(request=req,
+            subject='From Vera Vertraulich',
+            plaintext='Dear Mr Smith, this is Vera Vertraulich.')
+        FoiMessage.objects.filter(pk=message.pk).update(
+            subject_redacted='Edited subject', plaintext_redacted=None)
+
+        redact_messages_task.delay(user_id=user.id, only_missing=True)
+
+        message = FoiMessage.objects.get(pk=message.pk)
+        self.assertEqual(message.subject_redacted, 'Edited subject')
+        self.assertEqual(message.plaintext_redacted,
+                         message.redact_plaintext())
+        self.assertNotIn('Vertraulich', message.plaintext_redacted)
+
+    def test_get_content_does_not_save(self):
+        message = FoiMessage.objects.all()[0]
+        FoiMessage.objects.filter(pk=message.pk).update(
+            plaintext_redacted=None)
+        message = FoiMessage.objects.get(pk=message.pk)
+        self.assertEqual(message.get_content(), message.redact_plaintext())
+        message = FoiMessage.objects.get(pk=message.pk)
+        self.assertIsNone(message.plaintext_redacted)
+
+
+class AttachmentStorageTest(TestCase):
+    def setUp(self):
+        self.site = factories.make_world()
+        cache.clear()
+
+    def make_attachment(self, content, name='answer.pdf',
+                        filetype='application/pdf', **kwargs):
+        message = factories.FoiMessageFactory.create(
+            request=FoiRequest.objects.all()[0])
+        att = FoiAttachment(belongs_to=message, name=name,
+                            filetype=filetype, **kwargs)
+        att.store_file(ContentFile(content))
+        att.save()
+        return att
+
+    def test_identical_files_are_stored_once(self):
+        att = self.make_attachment(b'%PDF same content')
+        other = self.make_attachment(b'%PDF same content')
+        different = self.make_attachment(b'%PDF other content')
+        self.assertTrue(is_blob_name(att.file.name))
+        self.assertEqual(att.file.name, other.file.name)
+        self.assertEqual(att.content_hash, other.content_hash)
+        self.assertNotEqual(att.file.name, different.file.name)
+        self.assertEqual(att.size, len(b'%PDF same content'))
+
+        att.delete()
+        remove_unreferenced_blobs(max_age=timedelta(0))
+        self.assertTrue(default_storage.exists(other.file.name))
+        other.delete()
+        # Deleting leaves the blob to the sweep
+        self.assertTrue(default_storage.exists(other.file.name))
+        remove_unreferenced_blobs()
+        self.assertTrue(default_storage.exists(other.file.name))
+        remove_unreferenced_blobs(max_age=timedelta(0))
+        self.assertFalse(default_storage.exists(other.file.name))
+
+        name = different.file.name
+        different.store_file(ContentFile(b'%PDF replaced'))
+        different.save()
+        self.assertTrue(default_storage.exists(name))
+        remove_unreferenced_blobs(max_age=timedelta(0))
+        self.assertFalse(default_storage.exists(name))
+        self.assertTrue(default_storage.exists(different.file.name))
+        different.delete()
+        remove_unreferenced_blobs(max_age=timedelta(0))
+
+    def test_swept_blob_is_stored_again(self):
+        att = self.make_attachment(b'%PDF swept content')
+        att.delete()
+        other = FoiAttachment(belongs_to=att.belongs_to, name='other.pdf',
+                              filetype='application/pdf')
+        other.store_file(ContentFile(b'%PDF swept content'))
+        # The sweep runs before the new attachment is saved
+        remove_unreferenced_blobs(max_age=timedelta(0))
+        self.assertFalse(default_storage.exists(other.file.name))
+        other.save()
+        self.assertTrue(default_storage.exists(other.file.name))
+        other.delete()
+        remove_unreferenced_blobs(max_age=timedelta(0))
+
+    @patch('froide.foirequest.tasks.convert_to_pdf', lambda *a, **k: None)
+    def test_conversion_is_reused(self):
+        att = self.make_attachment(b'doc content', name='answer.doc',
+                                   filetype='application/msword')
+        converted = self.make_attachment(b'%PDF converted',
+                                         is_converted=True)
+        att.converted = converted
+        att.save()
+        other = self.make_attachment(b'doc content', name='same.doc',
+                                     filetype='application/msword')
+
+        # Converted on save
+        other = FoiAttachment.objects.get(id=other.id)
+        self.assertEqual(other.converted.file.name, converted.file.name)
+        self.assertEqual(other.converted.name, 'same.pdf')
+        self.assertTrue(other.converted.is_converted)
+        # Converting again keeps the converted version
+        convert_attachment(other)
+        self.assertEqual(FoiAttachment.objects.filter(
+            belongs_to=other.belongs_to).count(), 2)
+
+        for attachment in (att, other.converted, other, converted):
+            attachment.delete()
+        self.assertFalse(default_storage.exists(converted.file.name))
@@ -13,13 +13,16 @@ from django.core.urlresolvers import reverse
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.utils import timezone
 from django.utils.six import BytesIO
 from django.test.utils import override_settings
 
 from froide.publicbody.models import PublicBody, FoiLaw
 from froide.foirequest.tests import factories
-from froide.foirequest.foi_mail import package_foirequest
+from froide.foirequest.foi_mail import (package_foirequest,
+    get_foirequest_archive, delete_foirequest_archives)
 from froide.foirequest.models import FoiRequest, FoiMessage, FoiAttachment
 
 User = get_user_model()
@@ -835,6 +838,7 @@ class RequestTest(TestCase):
         self.assertEqual(message.attachments[0][2], 'application/zip')
         self.assertEqual(zipfile.ZipFile(BytesIO(message.attachments[0][1]), 'r').namelist(),
                          zipfile.ZipFile(BytesIO(zip_bytes), 'r').namelist())
+        delete_foirequest_archives(req)
 
     def test_set_tags(self):
         req = FoiRequest.objects.all()[0]
@@ -1267,9 +1271,23 @@ class RequestTest(TestCase):
         self.assertIn('public_body', response.context['request_form'].errors)
         self.assertEqual(len(response.context['request_form'].errors), 1)
 
-    @patch('froide.foirequest.views.convert_to_pdf',
-           lambda x: factories.TEST_PDF_PATH)
     def test_redact_attachment(self):
+        redaction_dirs = []
+
+        def convert_images_to_pdf(path):
+            redaction_dirs.append(path)
+            self.assertTrue(os.path.exists(os.path.join(path, 'page_0001.png')))
+            return factories.TEST_PDF_PATH
+
+        with patch('froide.foirequest.tasks.convert_images_to_pdf',
+                   convert_images_to_pdf):
+            self._test_redact_attachment()
+        self.assertEqual(len(redaction_dirs), 1)
+        self.assertFalse(os.path.exists(redaction_dirs[0]))
+        # The pages stored for the worker are removed as well
+        self.assertEqual(default_storage.listdir('redactions')[0], [])
+
+    def _test_redact_attachment(self):
         foirequest = FoiRequest.objects.all()[0]
         message = foirequest.messages[0]
         att = factories.FoiAttachmentFactory.create(belongs_to=message)
@@ -1295,10 +1313,26 @@ class RequestTest(TestCase):
         self.assertEqual(response.status_code, 200)
 
         response = self.client.post(url, {})
+        self.assertEqual(response.status_code, 400)
+
+        page = BytesIO(b'\x89PNG')
+        page.name = 'page_1.png'
+        response = self.client.post(url, {'page_1': page})
         self.assertEqual(response.status_code, 302)
 
         old_att = FoiAttachment.objects.get(id=att.id)
         self.assertFalse(old_att.can_approve)
+        self.assertTrue(old_att.redacted.is_redacted)
+        self.assertIn(old_att.redacted.get_anchor_url(), response['Location'])
+
+        # Only the task of the attachment can be polled
+        status_url = reverse('foirequest-redact_attachment_status', kwargs={
+            'slug': foirequest.slug,
+            'attachment_id': str(att.id),
+            'task_id': 'other-task'
+        })
+        response = self.client.get(status_url)
+        self.assertEqual(response.status_code, 404)
 
     def test_extend_deadline(self):
         foirequest = FoiRequest.objects.all()[0]
@@ -1534,3 +1568,68 @@ class PackageFoiRequestTest(TestCase):
         self.assertEqual(len(filenames), len(zip_names))
         for zname, fname in zip(zip_names, filenames):
             self.assertTrue(bool(re.match('^%s$' % fname, zname)))
+
+    def tearDown(self):
+        for fr in FoiRequest.objects.all():
+            delete_foirequest_archives(fr)
+
+    @override_settings(USE_X_ACCEL_REDIRECT=False)
+    def test_download_streaming(self):
+        fr = FoiRequest.objects.all()[0]
+        self.client.login(username='sw', password='froide')
+        response = self.client.get(reverse('foirequest-download',
+                kwargs={'slug': fr.slug}))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        content = b''.join(response.streaming_content)
+        zfile = zipfile.ZipFile(BytesIO(content), 'r')
+        self.assertEqual(zfile.namelist(),
+            zipfile.ZipFile(BytesIO(package_foirequest(fr)), 'r').namelist())
+
+    def test_download_x_accel(self):
+        fr = FoiRequest.objects.all()[0]
+        self.client.login(username='sw', password='froide')
+        response = self.client.get(reverse('foirequest-download',
+                kwargs={'slug': fr.slug}))
+        self.assertEqual(response.status_code, 200)
+        archive_name = get_foirequest_archive(fr)
+        self.assertEqual(response['X-Accel-Redirect'], '%s%s%s' % (
+            settings.X_ACCEL_REDIRECT_PREFIX, settings.MEDIA_URL, archive_name))
+
+    def test_archive_cache(self):
+        fr = FoiRequest.objects.all()[0]
+        archive_name = get_foirequest_archive(fr)
+        fr._messages = None
+        self.assertEqual(get_foirequest_archive(fr), archive_name)
+        old_names = zipfile.ZipFile(default_storage.open(archive_name, 'rb')).namelist()
+
+        factories.FoiMessageFactory.create(request=fr,
+            timestamp=fr.messages[-1].timestamp + timedelta(days=1))
+        fr._messages = None
+        new_archive_name = get_foirequest_archive(fr)
+        self.assertNotEqual(new_archive_name, archive_name)
+        self.assertFalse(default_storage.exists(archive_name))
+        new_names = zipfile.ZipFile(default_storage.open(new_archive_name, 'rb')).namelist()
+        self.assertEqual(new_names[:len(old_names)], old_names)
+        self.assertEqual(len(new_names), len(old_names) + 1)
+        self.assertEqual(new_names,
+            zipfile.ZipFile(BytesIO(package_foirequest(fr)), 'r').namelist())
+
+    def test_archive_deleted_with_request(self):
+        fr = FoiRequest.objects.all()[0]
+        archive_name = get_foirequest_archive(fr)
+        directory = archive_name.rsplit('/', 1)[0]
+        stale_name = default_storage.save('%s/stale.zip' % directory,
+                                          ContentFile(b'stale'))
+        factories.FoiMessageFactory.create(request=fr,
+            timestamp=fr.messages[-1].timestamp + timedelta(days=1))
+        fr._messages = None
+        archive_name = get_foirequest_archive(fr)
+        self.assertFalse(default_storage.exists(stale_name))
+        self.assertEqual(default_storage.listdir(directory)[1],
+                         [archive_name.rsplit('/', 1)[1]])
+
+        fr.delete()
+        self.assertFalse(default_storage.exists(archive_name))
+        self.assertFalse(default_storage.exists(directory))
@@ -1,14 +1,30 @@
+# -*- coding: utf-8 -*-
 from __future__ import with_statement
 
+from datetime import datetime
+import json
+
 from django.utils.six import text_type as str
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+
+from django_comments.models import Comment
 
 from froide.publicbody.models import PublicBody, PublicBodyTag, Jurisdiction
 from froide.foirequest.models import FoiRequest, FoiAttachment
 from froide.foirequest.tests import factories
+from froide.foirequest.utils import update_daily_stats, STATS_START_DATE
+
+User = get_user_model()
 
 
 class WebTest(TestCase):
@@ -200,6 +216,46 @@ class WebTest(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertTrue(response['Location'].endswith(req.get_absolute_url()))
 
+    def test_list_requests_keyset(self):
+        for _ in range(25):
+            factories.FoiRequestFactory.create(site=self.site)
+        expected = list(FoiRequest.published.for_list_view().filter(
+            last_message__isnull=False).order_by('-last_message', '-id'
+            ).values_list('id', flat=True))
+        self.assertGreater(len(expected), 20)
+        seen = []
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(reverse('foirequest-list'),
+                                       {'after': cursor})
+            self.assertEqual(response.status_code, 200)
+            page = response.context['object_list']
+            pages.append([obj.id for obj in page])
+            seen.extend(pages[-1])
+            cursor = page.next_cursor()
+        self.assertEqual(seen, expected)
+
+        response = self.client.get(reverse('foirequest-list'),
+                                   {'before': page.previous_cursor()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([obj.id for obj in response.context['object_list']],
+                         pages[-2])
+
+        response = self.client.get(reverse('foirequest-list'),
+                                   {'after': 'broken'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_feed_limited(self):
+        for _ in range(20):
+            factories.FoiRequestFactory.create(site=self.site)
+        response = self.client.get(reverse('foirequest-list_feed'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode('utf-8').count('<item>'), 15)
+        response = self.client.get(reverse('foirequest-list_feed'),
+                                   {'after': 'broken'})
+        self.assertEqual(response.status_code, 404)
+
     def test_feed(self):
         response = self.client.get(reverse('foirequest-feed_latest'))
         self.assertRedirects(response, reverse('foirequest-list_feed'),
@@ -277,6 +333,35 @@ class WebTest(TestCase):
         response = self.client.get(reverse('dashboard'))
         self.assertEqual(response.status_code, 200)
 
+    def test_dashboard_stats(self):
+        update_daily_stats(start_date=STATS_START_DATE)
+        self.client.login(username="sw", password="froide")
+        foi_requests = FoiRequest.objects.filter(is_foi=True,
+            public_body__isnull=False, first_message__isnull=False)
+        for params, qs in (
+                ({}, foi_requests),
+                ({'public': '1'}, foi_requests.filter(public=True)),
+                ({'public': '1', 'notsameas': '1'},
+                 foi_requests.filter(public=True, same_as__isnull=True))):
+            response = self.client.get(reverse('dashboard'), params)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.context['data'])
+            self.assertEqual(data['foirequest'][-1]['total'], qs.count())
+            self.assertEqual(sum(d['num'] for d in data['foirequest']),
+                             qs.count())
+            dates = [d['date'] for d in data['foirequest']]
+            self.assertEqual(dates, sorted(dates))
+        user = factories.UserFactory.create(date_joined=timezone.now())
+        update_daily_stats()
+        response = self.client.get(reverse('dashboard'))
+        data = json.loads(response.context['data'])
+        self.assertEqual(data['user'][-1]['date'],
+                         user.date_joined.date().isoformat())
+        self.assertEqual(data['user'][-1]['total'],
+            User.objects.filter(is_active=True,
+                date_joined__gte=datetime(2011, 7, 30, tzinfo=timezone.utc)
+            ).count())
+
     def test_search(self):
         response = self.client.get(reverse('foirequest-search'))
         self.assertEqual(response.status_code, 200)
@@ -315,6 +400,33 @@ class MediaServingTest(TestCase):
         response = self.client.get(att.get_absolute_url() + 'a')
         self.assertEqual(response.status_code, 404)
 
+    @override_settings(USE_X_ACCEL_REDIRECT=False)
+    def test_download_attachment_name(self):
+        att = FoiAttachment.objects.filter(approved=True)[0]
+        att.name = u'Bescheid-Grüße.pdf'
+        att.store_file(ContentFile(b'%PDF attachment content'))
+        att.save()
+        url = att.get_absolute_url()
+        self.assertTrue(url.endswith(reverse(
+            'foirequest-download_message_attachment', kwargs={
+                'message_id': att.belongs_to_id,
+                'attachment_name': att.name
+            })))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content),
+                         b'%PDF attachment content')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('filename="Bescheid-Gre.pdf"',
+                      response['Content-Disposition'])
+        self.assertIn("filename*=UTF-8''Bescheid-Gr%C3%BC%C3%9Fe.pdf",
+                      response['Content-Disposition'])
+
+        att.approved = False
+        att.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
 
 class PerformanceTest(TestCase):
     def setUp(self):
@@ -329,14 +441,14 @@ class PerformanceTest(TestCase):
         - FoiEvents of that request (+1)
         - FoiRequestFollowerCount (+1)
         - Tags (+1)
-        - ContentType + Comments for each FoiMessage (+3)
+        - ContentType + Comments of all FoiMessages (+2)
         """
         req = factories.FoiRequestFactory.create(site=self.site)
         factories.FoiMessageFactory.create(request=req)
         mes2 = factories.FoiMessageFactory.create(request=req)
         factories.FoiAttachmentFactory.create(belongs_to=mes2)
         ContentType.objects.clear_cache()
-        with self.assertNumQueries(9):
+        with self.assertNumQueries(8):
             self.client.get(req.get_absolute_url())
 
     def test_queries_foirequest_loggedin(self):
@@ -349,7 +461,7 @@ class PerformanceTest(TestCase):
         - FoiEvents of that request (+1)
         - FoiRequestFollowerCount + if following (+2)
         - Tags (+1)
-        - ContentType + Comments for each FoiMessage (+3)
+        - ContentType + Comments of all FoiMessages (+2)
         """
         req = factories.FoiRequestFactory.create(site=self.site)
         factories.FoiMessageFactory.create(request=req)
@@ -357,5 +469,120 @@ class PerformanceTest(TestCase):
         factories.FoiAttachmentFactory.create(belongs_to=mes2)
         self.client.login(username='dummy', password='froide')
         ContentType.objects.clear_cache()
-        with self.assertNumQueries(12):
+        with self.assertNumQueries(11):
             self.client.get(req.get_absolute_url())
+
+    def make_large_request(self, message_count=200, attachment_count=500):
+        req = factories.FoiRequestFactory.create(site=self.site)
+        messages = [factories.FoiMessageFactory.create(request=req,
+                        sender_public_body=req.public_body)
+                    for _ in range(message_count)]
+        for i in range(attachment_count):
+            factories.FoiAttachmentFactory.create(
+                belongs_to=messages[i % message_count],
+                approved=i % 5 != 0)
+        for message in messages[::10]:
+            factories.FoiEventFactory.create(request=req,
+                                             timestamp=message.timestamp)
+            Comment.objects.create(content_object=message,
+                site=self.site, user_name='Commenter',
+                user_email='commenter@example.org', comment='Comment')
+        return req
+
+    def test_queries_foirequest_many_messages(self):
+        """
+        Number of queries does not depend on the number of messages
+        and attachments of a request
+        """
+        req = self.make_large_request()
+        ContentType.objects.clear_cache()
+        with self.assertNumQueries(8):
+            response = self.client.get(req.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+
+    def test_queries_foirequest_many_messages_owner(self):
+        small_req = self.make_large_request(message_count=2,
+                                            attachment_count=3)
+        req = self.make_large_request()
+        req.user = small_req.user
+        req.save()
+        self.client.login(username=req.user.username, password='froide')
+        self.client.get(small_req.get_absolute_url())
+        with CaptureQueriesContext(connection) as small_queries:
+            self.client.get(small_req.get_absolute_url())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(req.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), len(small_queries))
+
+    @override_settings(FOI_REQUEST_FRAGMENT_CACHE_TIMEOUT=60)
+    def test_fragment_cache_foirequest(self):
+        cache.clear()
+        req = self.make_large_request(message_count=20, attachment_count=30)
+        self.client.get(req.get_absolute_url())
+        with CaptureQueriesContext(connection) as first_queries:
+            self.client.get(req.get_absolute_url())
+        cache.clear()
+        with CaptureQueriesContext(connection) as cold_queries:
+            self.client.get(req.get_absolute_url())
+        with CaptureQueriesContext(connection) as cached_queries:
+            response = self.client.get(req.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(first_queries), len(cached_queries))
+        self.assertLess(len(cached_queries), len(cold_queries))
+
+        message = req.messages[3]
+        Comment.objects.create(content_object=message,
+            site=self.site, user_name='Commenter',
+            user_email='commenter@example.org', comment='Freshly cached')
+        response = self.client.get(req.get_absolute_url())
+        self.assertContains(response, 'Freshly cached')
+
+        att = factories.FoiAttachmentFactory.create(belongs_to=message,
+            name='fresh_attachment.pdf')
+        response = self.client.get(req.get_absolute_url())
+        self.assertContains(response, 'fresh_attachment.pdf')
+
+        message.plaintext = 'Updated message text'
+        message.plaintext_redacted = 'Updated message text'
+        message.save()
+        response = self.client.get(req.get_absolute_url())
+        self.assertContains(response, 'Updated message text')
+
+        att.delete()
+        response = self.client.get(req.get_absolute_url())
+        self.assertNotContains(response, 'fresh_attachment.pdf')
+
+    @override_settings(FOI_REQUEST_FRAGMENT_CACHE_TIMEOUT=60)
+    def test_fragment_cache_owner_changes(self):
+        cache.clear()
+        req = self.make_large_request(message_count=3, attachment_count=0)
+        response = self.client.get(req.get_absolute_url())
+        self.assertContains(response, req.public_body.name)
+
+        version = response.context['cache_version']
+        other = factories.FoiRequestFactory.create(site=self.site,
+            public_body=req.public_body)
+        FoiRequest.request_to_public_body.send(sender=other)
+        response = self.client.get(req.get_absolute_url())
+        self.assertEqual(response.context['cache_version'], version)
+
+        req.public_body.name = 'Renamed Public Body'
+        req.public_body.save()
+        response = self.client.get(req.get_absolute_url())
+        self.assertNotEqual(response.context['cache_version'], version)
+        self.assertContains(response, 'Renamed Public Body')
+
+        version = response.context['cache_version']
+        req.user.private = True
+        req.user.save()
+        response = self.client.get(req.get_absolute_url())
+        self.assertNotEqual(response.context['cache_version'], version)
+
+    def test_fragment_cache_disabled_for_users(self):
+        req = factories.FoiRequestFactory.create(site=self.site)
+        self.client.login(username='dummy', password='froide')
+        with override_settings(FOI_REQUEST_FRAGMENT_CACHE_TIMEOUT=60):
+            cache.clear()
+            response = self.client.get(req.get_absolute_url())
+        self.assertNotIn('cache_version', response.context)
@@ -0,0 +1,538 @@
+from collections import defaultdict
+import datetime
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.db.models import Case, When, Value, Q, F
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.shortcuts import get_current_site
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from django.utils.six import text_type
+from django.utils.translation import get_language
+
+import django_comments
+
+from froide.helper.cache import bump_cache_version, get_cache_versions
+from froide.publicbody.models import PublicBody
+
+from .models import (FoiRequest, FoiMessage, FoiAttachment, FoiEvent,
+        DailyStats)
+from .file_utils import iter_blob_directories
+
+REDACTION_CHUNK_SIZE = 500
+ATTACHMENT_CHUNK_SIZE = 500
+ATTACHMENT_JOB_TIMEOUT = 24 * 60 * 60
+BLOB_MAX_AGE = datetime.timedelta(days=1)
+# Keeps the number of query parameters of one UPDATE low
+REDACTION_UPDATE_SIZE = 100
+
+
+def get_redaction_checkpoint_key(user_id=None, only_missing=False):
+    return 'froide:redact_messages:%s:%s' % (
+        'all' if user_id is None else user_id,
+        'missing' if only_missing else 'full')
+
+
+REDACTION_FIELDS = (
+    ('subject_redacted', models.CharField),
+    ('plaintext_redacted', models.TextField),
+    ('redaction_spans', models.TextField),
+)
+
+
+def update_redacted_messages(updates):
+    """
+    Writes (id, fields) tuples, fields mapping names of REDACTION_FIELDS
+    to their new values, with one UPDATE query per batch. Fields that
+    are not given keep their value.
+    """
+    for i in range(0, len(updates), REDACTION_UPDATE_SIZE):
+        batch = updates[i:i + REDACTION_UPDATE_SIZE]
+        values = {}
+        for name, field_class in REDACTION_FIELDS:
+            whens = [When(id=pk, then=Value(fields[name]))
+                     for pk, fields in batch if name in fields]
+            if whens:
+                values[name] = Case(*whens, default=F(name),
+                                    output_field=field_class())
+        FoiMessage.objects.filter(id__in=[u[0] for u in batch]).update(
+            **values)
+
+
+def redact_messages(user_id=None, only_missing=False, restart=False,
+                    chunk_size=REDACTION_CHUNK_SIZE, callback=None):
+    """
+    Recomputes subject_redacted and plaintext_redacted of messages
+    in chunks ordered by id.
+
+    The id of the last finished chunk is kept in the cache, so an
+    interrupted run continues where it stopped. Only messages whose
+    redaction changed are written, with only_missing only the fields
+    that are NULL. Returns (checked, updated) counts.
+    """
+    from .tasks import render_message_task
+
+    checkpoint_key = get_redaction_checkpoint_key(user_id, only_missing)
+    if restart:
+        cache.delete(checkpoint_key)
+    last_id = cache.get(checkpoint_key, 0)
+
+    messages = FoiMessage.objects.all()
+    if user_id is not None:
+        messages = messages.filter(request__user_id=user_id)
+    if only_missing:
+        messages = messages.filter(Q(subject_redacted__isnull=True) |
+                                   Q(plaintext_redacted__isnull=True))
+    messages = messages.select_related('request', 'request__user').defer(
+        'original', 'html').order_by('id')
+
+    checked, updated = 0, 0
+    while True:
+        chunk = list(messages.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        updates = []
+        changed = []
+        for message in chunk:
+            fields = {}
+            # With only_missing the fields that are set stay as they are
+            if not only_missing or message.subject_redacted is None:
+                subject = message.redact_subject()
+                if subject != message.subject_redacted:
+                    fields['subject_redacted'] = subject
+            if not only_missing or message.plaintext_redacted is None:
+                plaintext = message.redact_plaintext()
+                if plaintext != message.plaintext_redacted:
+                    fields['plaintext_redacted'] = plaintext
+                if message.plaintext is not None:
+                    # Also records the spans of messages saved before them
+                    message.plaintext_redacted = plaintext
+                    spans = message.get_redaction_spans_json()
+                    if spans != message.redaction_spans:
+                        fields['redaction_spans'] = spans
+            if fields:
+                updates.append((message.id, fields))
+            if ('subject_redacted' in fields or
+                    'plaintext_redacted' in fields):
+                changed.append(message)
+        with transaction.atomic():
+            update_redacted_messages(updates)
+        for message in changed:
+            invalidate_request_cache(message.request_id, [message.id])
+            render_message_task.delay(message.id)
+        last_id = chunk[-1].id
+        cache.set(checkpoint_key, last_id, None)
+        checked += len(chunk)
+        updated += len(updates)
+        if callback is not None:
+            callback(checked, updated, last_id)
+
+    cache.delete(checkpoint_key)
+    return checked, updated
+
+
+def get_message_comments(request, message_ids):
+    """
+    Comments of all given messages in one query, filtered like
+    the get_comment_list template tag does
+    """
+    if not message_ids:
+        return []
+    comment_model = django_comments.get_model()
+    comments = comment_model.objects.filter(
+        content_type=ContentType.objects.get_for_model(FoiMessage),
+        object_pk__in=[str(pk) for pk in message_ids],
+        site__pk=get_current_site(request).pk
+    )
+    field_names = [f.name for f in comment_model._meta.fields]
+    if 'is_public' in field_names:
+        comments = comments.filter(is_public=True)
+    if (getattr(settings, 'COMMENTS_HIDE_REMOVED', True) and
+            'is_removed' in field_names):
+        comments = comments.filter(is_removed=False)
+    if 'user' in field_names:
+        comments = comments.select_related('user')
+    return comments
+
+
+def get_request_cache_version_key(request_id):
+    return 'froide:foirequest:%s:cache_version' % request_id
+
+
+def get_message_cache_version_key(message_id):
+    return 'froide:foimessage:%s:cache_version' % message_id
+
+
+def get_user_cache_version_key(user_id):
+    return 'froide:user:%s:cache_version' % user_id
+
+
+def get_publicbody_cache_version_key(public_body_id):
+    return 'froide:publicbody:%s:cache_version' % public_body_id
+
+
+EVENT_TEXT_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+
+def get_event_version_keys(event):
+    keys = [get_request_cache_version_key(event.request_id)]
+    if event.user_id is not None:
+        keys.append(get_user_cache_version_key(event.user_id))
+    if event.public_body_id is not None:
+        keys.append(get_publicbody_cache_version_key(event.public_body_id))
+    return keys
+
+
+def load_event_relations(events):
+    """
+    Loads request, user and public body of the events that are
+    not loaded yet with one query per relation
+    """
+    relations = (
+        ('request', FoiRequest.objects),
+        ('user', get_user_model().objects),
+        ('public_body', PublicBody.non_filtered_objects)
+    )
+    for name, manager in relations:
+        cache_name = FoiEvent._meta.get_field(name).get_cache_name()
+        missing = [event for event in events
+                   if getattr(event, '%s_id' % name) is not None and
+                   not hasattr(event, cache_name)]
+        if not missing:
+            continue
+        objects = manager.in_bulk(set(getattr(event, '%s_id' % name)
+                                      for event in missing))
+        for event in missing:
+            obj = objects.get(getattr(event, '%s_id' % name))
+            if obj is not None:
+                setattr(event, name, obj)
+
+
+def prefetch_event_texts(events):
+    """
+    Sets the text and html of the events from the cache, rendering and
+    caching those that are missing. The cache keys contain the current
+    language and the cache versions of the request, user and public body
+    of the event, so changes to those render the texts again.
+    """
+    events = [event for event in events
+              if getattr(event, '_texts', None) is None]
+    if not events:
+        return
+    language = get_language()
+    version_keys = dict((event.id, get_event_version_keys(event))
+                        for event in events)
+    versions = get_cache_versions(list(set(
+        key for keys in version_keys.values() for key in keys)))
+    cache_keys = {}
+    for event in events:
+        checksum = zlib.crc32(event.context_json.encode('utf-8')) & 0xffffffff
+        cache_keys[event.id] = 'froide:foievent:%s:%s:%s:%s' % (
+            event.id, language, checksum,
+            '-'.join(str(versions[key]) for key in version_keys[event.id]))
+    cached = cache.get_many(list(cache_keys.values()))
+    missing = []
+    for event in events:
+        texts = cached.get(cache_keys[event.id])
+        if texts is None:
+            missing.append(event)
+        else:
+            event._texts = texts
+    if not missing:
+        return
+    load_event_relations(missing)
+    rendered = {}
+    for event in missing:
+        event._texts = (event.render_text(), text_type(event.render_html()))
+        rendered[cache_keys[event.id]] = event._texts
+    cache.set_many(rendered, EVENT_TEXT_CACHE_TIMEOUT)
+
+
+def create_request_events(event_name, requests):
+    """
+    Creates the same context-less event for many requests with one
+    query, requests are (id, visibility) pairs. Unlike
+    FoiEvent.objects.create_event this sends no post_save signals.
+    """
+    now = timezone.now()
+    FoiEvent.objects.bulk_create([
+        FoiEvent(request_id=request_id, public=visibility == 2,
+                 event_name=event_name, timestamp=now,
+                 context_json='{}')
+        for request_id, visibility in requests
+    ])
+
+
+def get_list_count_key(not_foi=False, status=None, topic=None, tag=None,
+        jurisdiction=None, public_body=None):
+    parts = [
+        'not_foi' if not_foi else 'foi',
+        status or '',
+    ] + [str(obj.pk) if obj is not None else ''
+         for obj in (topic, tag, jurisdiction, public_body)]
+    return 'froide:foirequest:list_count:%s' % ':'.join(parts)
+
+
+def use_fragment_cache(request, foirequest):
+    """
+    Rendered messages are only shared between anonymous
+    visitors of public requests
+    """
+    return (settings.FOI_REQUEST_FRAGMENT_CACHE_TIMEOUT > 0 and
+            foirequest.visibility == 2 and
+            not request.user.is_authenticated())
+
+
+def get_owner_version_keys(user_id, public_body_ids):
+    """
+    Keys of the versions of the user and public bodies shown in a
+    fragment, renaming them or making the user private bumps these
+    """
+    keys = []
+    if user_id is not None:
+        keys.append(get_user_cache_version_key(user_id))
+    for public_body_id in public_body_ids:
+        if public_body_id is not None:
+            keys.append(get_publicbody_cache_version_key(public_body_id))
+    return keys
+
+
+def get_request_cache_version(foirequest):
+    keys = [get_request_cache_version_key(foirequest.id)]
+    keys.extend(get_owner_version_keys(foirequest.user_id,
+                                       [foirequest.public_body_id]))
+    versions = get_cache_versions(keys)
+    return '-'.join(str(versions[key]) for key in keys)
+
+
+def set_message_cache_versions(messages):
+    message_keys = []
+    for message in messages:
+        keys = [get_message_cache_version_key(message.id)]
+        keys.extend(get_owner_version_keys(message.request.user_id,
+            [message.sender_public_body_id,
+             message.recipient_public_body_id]))
+        message_keys.append((message, keys))
+    versions = get_cache_versions(list(set(
+        key for _, keys in message_keys for key in keys)))
+    for message, keys in message_keys:
+        message.cache_version = '-'.join(str(versions[key]) for key in keys)
+
+
+def invalidate_request_cache(request_id, message_ids=()):
+    for message_id in message_ids:
+        bump_cache_version(get_message_cache_version_key(message_id))
+    bump_cache_version(get_request_cache_version_key(request_id))
+
+
+STATS_START_DATE = datetime.date(2011, 7, 30)
+# Users and requests can still change (activation, publishing)
+# after the day they were created on
+STATS_RECENT_DAYS = 7
+STATS_CHUNK_DAYS = 90
+
+STATS_FIELDS = ('users', 'requests', 'requests_public',
+                'requests_not_same_as', 'requests_public_not_same_as')
+
+
+def get_day_start(day):
+    start = datetime.datetime.combine(day, datetime.time.min)
+    if settings.USE_TZ:
+        start = timezone.make_aware(start, timezone.utc)
+    return start
+
+
+def get_daily_stats(start_date, end_date):
+    """
+    Counts new active users and requests per day from start_date
+    to end_date (inclusive), only days with any counts are returned
+    """
+    date_range = (get_day_start(start_date),
+                  get_day_start(end_date + datetime.timedelta(days=1)))
+    stats = defaultdict(lambda: dict.fromkeys(STATS_FIELDS, 0))
+
+    users = get_user_model().objects.filter(
+        is_active=True,
+        date_joined__gte=date_range[0],
+        date_joined__lt=date_range[1]
+    ).values_list('date_joined', flat=True)
+    for date_joined in users.iterator():
+        stats[date_joined.date()]['users'] += 1
+
+    foi_requests = FoiRequest.objects.filter(
+        is_foi=True,
+        public_body__isnull=False,
+        first_message__gte=date_range[0],
+        first_message__lt=date_range[1]
+    ).values_list('first_message', 'public', 'same_as_id')
+    for first_message, public, same_as_id in foi_requests.iterator():
+        day = stats[first_message.date()]
+        day['requests'] += 1
+        if public:
+            day['requests_public'] += 1
+        if same_as_id is None:
+            day['requests_not_same_as'] += 1
+            if public:
+                day['requests_public_not_same_as'] += 1
+    return stats
+
+
+def update_daily_stats(start_date=None, end_date=None, callback=None):
+    """
+    Replaces the daily statistics from start_date to end_date.
+    Without a start date the last STATS_RECENT_DAYS days are updated.
+    Returns the number of days that have statistics.
+    """
+    if end_date is None:
+        end_date = timezone.now().date()
+    if start_date is None:
+        start_date = end_date - datetime.timedelta(days=STATS_RECENT_DAYS)
+    count = 0
+    chunk_start = start_date
+    while chunk_start <= end_date:
+        chunk_end = min(end_date,
+                        chunk_start + datetime.timedelta(days=STATS_CHUNK_DAYS - 1))
+        stats = get_daily_stats(chunk_start, chunk_end)
+        with transaction.atomic():
+            DailyStats.objects.filter(date__gte=chunk_start,
+                                      date__lte=chunk_end).delete()
+            DailyStats.objects.bulk_create([
+                DailyStats(date=day, **values)
+                for day, values in sorted(stats.items())
+            ])
+        count += len(stats)
+        if callback is not None:
+            callback(chunk_start, chunk_end)
+        chunk_start = chunk_end + datetime.timedelta(days=1)
+    return count
+
+
+def get_attachment_job_key(job_id):
+    return 'froide:foirequest:attachment_job:%s' % job_id
+
+
+def get_attachment_job(job_id):
+    return cache.get(get_attachment_job_key(job_id))
+
+
+def set_attachment_job(job_id, action, done, total, result=None):
+    """
+    Keeps the progress of a background attachment job in the cache,
+    result is set when the job is finished
+    """
+    cache.set(get_attachment_job_key(job_id), {
+        'action': action,
+        'done': done,
+        'total': total,
+        'finished': result is not None,
+        'result': result
+    }, ATTACHMENT_JOB_TIMEOUT)
+
+
+def approve_attachments(attachment_ids, chunk_size=ATTACHMENT_CHUNK_SIZE,
+                        callback=None):
+    """
+    Approves the attachments with one UPDATE per chunk, attachments that
+    are already approved are skipped. attachments_published is sent once
+    per request at the end. Returns the number of approved attachments.
+    """
+    attachment_ids = sorted(set(attachment_ids))
+    published = defaultdict(lambda: ([], set()))
+    approved = 0
+    for i in range(0, len(attachment_ids), chunk_size):
+        chunk = attachment_ids[i:i + chunk_size]
+        rows = list(FoiAttachment.objects.filter(
+            id__in=chunk, approved=False).values_list(
+            'id', 'belongs_to_id', 'belongs_to__request_id'))
+        with transaction.atomic():
+            FoiAttachment.objects.filter(
+                id__in=[row[0] for row in rows]).update(approved=True)
+        for attachment_id, message_id, request_id in rows:
+            if request_id is not None:
+                published[request_id][0].append(attachment_id)
+                published[request_id][1].add(message_id)
+        approved += len(rows)
+        if callback is not None:
+            callback(i + len(chunk), len(attachment_ids))
+
+    foirequests = FoiRequest.objects.filter(
+        id__in=list(published.keys())).select_related('user', 'public_body')
+    for foirequest in foirequests:
+        ids, message_ids = published[foirequest.id]
+        FoiAttachment.attachments_published.send(sender=FoiAttachment,
+            foirequest=foirequest, attachment_ids=ids,
+            message_ids=sorted(message_ids))
+    return approved
+
+
+def get_convertable_attachments(queryset):
+    """
+    Filters the attachments that can be converted
+    and have no converted version yet
+    """
+    convertable = Q(filetype__in=FoiAttachment.CONVERTABLE_FILETYPES)
+    for extension in FoiAttachment.CONVERTABLE_FILETYPES:
+        if extension.startswith('.'):
+            convertable |= Q(name__endswith=extension)
+    return queryset.filter(convertable).filter(converted__isnull=True,
+                                               is_converted=False)
+
+
+def move_attachments_to_blobs(chunk_size=ATTACHMENT_CHUNK_SIZE,
+                              callback=None):
+    """
+    Moves attachment files stored before the blob store into it and
+    deletes the old files. Returns (moved, missing) counts.
+    """
+    attachments = FoiAttachment.objects.filter(content_hash='').exclude(
+        file='').order_by('id')
+    moved, missing = 0, 0
+    last_id = 0
+    while True:
+        chunk = list(attachments.filter(id__gt=last_id)[:chunk_size])
+        if not chunk:
+            break
+        for att in chunk:
+            old_name = att.file.name
+            try:
+                with default_storage.open(old_name, 'rb') as f:
+                    att.store_file(f, old_name)
+            except (IOError, OSError):
+                missing += 1
+                continue
+            # No post_save, the attachment did not change for anyone
+            FoiAttachment.objects.filter(id=att.id).update(
+                file=att.file.name, content_hash=att.content_hash,
+                size=att.size)
+            if not FoiAttachment.objects.filter(file=old_name).exists():
+                default_storage.delete(old_name)
+            moved += 1
+        last_id = chunk[-1].id
+        if callback is not None:
+            callback(moved, missing, last_id)
+    return moved, missing
+
+
+def remove_unreferenced_blobs(max_age=BLOB_MAX_AGE, storage=default_storage):
+    """
+    Deletes stored blobs no attachment refers to anymore and returns
+    their number. Attachments leave their blob in place when deleted or
+    replaced, the transaction may still roll back. Blobs younger than
+    max_age are kept for attachments that are not committed yet.
+    """
+    oldest = datetime.datetime.now() - max_age
+    count = 0
+    for directory, filenames in iter_blob_directories(storage=storage):
+        names = ['%s/%s' % (directory, filename) for filename in filenames]
+        referenced = set(FoiAttachment.objects.filter(
+            file__in=names).values_list('file', flat=True))
+        for name in names:
+            if name in referenced or storage.modified_time(name) > oldest:
+                continue
+            storage.delete(name)
+            count += 1
+    return count
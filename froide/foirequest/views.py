@@ -1,21 +1,24 @@
+from collections import defaultdict
 import datetime
-import re
 import json
 
 from django.utils.six import text_type as str
 from django.conf import settings
-from django.core.files import File
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.files.storage import default_storage
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.paginator import EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse
-from django.utils import timezone
+from django.utils import timezone, translation
+from django.utils.http import urlquote
 from django.shortcuts import render, get_object_or_404, redirect
 from django.views.decorators.http import require_POST
-from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
 from django.utils.translation import ugettext_lazy as _
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.template.defaultfilters import slugify
 from django.contrib import messages
-from django.contrib.auth import get_user_model
 from django.contrib.sitemaps import Sitemap
 
 from haystack.query import SearchQuerySet
@@ -27,20 +30,28 @@ from froide.publicbody.forms import PublicBodyForm
 from froide.publicbody.models import PublicBody, PublicBodyTag, FoiLaw, Jurisdiction
 from froide.frontpage.models import FeaturedRequest
 from froide.helper.utils import render_400, render_403
-from froide.helper.cache import cache_anonymous_page
-from froide.redaction.utils import convert_to_pdf
-
-from .models import FoiRequest, FoiMessage, FoiEvent, FoiAttachment
+from froide.helper.cache import cache_anonymous_page, get_cached_count
+from froide.helper.paginator import (CountedPaginator, KeysetPaginator,
+        InvalidCursor)
+from froide.redaction.utils import (store_pages, make_redaction_job,
+        remove_redaction_job)
+
+from .models import (FoiRequest, FoiMessage, FoiEvent, FoiAttachment,
+        DailyStats)
 from .forms import (RequestForm, ConcreteLawForm, TagFoiRequestForm,
         SendMessageForm, FoiRequestStatusForm, MakePublicBodySuggestionForm,
         PostalReplyForm, PostalAttachmentForm, MessagePublicBodySenderForm,
         EscalationMessageForm)
 from .feeds import LatestFoiRequestsFeed, LatestFoiRequestsFeedAtom
-from .tasks import process_mail
-from .foi_mail import package_foirequest
+from .tasks import process_mail, redact_attachment_task
+from .foi_mail import get_foirequest_archive, iter_file_chunks
+from .utils import (get_message_comments, use_fragment_cache,
+        get_request_cache_version, set_message_cache_versions,
+        get_list_count_key, STATS_START_DATE, prefetch_event_texts)
 
 X_ACCEL_REDIRECT_PREFIX = getattr(settings, 'X_ACCEL_REDIRECT_PREFIX', '')
-User = get_user_model()
+REDACTION_TASK_KEY = 'froide:foiattachment:%s:redaction_task'
+REDACTION_TASK_TIMEOUT = 24 * 60 * 60
 
 
 @cache_anonymous_page(15 * 60)
@@ -60,39 +71,23 @@ def index(request):
 def dashboard(request):
     if not request.user.is_staff:
         return render_403(request)
-    context = {}
-    user = {}
-    start_date = timezone.utc.localize(datetime.datetime(2011, 7, 30))
-    for u in User.objects.filter(
-            is_active=True,
-            date_joined__gte=start_date):
-        d = u.date_joined.date().isoformat()
-        user.setdefault(d, 0)
-        user[d] += 1
-    context['user'] = sorted([{'date': k, 'num': v, 'symbol': 'user'} for k, v in user.items()], key=lambda x: x['date'])
-    total = 0
-    for user in context['user']:
-        total += user['num']
-        user['total'] = total
-    foirequest = {}
-    foi_query = FoiRequest.objects.filter(
-            is_foi=True,
-            public_body__isnull=False,
-            first_message__gte=start_date
-    )
-    if request.GET.get('notsameas'):
-        foi_query = foi_query.filter(same_as__isnull=True)
+    request_field = 'requests'
     if request.GET.get('public'):
-        foi_query = foi_query.filter(public=True)
-    for u in foi_query:
-        d = u.first_message.date().isoformat()
-        foirequest.setdefault(d, 0)
-        foirequest[d] += 1
-    context['foirequest'] = sorted([{'date': k, 'num': v, 'symbol': 'user'} for k, v in foirequest.items()], key=lambda x: x['date'])
-    total = 0
-    for req in context['foirequest']:
-        total += req['num']
-        req['total'] = total
+        request_field += '_public'
+    if request.GET.get('notsameas'):
+        request_field += '_not_same_as'
+    stats = DailyStats.objects.filter(
+        date__gte=STATS_START_DATE
+    ).order_by('date').values_list('date', 'users', request_field)
+    context = {'user': [], 'foirequest': []}
+    totals = {'user': 0, 'foirequest': 0}
+    for date, users, requests in stats:
+        for key, num in (('user', users), ('foirequest', requests)):
+            if not num:
+                continue
+            totals[key] += num
+            context[key].append({'date': date.isoformat(), 'num': num,
+                                 'symbol': 'user', 'total': totals[key]})
     return render(request, 'foirequest/dashboard.html', {'data': json.dumps(context)})
 
 
@@ -104,7 +99,7 @@ def list_requests(request, status=None, topic=None, tag=None,
     manager = FoiRequest.published
     if not_foi:
         manager = FoiRequest.published_not_foi
-    topic_list = PublicBodyTag.objects.get_topic_list()
+    topic_list = PublicBodyTag.objects.get_cached_topic_list()
     if status is None:
         status = request.GET.get(str(_('status')), None)
     status_url = status
@@ -148,9 +143,9 @@ def list_requests(request, status=None, topic=None, tag=None,
             'public_body': public_body
         })
         context['filtered'] = True
-        context['jurisdiction_list'] = Jurisdiction.objects.get_visible()
+        context['jurisdiction_list'] = Jurisdiction.objects.get_cached_visible()
     else:
-        context['jurisdiction_list'] = Jurisdiction.objects.get_visible()
+        context['jurisdiction_list'] = Jurisdiction.objects.get_cached_visible()
         context['filtered'] = False
 
     if feed is not None:
@@ -159,22 +154,37 @@ def list_requests(request, status=None, topic=None, tag=None,
         else:
             klass = LatestFoiRequestsFeedAtom
         return klass(foi_requests, status=status_url, topic=topic,
-            tag=tag, jurisdiction=jurisdiction)(request)
-
-    count = foi_requests.count()
-
-    page = request.GET.get('page')
-    paginator = Paginator(foi_requests, 20)
+            tag=tag, jurisdiction=jurisdiction,
+            after=request.GET.get('after'))(request)
+
+    count_key = get_list_count_key(not_foi=not_foi, status=status,
+        topic=topic, tag=tag, jurisdiction=jurisdiction,
+        public_body=public_body)
+    count = get_cached_count(foi_requests, count_key,
+        settings.FOI_REQUEST_LIST_COUNT_CACHE_TIMEOUT)
+
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    if after is not None or before is not None:
+        paginator = KeysetPaginator(foi_requests, 20)
+        try:
+            foi_requests = paginator.page(after=after, before=before)
+        except InvalidCursor:
+            raise Http404
+        context['keyset_pagination'] = True
+    else:
+        page = request.GET.get('page')
+        paginator = CountedPaginator(foi_requests, 20, count)
 
-    if request.GET.get('all') is not None:
-        if count <= 500:
-            paginator = Paginator(foi_requests, count)
-    try:
-        foi_requests = paginator.page(page)
-    except PageNotAnInteger:
-        foi_requests = paginator.page(1)
-    except EmptyPage:
-        foi_requests = paginator.page(paginator.num_pages)
+        if request.GET.get('all') is not None:
+            if 0 < count <= 500:
+                paginator = CountedPaginator(foi_requests, count, count)
+        try:
+            foi_requests = paginator.page(page)
+        except PageNotAnInteger:
+            foi_requests = paginator.page(1)
+        except EmptyPage:
+            foi_requests = paginator.page(paginator.num_pages)
 
     context.update({
         'page_title': _("FoI Requests"),
@@ -209,6 +219,60 @@ def auth(request, obj_id, code):
         return render_403(request)
 
 
+def prepare_show_messages(request, obj, foi_messages, use_cache=False):
+    message_ids = [m.id for m in foi_messages]
+
+    attachments = defaultdict(list)
+    for att in FoiAttachment.objects.select_related('redacted', 'converted')\
+            .filter(belongs_to__request=obj):
+        attachments[att.belongs_to_id].append(att)
+
+    comments = defaultdict(list)
+    for comment in get_message_comments(request, message_ids):
+        comments[int(comment.object_pk)].append(comment)
+
+    can_edit = request.user == obj.user or request.user.is_staff
+    jurisdictions = None
+    if can_edit:
+        jurisdictions = Jurisdiction.objects.get_cached_visible()
+
+    for message in foi_messages:
+        message.all_attachments = attachments[message.id]
+        message.approved_attachments = []
+        message.not_approved_attachments = []
+        for att in message.all_attachments:
+            att.belongs_to = message
+            if att.approved:
+                message.approved_attachments.append(att)
+            else:
+                message.not_approved_attachments.append(att)
+        message.comment_list = comments[message.id]
+        if can_edit and message.is_response:
+            message.public_body_sender_form = \
+                message.get_public_body_sender_form(
+                    jurisdictions=jurisdictions)
+
+    events = list(FoiEvent.objects.filter(request=obj).select_related(
+            "user", "public_body").order_by("timestamp"))
+    for event in events:
+        event.request = obj
+    prefetch_event_texts(events)
+
+    # Every message gets the events that happened from its
+    # timestamp up to the next message
+    index = len(events)
+    for message in reversed(foi_messages):
+        start = index
+        while start > 0 and events[start - 1].timestamp >= message.timestamp:
+            start -= 1
+        message.events = events[start:index]
+        message.event_ids = ','.join(str(e.id) for e in message.events)
+        index = start
+
+    if use_cache:
+        set_message_cache_versions(foi_messages)
+
+
 def show(request, slug, template_name="foirequest/show.html",
             context=None, status=200):
     try:
@@ -218,39 +282,30 @@ def show(request, slug, template_name="foirequest/show.html",
         raise Http404
     if not obj.is_visible(request.user, pb_auth=request.session.get('pb_auth')):
         return render_403(request)
-    all_attachments = FoiAttachment.objects.select_related('redacted')\
-            .filter(belongs_to__request=obj).all()
-    for message in obj.messages:
+    foi_messages = obj.messages
+    for message in foi_messages:
         message.request = obj
         if message.not_publishable:
             obj.not_publishable_message = message
-        message.all_attachments = filter(
-            lambda x: x.belongs_to_id == message.id, all_attachments)
-        message.approved_attachments = filter(
-            lambda x: x.belongs_to_id == message.id and x.approved,
-            all_attachments
-        )
-        message.not_approved_attachments = filter(
-            lambda x: x.belongs_to_id == message.id and not x.approved,
-            all_attachments
-        )
-        for att in message.all_attachments:
-            att.belongs_to = message
-
-    events = FoiEvent.objects.filter(request=obj).select_related(
-            "user", "request",
-            "public_body").order_by("timestamp")
-
-    event_count = len(events)
-    last_index = event_count
-    for message in reversed(obj.messages):
-        message.events = [ev for ev in events[:last_index]
-                if ev.timestamp >= message.timestamp]
-        last_index = last_index - len(message.events)
 
     if context is None:
         context = {}
 
+    messages_fragment = None
+    if use_fragment_cache(request, obj):
+        context.update({
+            'cache_version': get_request_cache_version(obj),
+            'cache_language': translation.get_language(),
+            'cache_timeout': settings.FOI_REQUEST_FRAGMENT_CACHE_TIMEOUT
+        })
+        messages_fragment = cache.get(make_template_fragment_key(
+            'foirequest_messages', [obj.id, context['cache_version'],
+                                    context['cache_language']]))
+    if messages_fragment is None:
+        prepare_show_messages(request, obj, foi_messages,
+                              use_cache='cache_version' in context)
+    context['messages_fragment'] = messages_fragment
+
     active_tab = 'info'
     if request.user.is_authenticated() and request.user == obj.user:
         if obj.awaits_classification():
@@ -636,7 +691,7 @@ def add_postal_reply(request, slug):
         message.plaintext = ""
         if form.cleaned_data.get('text'):
             message.plaintext = form.cleaned_data.get('text')
-        message.plaintext_redacted = message.get_content()
+        message.plaintext_redacted = message.redact_plaintext()
         message.not_publishable = form.cleaned_data['not_publishable']
         message.save()
         foirequest.last_message = message.timestamp
@@ -652,7 +707,7 @@ def add_postal_reply(request, slug):
                     name=scan_name,
                     size=scan.size,
                     filetype=scan.content_type)
-            att.file.save(scan_name, scan)
+            att.store_file(scan, scan_name)
             att.approved = False
             att.save()
         messages.add_message(request, messages.SUCCESS,
@@ -689,9 +744,8 @@ def add_postal_reply_attachment(request, slug, message_id):
             att = FoiAttachment(belongs_to=message, name=scan_name)
             status_message = _('Your document was added to the message as a '
                 'new attachment.')
-        att.size = scan.size
         att.filetype = scan.content_type
-        att.file.save(scan_name, scan)
+        att.store_file(scan, scan_name)
         att.approved = False
         att.save()
         messages.add_message(request, messages.SUCCESS, status_message)
@@ -848,10 +902,10 @@ def make_same_request(request, slug, message_id):
         return redirect("/")
 
 
-def auth_message_attachment(request, message_id, attachment_name):
-    '''
-    nginx auth view
-    '''
+def get_visible_attachment(request, message_id, attachment_name):
+    """
+    Returns the attachment or None if the user may not see it
+    """
     message = get_object_or_404(FoiMessage, id=int(message_id))
     attachment = get_object_or_404(FoiAttachment, belongs_to=message,
         name=attachment_name)
@@ -859,8 +913,18 @@ def auth_message_attachment(request, message_id, attachment_name):
     pb_auth = request.session.get('pb_auth')
 
     if not foirequest.is_visible(request.user, pb_auth=pb_auth):
-        return render_403(request)
+        return None
     if not attachment.is_visible(request.user, foirequest):
+        return None
+    return attachment
+
+
+def auth_message_attachment(request, message_id, attachment_name):
+    '''
+    nginx auth view
+    '''
+    attachment = get_visible_attachment(request, message_id, attachment_name)
+    if attachment is None:
         return render_403(request)
 
     response = HttpResponse()
@@ -870,7 +934,44 @@ def auth_message_attachment(request, message_id, attachment_name):
     return response
 
 
+def download_message_attachment(request, message_id, attachment_name):
+    '''
+    Serves attachments when nginx does not, their stored files are
+    named by content hash so the name is sent along
+    '''
+    attachment = get_visible_attachment(request, message_id, attachment_name)
+    if attachment is None:
+        return render_403(request)
+    if not attachment.file:
+        raise Http404
+    try:
+        fileobj = attachment.file.storage.open(attachment.file.name, 'rb')
+    except (IOError, OSError):
+        raise Http404
+    response = StreamingHttpResponse(iter_file_chunks(fileobj),
+        content_type=attachment.filetype or 'application/octet-stream')
+    response['Content-Disposition'] = get_content_disposition(attachment.name)
+    return response
+
+
+def get_content_disposition(filename):
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii')
+    ascii_name = ascii_name.replace('\\', '').replace('"', '')
+    header = 'inline; filename="%s"' % ascii_name
+    if ascii_name != filename:
+        header += "; filename*=UTF-8''%s" % urlquote(filename)
+    return header
+
+
+@csrf_exempt
 def redact_attachment(request, slug, attachment_id):
+    # Uploaded pages go to temporary files instead of memory, this has
+    # to be set before the CSRF check reads the POST data
+    request.upload_handlers = [TemporaryFileUploadHandler(request)]
+    return _redact_attachment(request, slug, attachment_id)
+
+
+def get_redaction_attachment(request, slug, attachment_id):
     foirequest = get_object_or_404(FoiRequest, slug=slug)
     if not request.user.is_staff and not request.user == foirequest.user:
         return render_403(request)
@@ -886,39 +987,77 @@ def redact_attachment(request, slug, attachment_id):
 
     if already is not None and not already.can_approve and not request.user.is_staff:
         return render_403(request)
+    return foirequest, attachment
+
+
+def redaction_response(request, url):
+    if request.is_ajax():
+        return HttpResponse(json.dumps({'url': url}),
+                            content_type='application/json')
+    return redirect(url)
+
+
+@csrf_protect
+def _redact_attachment(request, slug, attachment_id):
+    result = get_redaction_attachment(request, slug, attachment_id)
+    if isinstance(result, HttpResponse):
+        return result
+    foirequest, attachment = result
     if request.method == 'POST':
-        path = convert_to_pdf(request.POST)
-        if path is None:
-            return render_400(request)
-        name = attachment.name.rsplit('.', 1)[0]
-        name = re.sub('[^\w\.\-]', '', name)
-        pdf_file = File(open(path, 'rb'))
-        if already:
-            att = already
-        else:
-            att = FoiAttachment(
-                belongs_to=attachment.belongs_to,
-                name=_('%s_redacted.pdf') % name,
-                is_redacted=True,
-                filetype='application/pdf',
-                approved=True,
-                can_approve=True
-            )
-        att.file = pdf_file
-        att.size = pdf_file.size
-        att.approve_and_save()
-        if not attachment.is_redacted:
-            attachment.redacted = att
-            attachment.can_approve = False
-            attachment.approved = False
-            attachment.save()
-        return redirect(att.get_anchor_url())
+        job_id = make_redaction_job()
+        try:
+            page_count = store_pages(request.POST, request.FILES, job_id)
+            if not page_count:
+                remove_redaction_job(job_id)
+                return render_400(request)
+            task = redact_attachment_task.delay(attachment.id, job_id)
+        except Exception:
+            remove_redaction_job(job_id)
+            raise
+        # Only the last redaction of the attachment can be polled
+        cache.set(REDACTION_TASK_KEY % attachment.id, task.id,
+                  REDACTION_TASK_TIMEOUT)
+        if task.ready():
+            url = task.get()
+            if url is None:
+                return render_400(request)
+            return redaction_response(request, url)
+        status_url = reverse('foirequest-redact_attachment_status', kwargs={
+            'slug': foirequest.slug,
+            'attachment_id': attachment.id,
+            'task_id': task.id
+        })
+        if request.is_ajax():
+            return HttpResponse(json.dumps({'status_url': status_url}),
+                                content_type='application/json')
+        return redirect(status_url)
     return render(request, 'foirequest/redact.html', {
         'foirequest': foirequest,
         'attachment': attachment
     })
 
 
+def redact_attachment_status(request, slug, attachment_id, task_id):
+    foirequest = get_object_or_404(FoiRequest, slug=slug)
+    if not request.user.is_staff and not request.user == foirequest.user:
+        return render_403(request)
+    attachment = get_object_or_404(FoiAttachment, pk=int(attachment_id),
+            belongs_to__request=foirequest)
+    if cache.get(REDACTION_TASK_KEY % attachment.id) != task_id:
+        raise Http404
+    task = redact_attachment_task.AsyncResult(task_id)
+    if not task.ready():
+        return HttpResponse(json.dumps({'status': 'pending'}),
+                            content_type='application/json')
+    url = task.result if task.successful() else None
+    if url is None:
+        if request.is_ajax():
+            return HttpResponse(json.dumps({'status': 'failed'}),
+                                content_type='application/json', status=400)
+        return render_400(request)
+    return redaction_response(request, url)
+
+
 @require_POST
 def extend_deadline(request, slug):
     foirequest = get_object_or_404(FoiRequest, slug=slug)
@@ -976,7 +1115,15 @@ def download_foirequest(request, slug):
     foirequest = get_object_or_404(FoiRequest, slug=slug)
     if not request.user.is_staff and not request.user == foirequest.user:
         return render_403(request)
-    response = HttpResponse(package_foirequest(foirequest), content_type='application/zip')
+    archive_name = get_foirequest_archive(foirequest)
+    if settings.USE_X_ACCEL_REDIRECT:
+        response = HttpResponse(content_type='application/zip')
+        response['X-Accel-Redirect'] = '%s%s%s' % (X_ACCEL_REDIRECT_PREFIX,
+            settings.MEDIA_URL, archive_name)
+    else:
+        response = StreamingHttpResponse(
+            iter_file_chunks(default_storage.open(archive_name, 'rb')),
+            content_type='application/zip')
     response['Content-Disposition'] = 'attachment; filename="%s.zip"' % foirequest.pk
     return response
 
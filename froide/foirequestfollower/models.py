@@ -6,11 +6,11 @@ from django.utils.translation import ugettext_lazy as _, ungettext_lazy
 from django.core.urlresolvers import reverse
 from django.dispatch import receiver
 from django.template.loader import render_to_string
-from django.core.mail import send_mail
 from django.utils.crypto import constant_time_compare
 from django.utils.encoding import python_2_unicode_compatible
 
 from froide.foirequest.models import FoiRequest
+from froide.helper.email_sending import send_mail
 
 
 class FoiRequestFollowerManager(models.Manager):
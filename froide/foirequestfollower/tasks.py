@@ -1,5 +1,7 @@
 from datetime import timedelta
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import logging
+import time
 
 from django.utils.six import iteritems
 from django.utils.translation import ugettext as _
@@ -11,18 +13,26 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
 
 from froide.celery import app as celery_app
+from froide.helper.email_sending import mail_queue
 from froide.foirequest.models import FoiRequest, FoiEvent, FoiMessage
+from froide.foirequest.utils import prefetch_event_texts
 
 from .models import FoiRequestFollower
 
+logger = logging.getLogger(__name__)
+
+# Number of digests rendered and sent by one subtask
+DIGEST_CHUNK_SIZE = 100
+
 
 @celery_app.task
 def update_followers(request_id, message, template=None):
     translation.activate(settings.LANGUAGE_CODE)
     try:
         foirequest = FoiRequest.objects.get(id=request_id)
-        FoiRequestFollower.objects.send_update(foirequest, message,
-                                               template=template)
+        with mail_queue():
+            FoiRequestFollower.objects.send_update(foirequest, message,
+                                                   template=template)
     except FoiRequest.DoesNotExist:
         pass
 
@@ -32,38 +42,126 @@ def batch_update():
     return _batch_update()
 
 
+@celery_app.task(ignore_result=True)
+def send_requester_digests(digests):
+    """
+    digests is a list of (user_id, [(request_id, [event text])])
+    """
+    translation.activate(settings.LANGUAGE_CODE)
+    request_ids = [request_id for _user_id, request_updates in digests
+                   for request_id, _events in request_updates]
+    requests = FoiRequest.objects.select_related('user').in_bulk(request_ids)
+    with mail_queue():
+        for user_id, request_updates in digests:
+            request_dict = {}
+            for request_id, events in request_updates:
+                if request_id in requests:
+                    request_dict[requests[request_id]] = {'events': events}
+            if not request_dict:
+                continue
+            user = list(request_dict.keys())[0].user
+            FoiRequest.send_update(request_dict, user=user)
+
+
+@celery_app.task(ignore_result=True)
+def send_follower_digests(digests):
+    """
+    digests is a list of [(follower_id, [event text])], all
+    followers of one digest share the same user or email
+    """
+    translation.activate(settings.LANGUAGE_CODE)
+    follower_ids = [follower_id for follower_updates in digests
+                    for follower_id, _events in follower_updates]
+    followers = FoiRequestFollower.objects.select_related(
+        'user', 'request').in_bulk(follower_ids)
+    with mail_queue():
+        for follower_updates in digests:
+            req_event_dict = {}
+            follower = None
+            for follower_id, events in follower_updates:
+                if follower_id not in followers:
+                    continue
+                follower = followers[follower_id]
+                req_event_dict[follower.request] = {
+                    'unfollow_link': follower.get_unfollow_link(),
+                    'events': events
+                }
+            if follower is None:
+                continue
+            email = None
+            if follower.user is None:
+                email = follower.email
+            FoiRequestFollower.send_update(req_event_dict, user=follower.user,
+                                           email=email)
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.last = time.time()
+        self.stages = OrderedDict()
+
+    def __call__(self, name):
+        now = time.time()
+        self.stages[name] = now - self.last
+        self.last = now
+
+    def __str__(self):
+        return ', '.join('%s %.2fs' % (name, duration)
+                         for name, duration in self.stages.items())
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def _batch_update(update_requester=True, update_follower=True):
+    """
+    Collects comments and events of the last day and sends one digest
+    per requester and per follower. Comments, events, requests and
+    followers are loaded in a fixed number of queries, the digests are
+    rendered and sent in chunks by subtasks.
+    """
     event_black_list = ("message_received", "message_sent", 'set_concrete_law',)
     translation.activate(settings.LANGUAGE_CODE)
+    timer = StageTimer()
     requests = {}
-    users = {}
     gte_date = timezone.now() - timedelta(days=1)
-    updates = {}
+    updates = defaultdict(list)
 
     message_type = ContentType.objects.get_for_model(FoiMessage)
-    for comment in Comment.objects.filter(content_type=message_type,
-            submit_date__gte=gte_date):
+    comments = list(Comment.objects.filter(content_type=message_type,
+            submit_date__gte=gte_date))
+    message_ids = set()
+    for comment in comments:
         try:
-            message = FoiMessage.objects.get(pk=comment.object_pk)
-            if message.request_id not in requests:
-                requests[message.request_id] = message.request
-            updates.setdefault(message.request_id, [])
-            tf = TimeFormat(comment.submit_date)
-            updates[message.request_id].append(
-                (
-                    comment.submit_date,
-                    _("%(time)s: New comment by %(name)s") % {
-                        "time": tf.format(_(settings.TIME_FORMAT)),
-                        "name": comment.name
-                    },
-                    comment.user_id
-                )
-            )
-        except FoiMessage.DoesNotExist:
+            message_ids.add(int(comment.object_pk))
+        except ValueError:
             pass
+    messages = FoiMessage.objects.select_related(
+        'request', 'request__user').in_bulk(message_ids)
+    for comment in comments:
+        try:
+            message = messages[int(comment.object_pk)]
+        except (KeyError, ValueError):
+            continue
+        requests[message.request_id] = message.request
+        tf = TimeFormat(comment.submit_date)
+        updates[message.request_id].append(
+            (
+                comment.submit_date,
+                _("%(time)s: New comment by %(name)s") % {
+                    "time": tf.format(_(settings.TIME_FORMAT)),
+                    "name": comment.name
+                },
+                comment.user_id
+            )
+        )
+    timer('comments')
 
+    digest_count = 0
     if update_requester:
-        requester_updates = defaultdict(dict)
+        requester_updates = defaultdict(list)
         # send out update on comments to request users
         for req_id, request in iteritems(requests):
             if not request.user.is_active:
@@ -77,22 +175,28 @@ def _batch_update(update_requester=True, update_follower=True):
 
             sorted_events = sorted(updates[req_id], key=lambda x: x[0])
 
-            requester_updates[request.user][request] = {
-                'events': [x[1] for x in sorted_events]
-            }
+            requester_updates[request.user_id].append(
+                (req_id, [x[1] for x in sorted_events])
+            )
 
-        for user, request_dict in iteritems(requester_updates):
-            FoiRequest.send_update(request_dict, user=user)
+        digests = list(requester_updates.items())
+        for chunk in chunks(digests, DIGEST_CHUNK_SIZE):
+            send_requester_digests.delay(chunk)
+        digest_count += len(digests)
+        timer('requester digests')
 
     if update_follower:
         # update followers
-
-        for event in FoiEvent.objects.filter(timestamp__gte=gte_date).select_related("request"):
-            if event.event_name in event_black_list:
-                continue
+        events = FoiEvent.objects.filter(
+            timestamp__gte=gte_date
+        ).exclude(
+            event_name__in=event_black_list
+        ).select_related('request', 'user', 'public_body')
+        events = list(events)
+        prefetch_event_texts(events)
+        for event in events:
             if event.request_id not in requests:
                 requests[event.request_id] = event.request
-            updates.setdefault(event.request_id, [])
             tf = TimeFormat(event.timestamp)
             updates[event.request_id].append(
                 (
@@ -104,35 +208,36 @@ def _batch_update(update_requester=True, update_follower=True):
                     event.user_id
                 )
             )
+        timer('events')
+
+        visible_ids = [req_id for req_id, request in iteritems(requests)
+                       if updates[req_id] and request.is_visible(None)]
+        followers = FoiRequestFollower.objects.filter(
+            request_id__in=visible_ids).select_related('user')
+        timer('followers')
 
         # Send out update on comments and event to followers
-        follower_updates = defaultdict(dict)
-        for req_id, request in iteritems(requests):
-            if not updates[req_id]:
+        follower_updates = defaultdict(list)
+        for follower in followers:
+            req_id = follower.request_id
+            if follower.user is None and not follower.confirmed:
                 continue
-            updates[req_id].sort(key=lambda x: x[0])
-            followers = FoiRequestFollower.objects.filter(
-                    request=request).select_related('user')
-            for follower in followers:
-                if follower.user is None and not follower.confirmed:
-                    continue
-                if follower.user and (
-                        not follower.user.is_active or not follower.user.email):
-                    continue
-                if not request.is_visible(None):
-                    continue
-                if not any([x for x in updates[req_id] if x[2] != follower.user_id]):
-                    continue
-                users[follower.user_id] = follower.user
-                ident = follower.user_id or follower.email
-                follower_updates[ident][request] = {
-                    'unfollow_link': follower.get_unfollow_link(),
-                    'events': [x[1] for x in updates[req_id]]
-                }
+            if follower.user and (
+                    not follower.user.is_active or not follower.user.email):
+                continue
+            if not any([x for x in updates[req_id] if x[2] != follower.user_id]):
+                continue
+            ident = follower.user_id or follower.email
+            follower_updates[ident].append(
+                (follower.id, [x[1] for x in sorted(updates[req_id],
+                                                    key=lambda x: x[0])])
+            )
 
-        for user_id, req_event_dict in iteritems(follower_updates):
-            user = users.get(user_id)
-            email = None
-            if user is None:
-                email = user_id
-            FoiRequestFollower.send_update(req_event_dict, user=user, email=email)
+        digests = list(follower_updates.values())
+        for chunk in chunks(digests, DIGEST_CHUNK_SIZE):
+            send_follower_digests.delay(chunk)
+        digest_count += len(digests)
+        timer('follower digests')
+
+    logger.info('Follower batch update: %d digests (%s)', digest_count, timer)
+    return {'digests': digest_count, 'stages': timer.stages}
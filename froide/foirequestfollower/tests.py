@@ -1,16 +1,20 @@
 from __future__ import with_statement
+from datetime import timedelta
 import re
 
 import factory
 
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.utils import timezone
 from django.core.urlresolvers import reverse
 from django.core import mail
 from django.contrib.auth import get_user_model
 from django_comments.forms import CommentForm
 from django_comments.models import Comment
 
-from froide.foirequest.models import FoiRequest
+from froide.foirequest.models import FoiRequest, FoiEvent
 from froide.foirequest.tests import factories
 
 from .models import FoiRequestFollower
@@ -176,3 +180,38 @@ class FoiRequestFollowerTest(TestCase):
         _batch_update()
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].to[0], req.user.email)
+
+    def make_followed_requests(self, count):
+        followers = []
+        for i in range(count):
+            req = factories.FoiRequestFactory.create(site=self.site,
+                                                     visibility=2)
+            factories.FoiEventFactory.create(request=req,
+                timestamp=timezone.now() - timedelta(hours=1))
+            followers.append(FoiRequestFollowerFactory.create(request=req))
+            FoiRequestFollowerFactory.create(request=req, user=None,
+                email='follower%d@example.org' % i)
+        return followers
+
+    def test_batch_update_queries(self):
+        FoiEvent.objects.all().delete()
+        Comment.objects.all().delete()
+        self.make_followed_requests(2)
+        mail.outbox = []
+        with CaptureQueriesContext(connection) as small_queries:
+            result = _batch_update()
+        self.assertEqual(result['digests'], 4)
+        self.assertEqual(len(mail.outbox), 4)
+
+        FoiEvent.objects.all().delete()
+        followers = self.make_followed_requests(10)
+        # One user following several requests gets a single digest
+        FoiRequestFollowerFactory.create(request=followers[1].request,
+                                         user=followers[0].user)
+        mail.outbox = []
+        with CaptureQueriesContext(connection) as queries:
+            result = _batch_update()
+        self.assertEqual(result['digests'], 20)
+        self.assertEqual(len(mail.outbox), 20)
+        self.assertEqual(len(queries), len(small_queries))
+        self.assertIn('comments', result['stages'])
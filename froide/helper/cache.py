@@ -1,3 +1,9 @@
+import copy
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
 from django.views.decorators.cache import cache_page
 
 
@@ -12,3 +18,119 @@ def cache_anonymous_page(time, **cache_kwargs):
             return cache_page(time, **cache_kwargs)(func)(request, *args, **kwargs)
         return _cache_page
     return _cache_anonymous_page
+
+
+def make_cache_version():
+    """
+    Versions start at the current time in milliseconds, so a version
+    key that got evicted never comes back with an old value
+    """
+    return int(time.time() * 1000)
+
+
+def get_cache_versions(keys):
+    versions = cache.get_many(keys)
+    missing = dict((key, make_cache_version())
+                   for key in keys if versions.get(key) is None)
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return versions
+
+
+def get_cache_version(key):
+    return get_cache_versions([key])[key]
+
+
+def bump_cache_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, make_cache_version(), None)
+
+
+def get_cached_count(queryset, key, timeout):
+    """
+    Returns the count of the queryset and keeps it in the cache
+    for timeout seconds, a timeout of 0 always counts
+    """
+    if not timeout:
+        return queryset.count()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+def copy_instance(obj):
+    """
+    Returns a shallow copy of a model instance that can be changed
+    without changing the original
+    """
+    if obj is None:
+        return None
+    obj = copy.copy(obj)
+    obj._state = copy.copy(obj._state)
+    return obj
+
+
+class ReferenceCache(object):
+    """
+    Rarely changing data (laws, jurisdictions, topics) kept in a per
+    process copy and in the shared cache. The shared cache holds a
+    generation counter that is checked at most every check_interval
+    seconds, bumping it makes all processes drop their copies.
+
+    Values are shared by all callers in the process and must not be
+    changed, model instances are handed out with copy_instance.
+    """
+    def __init__(self, name, check_interval=5):
+        self.name = name
+        self.check_interval = check_interval
+        self.generation_key = 'froide:reference:%s:generation' % name
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.local = {}
+            self.generation = None
+            self.checked = 0
+
+    def get_generation(self):
+        now = time.time()
+        if (self.generation is None or
+                now - self.checked >= self.check_interval):
+            generation = get_cache_version(self.generation_key)
+            with self.lock:
+                if generation != self.generation:
+                    self.local = {}
+                    self.generation = generation
+                self.checked = now
+        return self.generation
+
+    def get(self, key, build):
+        """
+        Returns the value for key, build is called to create
+        it when neither copy has it
+        """
+        timeout = settings.REFERENCE_DATA_CACHE_TIMEOUT
+        if not timeout:
+            return build()
+        generation = self.get_generation()
+        local = self.local
+        if key in local:
+            return local[key]
+        shared_key = 'froide:reference:%s:%s:%s' % (self.name, generation, key)
+        # Wrapped so that None can be cached as well
+        value = cache.get(shared_key)
+        if value is None:
+            value = (build(),)
+            cache.set(shared_key, value, timeout)
+        local[key] = value[0]
+        return value[0]
+
+    def invalidate(self):
+        bump_cache_version(self.generation_key)
+        self.clear()
@@ -0,0 +1,206 @@
+"""
+Converter process for froide.helper.document_conversion
+
+Runs as a script without Django: converts the documents it is sent to
+PDF with one LibreOffice instance that is started once and then driven
+over UNO, so LibreOffice starts once per converter instead of once per
+document. The profile directory is passed by the pool, which removes it.
+
+    python conversion_worker.py /usr/bin/soffice /tmp/froide_converter_x
+
+UNO needs a Python interpreter with the LibreOffice bindings (e.g. the
+python3-uno package, see DOC_CONVERSION_PYTHON). Without them every
+document is converted by its own soffice --convert-to call.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+try:
+    import uno
+except ImportError:
+    uno = None
+
+OFFICE_START_TIMEOUT = 60
+
+PDF_FILTERS = (
+    ('com.sun.star.sheet.SpreadsheetDocument', 'calc_pdf_Export'),
+    ('com.sun.star.presentation.PresentationDocument', 'impress_pdf_Export'),
+    ('com.sun.star.drawing.DrawingDocument', 'draw_pdf_Export'),
+    ('com.sun.star.text.WebDocument', 'writer_web_pdf_Export'),
+)
+DEFAULT_PDF_FILTER = 'writer_pdf_Export'
+
+
+def get_output_file(input_path, outdir):
+    filename = os.path.basename(input_path)
+    name = filename.rsplit('.', 1)[0]
+    return os.path.join(outdir, '%s.pdf' % name)
+
+
+def get_office_env(profile_dir):
+    env = dict(os.environ)
+    env['HOME'] = profile_dir
+    return env
+
+
+def convert(binary_name, profile_dir, input_path, outdir):
+    output_file = get_output_file(input_path, outdir)
+    arguments = [
+        binary_name,
+        "--headless",
+        "-env:UserInstallation=file://%s" % profile_dir,
+        "--convert-to",
+        "pdf",
+        "--outdir",
+        outdir,
+        input_path
+    ]
+    p = subprocess.Popen(arguments, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         env=get_office_env(profile_dir))
+    out, err = p.communicate()
+    if p.returncode == 0 and os.path.exists(output_file):
+        return {'output': output_file}
+    return {'error': err.decode('utf-8', 'replace') or 'No output'}
+
+
+def make_properties(**kwargs):
+    from com.sun.star.beans import PropertyValue
+
+    properties = []
+    for name, value in kwargs.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        properties.append(prop)
+    return tuple(properties)
+
+
+class Office(object):
+    """
+    A LibreOffice instance listening on a pipe, started on first use
+    and again after it died
+    """
+
+    def __init__(self, binary_name, profile_dir):
+        self.binary_name = binary_name
+        self.profile_dir = profile_dir
+        self.pipe_name = 'froide_converter_%d' % os.getpid()
+        self.process = None
+        self.desktop = None
+
+    def start(self):
+        arguments = [
+            self.binary_name,
+            "--headless",
+            "--invisible",
+            "--nologo",
+            "--nodefault",
+            "--norestore",
+            "--nolockcheck",
+            "-env:UserInstallation=file://%s" % self.profile_dir,
+            "--accept=pipe,name=%s;urp;StarOffice.ComponentContext" % (
+                self.pipe_name)
+        ]
+        with open(os.devnull, 'wb') as devnull:
+            self.process = subprocess.Popen(arguments, stdout=devnull,
+                stderr=devnull, env=get_office_env(self.profile_dir))
+        self.desktop = self.connect()
+
+    def connect(self):
+        from com.sun.star.connection import NoConnectException
+
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext(
+            'com.sun.star.bridge.UnoUrlResolver', local)
+        url = 'uno:pipe,name=%s;urp;StarOffice.ComponentContext' % (
+            self.pipe_name)
+        deadline = time.time() + OFFICE_START_TIMEOUT
+        while True:
+            try:
+                context = resolver.resolve(url)
+                break
+            except NoConnectException:
+                if (self.process.poll() is not None or
+                        time.time() > deadline):
+                    self.stop()
+                    raise RuntimeError('LibreOffice did not start')
+                time.sleep(0.2)
+        return context.ServiceManager.createInstanceWithContext(
+            'com.sun.star.frame.Desktop', context)
+
+    def stop(self):
+        self.desktop = None
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def is_alive(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self.desktop.getFrames()
+        except Exception:
+            return False
+        return True
+
+    def convert(self, input_path, outdir):
+        if not self.is_alive():
+            self.stop()
+            self.start()
+        output_file = get_output_file(input_path, outdir)
+        document = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(input_path)), '_blank',
+            0, make_properties(Hidden=True, ReadOnly=True))
+        if document is None:
+            return {'error': 'Could not load document'}
+        try:
+            filter_name = DEFAULT_PDF_FILTER
+            for service, name in PDF_FILTERS:
+                if document.supportsService(service):
+                    filter_name = name
+                    break
+            document.storeToURL(
+                uno.systemPathToFileUrl(os.path.abspath(output_file)),
+                make_properties(FilterName=filter_name))
+        finally:
+            try:
+                document.close(True)
+            except Exception:
+                document.dispose()
+        return {'output': output_file}
+
+
+def main(argv):
+    binary_name = argv[1]
+    profile_dir = argv[2]
+    office = None
+    if uno is not None:
+        office = Office(binary_name, profile_dir)
+    try:
+        for line in iter(sys.stdin.readline, ''):
+            try:
+                request = json.loads(line)
+                if office is not None:
+                    result = office.convert(request['input'],
+                                            request['outdir'])
+                else:
+                    result = convert(binary_name, profile_dir,
+                                     request['input'], request['outdir'])
+            except Exception as e:
+                result = {'error': str(e)}
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+    finally:
+        if office is not None:
+            office.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,3 +1,4 @@
+from django.core.exceptions import FieldDoesNotExist
 from django.utils import six
 from django.http import StreamingHttpResponse
 
@@ -10,15 +11,6 @@ def export_csv_response(generator, name='export.csv'):
     return response
 
 
-class FakeFile(object):
-    # unicodecsv doesn't return values
-    # so temp store them in here
-    def write(self, string):
-        self._last_string = string
-        if six.PY3:
-            self._last_string = self._last_string.encode('utf-8')
-
-
 def get_dict(self, fields):
     d = {}
     if 'tags' in fields:
@@ -39,23 +31,96 @@ def get_dict(self, fields):
     return d
 
 
-def export_csv(queryset, fields):
+EXPORT_CHUNK_SIZE = 500
+
+
+def get_related_lookups(model, fields):
+    """
+    Returns the select_related and prefetch_related lookups
+    that get_dict needs for the given fields
+    """
+    select_related = set()
+    prefetch_related = set()
+    for field in fields:
+        if field == 'tags':
+            prefetch_related.add(field)
+            continue
+        opts = model._meta
+        path = []
+        for name in field.split('__')[:-1]:
+            try:
+                model_field = opts.get_field(name)
+            except FieldDoesNotExist:
+                break
+            if not (model_field.many_to_one or model_field.one_to_one):
+                break
+            path.append(name)
+            opts = model_field.related_model._meta
+        if path:
+            select_related.add('__'.join(path))
+    return sorted(select_related), sorted(prefetch_related)
+
+
+def iterate_chunks(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields lists of objects ordered by primary key, every list
+    is loaded with its own query so memory stays bounded
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        qs = queryset
+        if last_pk is not None:
+            qs = qs.filter(pk__gt=last_pk)
+        chunk = list(qs[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1].pk
+
+
+def export_csv(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields the CSV of the queryset in pieces of chunk_size rows,
+    in primary key order. Related objects that the fields refer to
+    are loaded with a fixed number of queries per chunk.
+    """
     if six.PY3:
         import csv
+        buf = six.StringIO()
+        writer = csv.DictWriter(buf, fields)
     else:
         import unicodecsv as csv
+        buf = six.BytesIO()
+        writer = csv.DictWriter(buf, fields, encoding='utf-8')
+
+    def flush():
+        value = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        if six.PY3:
+            value = value.encode('utf-8')
+        return value
+
+    select_related, prefetch_related = get_related_lookups(
+        queryset.model, fields)
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
 
-    f = FakeFile()
-    writer = csv.DictWriter(f, fields)
     writer.writeheader()
-    yield f._last_string
-    for obj in queryset:
-        if hasattr(obj, 'get_dict'):
-            d = obj.get_dict(fields)
-        else:
-            d = get_dict(obj, fields)
-        writer.writerow(d)
-        yield f._last_string
+    yield flush()
+    for chunk in iterate_chunks(queryset, chunk_size):
+        for obj in chunk:
+            if hasattr(obj, 'get_dict'):
+                d = obj.get_dict(fields)
+            else:
+                d = get_dict(obj, fields)
+            writer.writerow(d)
+        yield flush()
 
 
 def export_csv_bytes(generator):
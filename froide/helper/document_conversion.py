@@ -0,0 +1,249 @@
+"""
+Pool of long running document converter processes
+
+Every converter process gets a profile directory as last argument,
+reads one JSON request per line on stdin, ``{"input": path, "outdir":
+path}``, and answers with one JSON line on stdout, ``{"output": path}``
+or ``{"error": message}``. Converters stay alive between documents, so
+their startup cost is paid once per process instead of once per
+document. Converters that crash or hang are killed together with
+everything they started and restarted.
+
+Documents of one process are converted in priority order, lower numbers
+first. Across Celery workers low priority conversions can be sent to
+their own queue, see DOC_CONVERSION_LOW_PRIORITY_QUEUE.
+"""
+import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.utils.six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'conversion_worker.py')
+
+
+class ConversionError(Exception):
+    pass
+
+
+def get_worker_command(binary_name):
+    python = settings.DOC_CONVERSION_PYTHON or sys.executable
+    return [python, WORKER_SCRIPT, binary_name]
+
+
+class ConverterProcess(object):
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+        self.profile_dir = None
+        self.starts = 0
+
+    def start(self):
+        # Runs in its own process group so that stopping it also
+        # stops the office processes it started
+        self.profile_dir = tempfile.mkdtemp(prefix='froide_converter_')
+        self.process = subprocess.Popen(self.command + [self.profile_dir],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            preexec_fn=os.setsid)
+        self.starts += 1
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.process.wait()
+            self.process = None
+        if self.profile_dir is not None:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def read_line(self, timeout):
+        """
+        Reads the answer in a thread so that a hanging
+        converter can be timed out, returns None on timeout
+        """
+        lines = []
+        stdout = self.process.stdout
+        reader = threading.Thread(target=lambda: lines.append(stdout.readline()))
+        reader.daemon = True
+        reader.start()
+        reader.join(timeout)
+        if reader.is_alive():
+            return None
+        return lines[0]
+
+    def convert(self, input_path, outdir, timeout):
+        if not self.is_alive():
+            self.stop()
+            self.start()
+        request = json.dumps({'input': input_path, 'outdir': outdir})
+        try:
+            self.process.stdin.write(request.encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            self.stop()
+            raise ConversionError('Converter process died')
+        line = self.read_line(timeout)
+        if line is None:
+            self.stop()
+            raise ConversionError('Conversion timed out after %ds' % timeout)
+        if not line:
+            self.stop()
+            raise ConversionError('Converter process died')
+        try:
+            result = json.loads(line.decode('utf-8'))
+        except ValueError:
+            self.stop()
+            raise ConversionError('Invalid converter answer %r' % line)
+        if result.get('error') or not result.get('output'):
+            raise ConversionError(result.get('error', 'No output'))
+        return result['output']
+
+
+class ConversionJob(object):
+    def __init__(self, input_path, outdir, priority, timeout):
+        self.input_path = input_path
+        self.outdir = outdir
+        self.priority = priority
+        self.timeout = timeout
+        self.output = None
+        self.error = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.finished = threading.Event()
+
+    def wait(self, timeout=None):
+        """
+        Returns the path of the converted file or raises ConversionError
+        """
+        if not self.finished.wait(timeout):
+            raise ConversionError('Conversion did not finish in time')
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+    @property
+    def timing(self):
+        """
+        Seconds spent waiting in the queue and converting
+        """
+        timing = {}
+        if self.started_at is not None:
+            timing['queued'] = self.started_at - self.queued_at
+        if self.finished_at is not None:
+            timing['conversion'] = self.finished_at - self.started_at
+        return timing
+
+
+class ConversionPool(object):
+    def __init__(self, command, workers=1, timeout=300):
+        self.command = command
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.processes = []
+
+    def start_workers(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                process = ConverterProcess(self.command)
+                thread = threading.Thread(target=self.run_worker,
+                                          args=(process,))
+                thread.daemon = True
+                self.processes.append(process)
+                self.threads.append(thread)
+                thread.start()
+
+    def submit(self, input_path, outdir, priority=PRIORITY_NORMAL,
+               timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        job = ConversionJob(input_path, outdir, priority, timeout)
+        self.queue.put((priority, next(self.counter), job))
+        self.start_workers()
+        return job
+
+    def convert(self, input_path, outdir, priority=PRIORITY_NORMAL,
+                timeout=None):
+        job = self.submit(input_path, outdir, priority=priority,
+                          timeout=timeout)
+        return job.wait()
+
+    def run_worker(self, process):
+        while True:
+            priority, _, job = self.queue.get()
+            if job is None:
+                process.stop()
+                return
+            job.started_at = time.time()
+            try:
+                job.output = process.convert(job.input_path, job.outdir,
+                                             job.timeout)
+            except ConversionError as e:
+                job.error = e
+            except Exception as e:
+                logger.exception('Converting %s failed', job.input_path)
+                job.error = ConversionError(str(e))
+                process.stop()
+            job.finished_at = time.time()
+            if job.error is not None:
+                logger.warning('Converting %s failed after %.2fs: %s',
+                               job.input_path, job.timing['conversion'],
+                               job.error)
+            else:
+                logger.info('Converted %s in %.2fs (queued %.2fs)',
+                            job.input_path, job.timing['conversion'],
+                            job.timing['queued'])
+            job.finished.set()
+
+    def shutdown(self):
+        with self.lock:
+            threads, self.threads = self.threads, []
+            self.processes = []
+        for _ in threads:
+            # Sorts after all queued documents
+            self.queue.put((float('inf'), next(self.counter), None))
+        for thread in threads:
+            thread.join()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_conversion_pool(binary_name):
+    """
+    Returns the pool of this process for the converter binary
+    """
+    with _pools_lock:
+        if binary_name not in _pools:
+            _pools[binary_name] = ConversionPool(
+                get_worker_command(binary_name),
+                workers=settings.DOC_CONVERSION_WORKERS,
+                timeout=settings.DOC_CONVERSION_TIMEOUT)
+        return _pools[binary_name]
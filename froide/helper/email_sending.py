@@ -0,0 +1,225 @@
+"""
+Sending of outgoing mail
+
+Inside a ``mail_queue()`` block mails sent with ``send_mail`` and
+``send_message`` are collected and sent when the block ends, over a few
+persistent connections per mail server and rate limited per recipient
+domain. Outside of such a block mails are sent right away.
+"""
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def get_recipient_domain(message):
+    recipients = message.recipients()
+    if not recipients:
+        return ''
+    return recipients[0].rsplit('@', 1)[-1].lower()
+
+
+class DomainRateLimiter(object):
+    """
+    Spaces out mails to the same domain so that no domain gets
+    more than rate mails per second, shared between threads
+    """
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.interval = 1.0 / rate if rate else 0
+        self.clock = clock
+        self.sleep = sleep
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, domain):
+        if not self.interval:
+            return
+        with self.lock:
+            now = self.clock()
+            slot = max(now, self.next_slot.get(domain, now))
+            self.next_slot[domain] = slot + self.interval
+        if slot > now:
+            self.sleep(slot - now)
+
+
+class MailQueue(object):
+    def __init__(self, connections=None, domain_rate=None, limiter=None):
+        if connections is None:
+            connections = settings.EMAIL_QUEUE_CONNECTIONS
+        if domain_rate is None:
+            domain_rate = settings.EMAIL_QUEUE_DOMAIN_RATE
+        if limiter is None:
+            limiter = DomainRateLimiter(domain_rate)
+        self.connections = max(1, connections)
+        self.limiter = limiter
+        self.clear()
+
+    def __len__(self):
+        return sum(len(items) for items in self.messages.values())
+
+    def clear(self):
+        self.messages = defaultdict(list)
+        self.connection_kwargs = {}
+
+    def add(self, message, connection_kwargs=None, fail_silently=False,
+            on_sent=None):
+        """
+        Queues an EmailMessage, connection_kwargs are passed to
+        get_connection and mails with equal ones share connections.
+        on_sent is called with the message right after it was sent,
+        possibly from another thread.
+        """
+        connection_kwargs = dict(connection_kwargs or {})
+        connection_kwargs.pop('fail_silently', None)
+        key = tuple(sorted(connection_kwargs.items()))
+        self.connection_kwargs[key] = connection_kwargs
+        self.messages[key].append((message, fail_silently, on_sent))
+
+    def partition(self, items):
+        """
+        Spreads the mails over the connections, with rate limiting the
+        recipient domains are interleaved so a rate limited domain does
+        not hold up one connection
+        """
+        ordered = items
+        if self.limiter.interval:
+            by_domain = OrderedDict()
+            for item in items:
+                domain = get_recipient_domain(item[0])
+                by_domain.setdefault(domain, []).append(item)
+            ordered = []
+            queues = list(by_domain.values())
+            while queues:
+                ordered.extend(queue.pop(0) for queue in queues)
+                queues = [queue for queue in queues if queue]
+        count = min(self.connections, len(ordered))
+        return [ordered[i::count] for i in range(count)]
+
+    def send_partition(self, connection_kwargs, items):
+        sent = 0
+        errors = []
+        connection = get_connection(**connection_kwargs)
+        try:
+            connection.open()
+        except Exception:
+            # send_messages opens the connection itself and fails
+            # for each mail on its own
+            pass
+        try:
+            for message, fail_silently, on_sent in items:
+                self.limiter.wait(get_recipient_domain(message))
+                try:
+                    count = connection.send_messages([message]) or 0
+                    sent += count
+                    if count and on_sent is not None:
+                        on_sent(message)
+                except Exception as e:
+                    logger.exception('Sending mail to %s failed',
+                                     ', '.join(message.recipients()))
+                    if not fail_silently:
+                        errors.append(e)
+                    # The connection may be broken after an error,
+                    # if reopening fails the next send tries again
+                    connection.close()
+                    try:
+                        connection.open()
+                    except Exception:
+                        pass
+        finally:
+            connection.close()
+        return sent, errors
+
+    def flush(self, fail_silently=False):
+        """
+        Sends all queued mails and returns the number of sent mails.
+        Mails that fail do not stop the others, the first error is
+        raised at the end unless the mails were queued fail_silently.
+        """
+        messages, connection_kwargs = self.messages, self.connection_kwargs
+        self.clear()
+        sent = 0
+        errors = []
+        start = time.time()
+        for key, items in messages.items():
+            partitions = self.partition(items)
+            if len(partitions) == 1:
+                results = [self.send_partition(connection_kwargs[key],
+                                               partitions[0])]
+            else:
+                pool = ThreadPool(len(partitions))
+                try:
+                    results = pool.map(
+                        lambda items: self.send_partition(
+                            connection_kwargs[key], items),
+                        partitions)
+                finally:
+                    pool.close()
+                    pool.join()
+            for partition_sent, partition_errors in results:
+                sent += partition_sent
+                errors.extend(partition_errors)
+        if sent or errors:
+            logger.info('Sent %d mails in %.2fs, %d failed', sent,
+                        time.time() - start, len(errors))
+        if errors and not fail_silently:
+            raise errors[0]
+        return sent
+
+
+def get_mail_queue():
+    return getattr(_local, 'queue', None)
+
+
+@contextmanager
+def mail_queue(**kwargs):
+    """
+    Collects all mails sent in this thread inside the block and
+    sends them in one batch at the end of the block
+    """
+    previous = get_mail_queue()
+    queue = MailQueue(**kwargs)
+    _local.queue = queue
+    try:
+        yield queue
+    except Exception:
+        _local.queue = previous
+        # Whatever was done before the error should still be notified
+        queue.flush(fail_silently=True)
+        raise
+    finally:
+        _local.queue = previous
+    queue.flush()
+
+
+def send_message(message, connection_kwargs=None, fail_silently=False,
+                 on_sent=None):
+    queue = get_mail_queue()
+    if queue is not None:
+        queue.add(message, connection_kwargs=connection_kwargs,
+                  fail_silently=fail_silently, on_sent=on_sent)
+        return 1
+    connection_kwargs = dict(connection_kwargs or {})
+    connection_kwargs['fail_silently'] = fail_silently
+    sent = get_connection(**connection_kwargs).send_messages([message])
+    if sent and on_sent is not None:
+        on_sent(message)
+    return sent
+
+
+def send_mail(subject, message, from_email, recipient_list,
+              fail_silently=False, headers=None, on_sent=None):
+    """
+    Like django.core.mail.send_mail, but queued inside mail_queue()
+    """
+    email = EmailMessage(subject, message, from_email, recipient_list,
+                         headers=headers)
+    return send_message(email, fail_silently=fail_silently, on_sent=on_sent)
@@ -9,38 +9,143 @@ from datetime import datetime, timedelta
 import time
 
 import base64
+import binascii
 
 try:
     from email.header import decode_header
     from email.parser import BytesParser as Parser
+    from email.parser import BytesHeaderParser as HeaderParser
 except ImportError:
     from email.Header import decode_header
-    from email.Parser import Parser
+    from email.Parser import Parser, HeaderParser
 
 from email.utils import parseaddr, formataddr, parsedate_tz, getaddresses
 import imaplib
+from multiprocessing.pool import ThreadPool
 import re
+import tempfile
+import threading
 
+from django.core.files import File
 from django.utils.six import BytesIO, text_type as str, binary_type as bytes
 
 import pytz
 
 
-def get_unread_mails(host, port, user, password, ssl=True):
-    klass = imaplib.IMAP4
-    if ssl:
-        klass = imaplib.IMAP4_SSL
-    mail = klass(host, port)
-    mail.login(user, password)
-    try:
-        status, count = mail.select('Inbox')
-        typ, data = mail.search(None, 'UNSEEN')
-        for num in data[0].split():
-            status, data = mail.fetch(num, '(RFC822)')
-            yield data[0][1]
-    finally:
-        mail.close()
-        mail.logout()
+IMAP_UID_RE = re.compile(br'UID (\d+)')
+IMAP_UIDVALIDITY_RE = re.compile(br'UIDVALIDITY (\d+)')
+
+
+class ImapMailFetcher(object):
+    """
+    Fetches unseen mails by UID in batches over a small pool of
+    IMAP connections. Mails are fetched with BODY.PEEK[] so they are
+    only flagged as seen when mark_seen is called after processing.
+    """
+
+    def __init__(self, host, port, user, password, ssl=True,
+                 mailbox='Inbox', batch_size=20, connections=2,
+                 connection_factory=None):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.ssl = ssl
+        self.mailbox = mailbox
+        self.batch_size = max(batch_size, 1)
+        self.connections = max(connections, 1)
+        self.connection_factory = connection_factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open_connections = []
+
+    def connect(self):
+        if self.connection_factory is not None:
+            mail = self.connection_factory(self.host, self.port)
+        else:
+            klass = imaplib.IMAP4
+            if self.ssl:
+                klass = imaplib.IMAP4_SSL
+            mail = klass(self.host, self.port)
+        mail.login(self.user, self.password)
+        mail.select(self.mailbox)
+        return mail
+
+    def get_connection(self):
+        mail = getattr(self._local, 'connection', None)
+        if mail is None:
+            mail = self.connect()
+            self._local.connection = mail
+            with self._lock:
+                self._open_connections.append(mail)
+        return mail
+
+    def close(self):
+        with self._lock:
+            connections = self._open_connections
+            self._open_connections = []
+        for mail in connections:
+            try:
+                mail.close()
+                mail.logout()
+            except imaplib.IMAP4.error:
+                pass
+        self._local = threading.local()
+
+    def get_uidvalidity(self):
+        typ, data = self.get_connection().status(self.mailbox, '(UIDVALIDITY)')
+        match = IMAP_UIDVALIDITY_RE.search(data[0])
+        if match is None:
+            return None
+        return int(match.group(1))
+
+    def get_unread_uids(self):
+        typ, data = self.get_connection().uid('search', None, 'UNSEEN')
+        return sorted(int(uid) for uid in data[0].split())
+
+    def get_batches(self, uids):
+        return [uids[i:i + self.batch_size]
+                for i in range(0, len(uids), self.batch_size)]
+
+    def fetch_batch(self, uids):
+        uid_set = ','.join(str(uid) for uid in uids)
+        typ, data = self.get_connection().uid('fetch', uid_set,
+                                              '(UID BODY.PEEK[])')
+        mails = []
+        for part in data:
+            if not isinstance(part, tuple):
+                continue
+            match = IMAP_UID_RE.search(part[0])
+            if match is None:
+                continue
+            mails.append((int(match.group(1)), part[1]))
+        return sorted(mails, key=lambda x: x[0])
+
+    def fetch_batches(self, uids):
+        """
+        Yields lists of (uid, rfc_data) in UID order. Batches are
+        fetched ahead in parallel, at most two per connection.
+        """
+        batches = self.get_batches(uids)
+        if self.connections == 1 or len(batches) <= 1:
+            for batch in batches:
+                yield self.fetch_batch(batch)
+            return
+        pool = ThreadPool(min(self.connections, len(batches)))
+        window = self.connections * 2
+        try:
+            for i in range(0, len(batches), window):
+                for mails in pool.imap(self.fetch_batch, batches[i:i + window]):
+                    yield mails
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def mark_seen(self, uids):
+        if not uids:
+            return
+        uid_set = ','.join(str(uid) for uid in uids)
+        self.get_connection().uid('store', uid_set, '+FLAGS', '(\\Seen)')
 
 
 def make_address(email, name=None):
@@ -53,8 +158,128 @@ class UnsupportedMailFormat(Exception):
     pass
 
 
+# Attachments up to this size are kept in memory while streaming
+MAX_MEMORY_SIZE = 1024 * 1024
+LINE_LIMIT = 64 * 1024
+HEADER_LINE_RE = re.compile(br'^([^\s:]+:|[ \t]|From )')
+NOT_BASE64_RE = re.compile(br'[^A-Za-z0-9+/=]')
+
+
+class LineReader(object):
+    """
+    Reads a binary file line by line, longer lines are returned in
+    pieces of at most limit bytes. Every piece is returned with a flag
+    that tells if it starts a line, one piece can be pushed back.
+    """
+
+    def __init__(self, fileobj, limit=LINE_LIMIT):
+        self.file = fileobj
+        self.limit = limit
+        self.line_start = True
+        self.pushed = None
+
+    def readline(self):
+        if self.pushed is not None:
+            piece, self.pushed = self.pushed, None
+            return piece
+        line = self.file.readline(self.limit)
+        piece = (line, self.line_start)
+        self.line_start = line.endswith(b'\n')
+        return piece
+
+    def push_back(self, piece):
+        self.pushed = piece
+
+
+class TransferDecoder(object):
+    """
+    Decodes a transfer encoded body into a file while it is read
+    """
+
+    def __init__(self, encoding, fileobj):
+        self.encoding = (encoding or '').strip().lower()
+        self.file = fileobj
+        self.size = 0
+        self.rest = b''
+        self.carriage_return = False
+
+    def translate_newlines(self, data):
+        """
+        Turns CRLF and CR into LF like the parser of parse does
+        """
+        if self.carriage_return:
+            data = b'\r' + data
+        self.carriage_return = data.endswith(b'\r')
+        if self.carriage_return:
+            # Its LF may come with the next data
+            data = data[:-1]
+        return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+    def write_decoded(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def write_base64(self, data):
+        try:
+            self.write_decoded(binascii.a2b_base64(data))
+        except binascii.Error:
+            # Keep what can be decoded of broken payloads
+            for i in range(0, len(data), 4):
+                try:
+                    self.write_decoded(binascii.a2b_base64(data[i:i + 4]))
+                except binascii.Error:
+                    pass
+
+    def write(self, data):
+        if self.encoding == 'base64':
+            data = self.rest + NOT_BASE64_RE.sub(b'', data)
+            end = len(data) - len(data) % 4
+            self.rest = data[end:]
+            self.write_base64(data[:end])
+            return
+        data = self.translate_newlines(data)
+        if self.encoding == 'quoted-printable':
+            # Escapes must not be split, so decode whole lines only
+            data = self.rest + data
+            if not data.endswith(b'\n') and len(data) < LINE_LIMIT:
+                self.rest = data
+                return
+            self.rest = b''
+            self.write_decoded(binascii.a2b_qp(data))
+        else:
+            self.write_decoded(data)
+
+    def close(self):
+        rest, self.rest = self.rest, b''
+        if self.encoding == 'base64':
+            if len(rest) % 4 > 1:
+                self.write_base64(rest + b'=' * (4 - len(rest) % 4))
+        else:
+            if self.carriage_return:
+                self.carriage_return = False
+                rest += b'\n'
+            if rest and self.encoding == 'quoted-printable':
+                rest = binascii.a2b_qp(rest)
+            if rest:
+                self.write_decoded(rest)
+        self.file.seek(0)
+
+
+class EmailAttachment(File):
+    """
+    Attachment of a streamed mail in a temporary file
+    """
+
+    def __init__(self, fileobj, size):
+        super(EmailAttachment, self).__init__(fileobj)
+        self.size = size
+
+
 class EmailParser(object):
 
+    def __init__(self, max_memory_size=MAX_MEMORY_SIZE):
+        self.max_memory_size = max_memory_size
+
     def parse_dispositions(self, dispo):
         dispos = dispo.strip().split(";", 1)
         dispo_name = dispos[0].lower()
@@ -68,45 +293,59 @@ class EmailParser(object):
             dispo_dict[name] = self.parse_header_field(value)
         return dispo_name, dispo_dict
 
-    def parse_attachment(self, message_part):
+    def get_attachment_dispositions(self, message_part):
+        """
+        Returns the disposition parameters of attachment parts
+        and None for all other parts
+        """
         content_disposition = message_part.get("Content-Disposition", None)
         if content_disposition:
             dispo_type, dispo_dict = self.parse_dispositions(content_disposition)
             if dispo_type == "attachment" or (dispo_type == 'inline' and
                     'filename' in dispo_dict):
-                content_type = message_part.get("Content-Type", None)
-                file_data = message_part.get_payload(decode=True)
-                if file_data is None:
-                    payloads = message_part.get_payload()
-                    file_data = '\n\n'.join([p.as_string() for p in payloads]).encode('utf-8')
-                attachment = BytesIO(file_data)
-                attachment.content_type = message_part.get_content_type()
-                attachment.size = len(file_data)
-                attachment.name = None
-                attachment.create_date = None
-                attachment.mod_date = None
-                attachment.read_date = None
-                if "filename" in dispo_dict:
-                    attachment.name = dispo_dict['filename']
-                if content_type:
-                    _, content_dict = self.parse_dispositions(content_type)
-                    if 'name' in content_dict:
-                        attachment.name = content_dict['name']
-                if attachment.name is None and content_type == 'message/rfc822':
-                    p = Parser()
-                    msgobj = p.parse(BytesIO(attachment.getvalue()))
-                    subject = self.parse_header_field(msgobj['Subject'])
-                    if subject:
-                        attachment.name = '%s.eml' % subject[:45]
-                if "create-date" in dispo_dict:
-                    attachment.create_date = dispo_dict['create-date']  # TODO: datetime
-                if "modification-date" in dispo_dict:
-                    attachment.mod_date = dispo_dict['modification-date']  # TODO: datetime
-                if "read-date" in dispo_dict:
-                    attachment.read_date = dispo_dict['read-date']  # TODO: datetime
-                return attachment
+                return dispo_dict
         return None
 
+    def set_attachment_info(self, attachment, message_part, dispo_dict):
+        content_type = message_part.get("Content-Type", None)
+        attachment.content_type = message_part.get_content_type()
+        attachment.name = None
+        attachment.create_date = None
+        attachment.mod_date = None
+        attachment.read_date = None
+        if "filename" in dispo_dict:
+            attachment.name = dispo_dict['filename']
+        if content_type:
+            _, content_dict = self.parse_dispositions(content_type)
+            if 'name' in content_dict:
+                attachment.name = content_dict['name']
+        if attachment.name is None and content_type == 'message/rfc822':
+            attachment.seek(0)
+            msgobj = self.read_headers(LineReader(attachment))
+            attachment.seek(0)
+            subject = self.parse_header_field(msgobj['Subject'])
+            if subject:
+                attachment.name = '%s.eml' % subject[:45]
+        if "create-date" in dispo_dict:
+            attachment.create_date = dispo_dict['create-date']  # TODO: datetime
+        if "modification-date" in dispo_dict:
+            attachment.mod_date = dispo_dict['modification-date']  # TODO: datetime
+        if "read-date" in dispo_dict:
+            attachment.read_date = dispo_dict['read-date']  # TODO: datetime
+
+    def parse_attachment(self, message_part):
+        dispo_dict = self.get_attachment_dispositions(message_part)
+        if dispo_dict is None:
+            return None
+        file_data = message_part.get_payload(decode=True)
+        if file_data is None:
+            payloads = message_part.get_payload()
+            file_data = '\n\n'.join([p.as_string() for p in payloads]).encode('utf-8')
+        attachment = BytesIO(file_data)
+        attachment.size = len(file_data)
+        self.set_attachment_info(attachment, message_part, dispo_dict)
+        return attachment
+
     def parse_header_field(self, field):
         if field is None:
             return None
@@ -179,11 +418,153 @@ class EmailParser(object):
     def parse(self, bytesfile):
         p = Parser()
         msgobj = p.parse(bytesfile)
-        subject = self.parse_header_field(msgobj['Subject'])
         attachments = []
         body = []
         html = []
         self.parse_body(msgobj.walk(), attachments, body, html)
+        return self.get_email(msgobj, attachments, body, html)
+
+    def read_headers(self, reader, boundaries=()):
+        """
+        Parses the header lines up to the empty line and
+        returns them as a message without payload
+        """
+        lines = []
+        while True:
+            piece = reader.readline()
+            line, line_start = piece
+            if not line:
+                break
+            if line_start:
+                if line in (b'\r\n', b'\n'):
+                    break
+                if (self.match_boundary(line, boundaries) is not None or
+                        not HEADER_LINE_RE.match(line)):
+                    # Part without empty line after the headers
+                    reader.push_back(piece)
+                    break
+            lines.append(line)
+        return HeaderParser().parse(BytesIO(b''.join(lines)))
+
+    def match_boundary(self, line, boundaries):
+        line = line.rstrip()
+        for boundary in reversed(boundaries):
+            if line == boundary or line == boundary + b'--':
+                return boundary
+        return None
+
+    def copy_until_boundary(self, reader, boundaries, write=None):
+        """
+        Passes the lines up to the next boundary line to write and
+        returns the boundary line or an empty string at the end.
+        The line break before a boundary belongs to the boundary.
+        """
+        pending = b''
+        while True:
+            line, line_start = reader.readline()
+            if not line:
+                break
+            if line_start and self.match_boundary(line, boundaries):
+                if pending.endswith(b'\r\n'):
+                    pending = pending[:-2]
+                elif pending.endswith(b'\n'):
+                    pending = pending[:-1]
+                if write is not None and pending:
+                    write(pending)
+                return line
+            if write is not None and pending:
+                write(pending)
+            pending = line
+        if write is not None and pending:
+            write(pending)
+        return b''
+
+    def parse_stream_part(self, msgobj, reader, boundaries, attachments,
+                          body, html):
+        """
+        Reads the payload of the part with the headers msgobj up to the
+        next boundary line, which is left in the reader
+        """
+        boundary = msgobj.get_boundary()
+        if msgobj.get_content_maintype() == 'multipart' and boundary:
+            separator = b'--' + boundary.encode('ascii', 'ignore')
+            boundaries = boundaries + (separator,)
+            # Skip the preamble
+            line = self.copy_until_boundary(reader, boundaries)
+            while line.rstrip() == separator:
+                part = self.read_headers(reader, boundaries)
+                self.parse_stream_part(part, reader, boundaries,
+                                       attachments, body, html)
+                line = self.copy_until_boundary(reader, boundaries)
+            if line.rstrip() == separator + b'--':
+                # Skip the epilogue
+                line = self.copy_until_boundary(reader, boundaries[:-1])
+            if line:
+                reader.push_back((line, True))
+            return
+
+        content_type = msgobj.get_content_type()
+        dispo_dict = self.get_attachment_dispositions(msgobj)
+        if dispo_dict is not None or content_type == 'message/rfc822':
+            fileobj = tempfile.SpooledTemporaryFile(
+                max_size=self.max_memory_size)
+        elif content_type in ('text/plain', 'text/html'):
+            fileobj = BytesIO()
+        else:
+            fileobj = None
+
+        write = None
+        if fileobj is not None:
+            encoding = msgobj.get('Content-Transfer-Encoding')
+            if content_type == 'message/rfc822':
+                encoding = None
+            decoder = TransferDecoder(encoding, fileobj)
+            write = decoder.write
+        line = self.copy_until_boundary(reader, boundaries, write)
+        if line:
+            reader.push_back((line, True))
+        if fileobj is None:
+            return
+        decoder.close()
+
+        if dispo_dict is not None:
+            attachment = EmailAttachment(fileobj, decoder.size)
+            self.set_attachment_info(attachment, msgobj, dispo_dict)
+            attachments.append(attachment)
+        if content_type == 'message/rfc822':
+            # Also look into the parts of attached mails
+            inner_reader = LineReader(fileobj)
+            inner = self.read_headers(inner_reader)
+            self.parse_stream_part(inner, inner_reader, (), attachments,
+                                   body, html)
+            if dispo_dict is None:
+                fileobj.close()
+            else:
+                fileobj.seek(0)
+        elif dispo_dict is None:
+            charset = msgobj.get_content_charset() or 'ascii'
+            text = str(fileobj.getvalue(), charset, 'replace')
+            if content_type == 'text/plain':
+                body.append(text)
+            else:
+                html.append(text)
+
+    def parse_stream(self, bytesfile):
+        """
+        Parses the mail while reading it from bytesfile. Attachments
+        are decoded into temporary files that stay in memory up to
+        max_memory_size bytes and are written to disk beyond that.
+        """
+        reader = LineReader(bytesfile)
+        msgobj = self.read_headers(reader)
+        attachments = []
+        body = []
+        html = []
+        self.parse_stream_part(msgobj, reader, (), attachments, body, html)
+        return self.get_email(msgobj, attachments, body, html)
+
+    def get_email(self, msgobj, attachments, body, html):
+        subject = self.parse_header_field(msgobj['Subject'])
         body = u'\n'.join(body)
         html = u'\n'.join(html)
 
@@ -0,0 +1,130 @@
+import calendar
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils import timezone
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CountedPaginator(Paginator):
+    """
+    Paginator that uses a count that is already known
+    instead of running a COUNT query on the object list
+    """
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.known_count = count
+
+    @property
+    def count(self):
+        return self.known_count
+
+
+def encode_cursor(value, pk):
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    micros = calendar.timegm(value.timetuple()) * 10 ** 6 + value.microsecond
+    return '%d_%d' % (micros, pk)
+
+
+def decode_cursor(cursor):
+    try:
+        micros, pk = [int(x) for x in cursor.split('_')]
+        value = datetime(1970, 1, 1) + timedelta(microseconds=micros)
+    except (ValueError, OverflowError):
+        raise InvalidCursor(cursor)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.utc)
+    return value, pk
+
+
+class KeysetPage(object):
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.has_next_page = has_next
+        self.has_previous_page = has_previous
+
+    def __repr__(self):
+        return '<KeysetPage of %d items>' % len(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.has_next_page
+
+    def has_previous(self):
+        return self.has_previous_page
+
+    def has_other_pages(self):
+        return self.has_next_page or self.has_previous_page
+
+    def next_cursor(self):
+        if not self.has_next_page or not self.object_list:
+            return None
+        return self.paginator.get_cursor(self.object_list[-1])
+
+    def previous_cursor(self):
+        if not self.has_previous_page or not self.object_list:
+            return None
+        return self.paginator.get_cursor(self.object_list[0])
+
+
+class KeysetPaginator(object):
+    """
+    Seeks through a queryset ordered descending by a date field and the
+    primary key instead of using OFFSET, so every page costs the same
+    no matter how deep it is.
+
+    Rows with a NULL value in the date field are not part of any page.
+    """
+    def __init__(self, object_list, per_page, field='last_message'):
+        self.object_list = object_list.filter(**{
+            '%s__isnull' % field: False
+        })
+        self.per_page = int(per_page)
+        self.field = field
+
+    def get_cursor(self, obj):
+        return encode_cursor(getattr(obj, self.field), obj.pk)
+
+    def page(self, after=None, before=None):
+        """
+        Returns the page following the cursor `after` or the page
+        preceding the cursor `before`. Without any cursor the first
+        page is returned. Raises InvalidCursor for malformed cursors.
+        """
+        field = self.field
+        if before:
+            value, pk = decode_cursor(before)
+            qs = self.object_list.filter(
+                Q(**{'%s__gt' % field: value}) | Q(**{field: value, 'pk__gt': pk})
+            ).order_by(field, 'pk')
+            items = list(qs[:self.per_page + 1])
+            has_previous = len(items) > self.per_page
+            items = items[:self.per_page]
+            items.reverse()
+            return KeysetPage(items, self, True, has_previous)
+
+        qs = self.object_list
+        if after:
+            value, pk = decode_cursor(after)
+            qs = qs.filter(
+                Q(**{'%s__lt' % field: value}) | Q(**{field: value, 'pk__lt': pk})
+            )
+        qs = qs.order_by('-%s' % field, '-pk')
+        items = list(qs[:self.per_page + 1])
+        has_next = len(items) > self.per_page
+        return KeysetPage(items[:self.per_page], self, has_next, bool(after))
@@ -1,14 +1,349 @@
 from datetime import datetime, timedelta
+import os
+import shutil
+import sys
+import tempfile
+import threading
 
+from django.utils.six.moves import socketserver
+from django.core.mail import EmailMessage
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.template import engines
 
-from .text_utils import replace_email_name
+from .text_utils import (replace_email_name, replace_email,
+    replace_email_and_name, replace_word, Redactor)
+from .email_utils import ImapMailFetcher
+from .email_sending import MailQueue, DomainRateLimiter, mail_queue, send_mail
+from .document_conversion import ConversionPool, ConversionError
 from .form_generator import FormGenerator
 from .date_utils import calc_easter, calculate_month_range_de
 
 
+class FakeIMAP(object):
+    """
+    Minimal local IMAP stand-in that answers UID SEARCH, FETCH and STORE
+    on a shared dict of uid -> [rfc_data, seen]
+    """
+    def __init__(self, mailbox, uidvalidity=1):
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.fetch_calls = []
+
+    def __call__(self, host, port):
+        return self
+
+    def login(self, user, password):
+        return 'OK', [b'Logged in']
+
+    def select(self, mailbox):
+        return 'OK', [str(len(self.mailbox)).encode('ascii')]
+
+    def status(self, mailbox, names):
+        return 'OK', [('"%s" (UIDVALIDITY %d)' % (
+            mailbox, self.uidvalidity)).encode('ascii')]
+
+    def _parse_uids(self, uid_set):
+        return [int(uid) for uid in uid_set.split(',')]
+
+    def uid(self, command, *args):
+        if command == 'search':
+            uids = [str(uid) for uid, (data, seen) in sorted(self.mailbox.items())
+                    if not seen]
+            return 'OK', [' '.join(uids).encode('ascii')]
+        if command == 'fetch':
+            uids = self._parse_uids(args[0])
+            self.fetch_calls.append(uids)
+            data = []
+            for i, uid in enumerate(uids):
+                header = '%d (UID %d BODY[] {%d}' % (
+                    i + 1, uid, len(self.mailbox[uid][0]))
+                data.append((header.encode('ascii'), self.mailbox[uid][0]))
+                data.append(b')')
+            return 'OK', data
+        if command == 'store':
+            for uid in self._parse_uids(args[0]):
+                self.mailbox[uid][1] = True
+            return 'OK', []
+
+    def close(self):
+        return 'OK', []
+
+    def logout(self):
+        return 'BYE', []
+
+
+class TestImapMailFetcher(TestCase):
+    def get_fetcher(self, imap, **kwargs):
+        return ImapMailFetcher('localhost', 143, 'user', 'password',
+                               ssl=False, connection_factory=imap, **kwargs)
+
+    def test_fetch_in_batches(self):
+        mailbox = dict((uid, [('Mail %d' % uid).encode('ascii'), False])
+                       for uid in range(1, 12))
+        mailbox[3][1] = True
+        imap = FakeIMAP(mailbox)
+        fetcher = self.get_fetcher(imap, batch_size=4, connections=3)
+        uids = fetcher.get_unread_uids()
+        self.assertEqual(len(uids), 10)
+        self.assertEqual(fetcher.get_uidvalidity(), 1)
+        fetched = []
+        for mails in fetcher.fetch_batches(uids):
+            self.assertTrue(len(mails) <= 4)
+            fetched.extend(mails)
+        fetcher.close()
+        self.assertEqual([uid for uid, data in fetched], uids)
+        self.assertEqual(fetched[0][1], b'Mail 1')
+        self.assertEqual(len(imap.fetch_calls), 3)
+        # Fetching does not flag mails as seen
+        self.assertFalse(mailbox[1][1])
+        fetcher.mark_seen([1, 2])
+        self.assertTrue(mailbox[1][1])
+        self.assertFalse(mailbox[4][1])
+
+
+class FakeMailBackend(object):
+    opened = []
+    sent = []
+
+    def __init__(self, fail_silently=False, **kwargs):
+        self.kwargs = kwargs
+
+    def open(self):
+        FakeMailBackend.opened.append(self)
+
+    def close(self):
+        pass
+
+    def send_messages(self, messages):
+        for message in messages:
+            if 'fail' in message.to[0]:
+                raise ValueError(message.to[0])
+        FakeMailBackend.sent.extend(messages)
+        return len(messages)
+
+
+class LocalSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().split(b' ')[0].upper()
+            if command == b'DATA':
+                self.reply('354 go ahead')
+                data = []
+                line = self.rfile.readline()
+                while line and line.rstrip(b'\r\n') != b'.':
+                    data.append(line)
+                    line = self.rfile.readline()
+                self.server.messages.append(b''.join(data))
+                self.reply('250 ok')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class LocalSMTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0),
+                                        LocalSMTPHandler)
+        self.connections = 0
+        self.messages = []
+
+
+class TestMailQueue(TestCase):
+    backend = 'froide.helper.tests.FakeMailBackend'
+
+    def setUp(self):
+        FakeMailBackend.opened = []
+        FakeMailBackend.sent = []
+
+    def make_mail(self, to):
+        return EmailMessage('Subject', 'Body', 'info@example.com', [to])
+
+    def test_pooled_connections(self):
+        queue = MailQueue(connections=2, domain_rate=0)
+        for i in range(10):
+            queue.add(self.make_mail('user%d@domain%d.example.org' % (i, i % 3)),
+                      connection_kwargs={'backend': self.backend})
+        self.assertEqual(len(queue), 10)
+        self.assertEqual(queue.flush(), 10)
+        self.assertEqual(len(FakeMailBackend.opened), 2)
+        self.assertEqual(len(FakeMailBackend.sent), 10)
+        self.assertEqual(len(queue), 0)
+
+    def test_failing_mail_does_not_stop_others(self):
+        queue = MailQueue(connections=1, domain_rate=0)
+        for to in ('a@example.org', 'fail@example.org', 'b@example.org'):
+            queue.add(self.make_mail(to),
+                      connection_kwargs={'backend': self.backend})
+        with self.assertRaises(ValueError):
+            queue.flush()
+        self.assertEqual([m.to[0] for m in FakeMailBackend.sent],
+                         ['a@example.org', 'b@example.org'])
+
+    def test_on_sent(self):
+        queue = MailQueue(connections=1, domain_rate=0)
+        sent = []
+        for to in ('a@example.org', 'fail@example.org', 'b@example.org'):
+            queue.add(self.make_mail(to),
+                      connection_kwargs={'backend': self.backend},
+                      fail_silently=True,
+                      on_sent=lambda message: sent.append(
+                          (message.to[0], len(FakeMailBackend.sent))))
+        queue.flush()
+        self.assertEqual(sent, [('a@example.org', 1), ('b@example.org', 2)])
+
+    def test_domain_rate_limit(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+
+        limiter = DomainRateLimiter(2, clock=lambda: now[0], sleep=sleep)
+        limiter.wait('example.org')
+        limiter.wait('example.com')
+        limiter.wait('example.org')
+        limiter.wait('example.org')
+        self.assertEqual(sleeps, [0.5, 1.0])
+
+    def test_mail_queue_collects_mails(self):
+        with override_settings(EMAIL_BACKEND=self.backend):
+            with mail_queue(connections=1, domain_rate=0) as queue:
+                send_mail('Subject', 'Body', 'info@example.com',
+                          ['a@example.org'])
+                send_mail('Subject', 'Body', 'info@example.com',
+                          ['b@example.org'])
+                self.assertEqual(len(queue), 2)
+                self.assertEqual(FakeMailBackend.sent, [])
+            self.assertEqual(len(FakeMailBackend.sent), 2)
+            self.assertEqual(len(FakeMailBackend.opened), 1)
+            send_mail('Subject', 'Body', 'info@example.com',
+                      ['c@example.org'])
+            self.assertEqual(len(FakeMailBackend.sent), 3)
+
+    def test_local_smtp_server(self):
+        server = LocalSMTPServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            queue = MailQueue(connections=2, domain_rate=0)
+            connection_kwargs = {
+                'backend': 'django.core.mail.backends.smtp.EmailBackend',
+                'host': '127.0.0.1',
+                'port': server.server_address[1],
+                'username': '',
+                'password': '',
+                'use_tls': False
+            }
+            for i in range(6):
+                queue.add(self.make_mail('user%d@example.org' % i),
+                          connection_kwargs=connection_kwargs)
+            self.assertEqual(queue.flush(), 6)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(server.messages), 6)
+        self.assertEqual(server.connections, 2)
+
+
+FAKE_CONVERTER = """
+import json, os, sys, time
+for line in iter(sys.stdin.readline, ''):
+    request = json.loads(line)
+    name = os.path.basename(request['input']).rsplit('.', 1)[0]
+    if name == 'crash':
+        sys.exit(1)
+    if name == 'hang':
+        time.sleep(30)
+    if name == 'broken':
+        result = {'error': 'Broken document'}
+    else:
+        output = os.path.join(request['outdir'], name + '.pdf')
+        with open(output, 'w') as f:
+            f.write(str(os.getpid()))
+        result = {'output': output}
+    sys.stdout.write(json.dumps(result) + '\\n')
+    sys.stdout.flush()
+"""
+
+
+class TestConversionPool(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        converter = os.path.join(self.path, 'converter.py')
+        with open(converter, 'w') as f:
+            f.write(FAKE_CONVERTER)
+        self.pool = ConversionPool([sys.executable, converter], workers=1,
+                                   timeout=2)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        shutil.rmtree(self.path)
+
+    def read(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+    def test_process_is_reused(self):
+        first = self.pool.convert('first.doc', self.path)
+        second = self.pool.convert('second.doc', self.path)
+        self.assertEqual(first, os.path.join(self.path, 'first.pdf'))
+        self.assertEqual(self.read(first), self.read(second))
+        self.assertEqual(self.pool.processes[0].starts, 1)
+
+    def test_restart_after_crash_and_timeout(self):
+        with self.assertRaises(ConversionError):
+            self.pool.convert('crash.doc', self.path)
+        with self.assertRaises(ConversionError):
+            self.pool.convert('hang.doc', self.path, timeout=0.5)
+        with self.assertRaises(ConversionError):
+            self.pool.convert('broken.doc', self.path)
+        self.assertTrue(self.pool.convert('after.doc', self.path))
+        self.assertEqual(self.pool.processes[0].starts, 3)
+
+    def test_profile_dir_removed(self):
+        self.pool.convert('first.doc', self.path)
+        process = self.pool.processes[0]
+        profile_dir = process.profile_dir
+        self.assertTrue(os.path.isdir(profile_dir))
+        with self.assertRaises(ConversionError):
+            self.pool.convert('hang.doc', self.path, timeout=0.5)
+        self.assertFalse(os.path.exists(profile_dir))
+        self.pool.convert('second.doc', self.path)
+        profile_dir = process.profile_dir
+        self.pool.shutdown()
+        self.assertFalse(os.path.exists(profile_dir))
+
+    def test_priority_and_timing(self):
+        # Keeps the only converter busy while the others are queued
+        busy = self.pool.submit('hang.doc', self.path, timeout=0.5)
+        jobs = [self.pool.submit('low.doc', self.path, priority=10),
+                self.pool.submit('high.doc', self.path, priority=0)]
+        for job in jobs:
+            job.wait()
+        with self.assertRaises(ConversionError):
+            busy.wait()
+        self.assertLess(jobs[1].started_at, jobs[0].started_at)
+        timing = jobs[0].timing
+        self.assertGreater(timing['queued'], 0)
+        self.assertIn('conversion', timing)
+
+
 class TestAPIDocs(TestCase):
     def test_api_docs_main(self):
         response = self.client.get('/api/v1/docs/')
@@ -25,6 +360,45 @@ class TestTextReplacement(TestCase):
         content = replace_email_name(content, 'REPLACEMENT')
         self.assertEqual(content, 'This is a very long string with a name REPLACEMENT it')
 
+    def test_email_and_name_replacement(self):
+        texts = [
+            'Mail <and.email@adress.in> or and.email@adress.in now',
+            'foo<a@b.de> x@y<a@b> @ a@ @b <a@b.de>\nnext@line.de',
+        ]
+        for text in texts:
+            self.assertEqual(replace_email_and_name(text, 'NAME', 'EMAIL'),
+                replace_email(replace_email_name(text, 'NAME'), 'EMAIL'))
+
+    def test_redactor(self):
+        redactor = Redactor()
+        redactor.replace('Musterstr. 1', 'ADDRESS')
+        redactor.replace('12345 Berlin', 'ADDRESS')
+        redactor.replace_word('Mustermann', 'NAME')
+        redactor.replace_word('Max', 'NAME')
+        redactor.replace_word('Max Mustermann', 'NAME')
+        redactor.compile()
+        self.assertTrue(all(step.regex is not None
+                            for step in redactor.steps))
+        texts = [
+            'Max Mustermann\nMusterstr. 12345 Berlin\nMaxi, Max,Max Max\n',
+            'MaxMustermann Max-Mustermann ' + 'Max ' * 40,
+            'Max',
+        ]
+        for text in texts:
+            self.assertEqual(redactor(text), redactor.apply_sequential(text))
+        self.assertEqual(redactor('Hello Max Mustermann!'),
+                         'Hello NAME NAME!')
+
+    def test_redactor_overlapping_needles(self):
+        redactor = Redactor()
+        redactor.replace_word('Max', 'NAME')
+        redactor.replace_word('Maximilian', 'NAME')
+        redactor.compile()
+        self.assertIsNone(redactor.steps[0].regex)
+        text = 'Max and Maximilian'
+        self.assertEqual(redactor(text),
+            replace_word('Maximilian', 'NAME', replace_word('Max', 'NAME', text)))
+
 
 @override_settings(
     HOLIDAYS=[
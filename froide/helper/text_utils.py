@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from difflib import SequenceMatcher
 import re
 
 try:
@@ -52,6 +53,84 @@ def split_text_by_separator(text, separator=None):
     return split_text
 
 
+DIFF_ANCHOR_LENGTH = 8
+DIFF_SEARCH_WINDOW = 1000
+
+
+def get_common_prefix_length(a, i, b, j, block=256):
+    length = 0
+    while a[i + length:i + length + block] == b[j + length:j + length + block]:
+        if i + length + block >= len(a) or j + length + block >= len(b):
+            return min(len(a) - i, len(b) - j)
+        length += block
+    end = min(len(a) - i, len(b) - j)
+    while length < end and a[i + length] == b[j + length]:
+        length += 1
+    return length
+
+
+def find_realignment(a, i, b, j):
+    """
+    Returns the shortest (di, dj) after which a[i + di:] and b[j + dj:]
+    start with the same DIFF_ANCHOR_LENGTH characters or both end,
+    None if there is none within DIFF_SEARCH_WINDOW characters
+    """
+    best = None
+    for dj in range(min(len(b) - j, DIFF_SEARCH_WINDOW) + 1):
+        if best is not None and dj >= best[0] + best[1]:
+            break
+        anchor = b[j + dj:j + dj + DIFF_ANCHOR_LENGTH]
+        if len(anchor) < DIFF_ANCHOR_LENGTH:
+            # Close to the end of b only the end of a can match
+            if not a.endswith(anchor) or len(a) - len(anchor) < i:
+                continue
+            di = len(a) - len(anchor) - i
+        else:
+            limit = DIFF_SEARCH_WINDOW
+            if best is not None:
+                limit = best[0] + best[1] - dj
+            pos = a.find(anchor, i, i + limit + len(anchor))
+            if pos == -1:
+                continue
+            di = pos - i
+        if best is None or di + dj < best[0] + best[1]:
+            best = (di, dj)
+    return best
+
+
+def get_differences(content_a, content_b):
+    """
+    Returns the (i1, i2, j1, j2) ranges in which content_a[i1:i2] and
+    content_b[j1:j2] differ. Redaction replaces short parts of a text,
+    so after every difference both texts are realigned on the next
+    common characters, which takes time proportional to their length.
+    Texts that cannot be realigned are compared with difflib.
+    """
+    differences = []
+    i, j = 0, 0
+    while True:
+        length = get_common_prefix_length(content_a, i, content_b, j)
+        i += length
+        j += length
+        if i == len(content_a) and j == len(content_b):
+            break
+        if i == len(content_a) or j == len(content_b):
+            differences.append((i, len(content_a), j, len(content_b)))
+            break
+        realignment = find_realignment(content_a, i, content_b, j)
+        if realignment is None:
+            matcher = SequenceMatcher(None, content_a[i:], content_b[j:])
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                if tag != 'equal':
+                    differences.append((i + i1, i + i2, j + j1, j + j2))
+            break
+        di, dj = realignment
+        differences.append((i, i + di, j, j + dj))
+        i += di
+        j += dj
+    return differences
+
+
 def replace_word(needle, replacement, content):
     return re.sub('(^|\W)%s($|\W)' % re.escape(needle),
                     '\\1%s\\2' % replacement, content, re.U)
@@ -86,3 +165,231 @@ def remove_closing(content, closings):
             content = content[:match.end()]
             break
     return content
+
+
+EMAIL_TOKEN_RE = re.compile(r'(?<![^\s])[^\s@]*@[^\s]*')
+
+
+def replace_email_and_name(text, name_replacement=u"", email_replacement=u""):
+    """
+    Same as calling replace_email_name and then replace_email, but only
+    whitespace separated tokens that contain an @ are looked at again.
+    """
+    name_replacement = str(name_replacement)
+    email_replacement = str(email_replacement)
+
+    def replace_token(match):
+        token = EMAIL_NAME_RE.sub(name_replacement, match.group(0))
+        return EMAIL_RE.sub(email_replacement, token)
+
+    return EMAIL_TOKEN_RE.sub(replace_token, text)
+
+
+# replace_word passes re.U as count to re.sub
+WORD_REPLACE_LIMIT = re.U
+
+WORD_CHAR_RE = re.compile(r'\w')
+
+
+class RedactionFallback(Exception):
+    pass
+
+
+def _overlaps(a, b):
+    """ Check if a proper suffix of a is a proper prefix of b """
+    for k in range(1, min(len(a), len(b))):
+        if a[-k:] == b[:k]:
+            return True
+    return False
+
+
+def _interferes(needle, other):
+    return (needle in other or other in needle or
+            _overlaps(needle, other) or _overlaps(other, needle))
+
+
+class EmailRedaction(object):
+    def __init__(self, name_replacement, email_replacement):
+        self.name_replacement = name_replacement
+        self.email_replacement = email_replacement
+
+    def __call__(self, content):
+        return replace_email_and_name(content, self.name_replacement,
+                                      self.email_replacement)
+
+    def apply_sequential(self, content):
+        content = replace_email_name(content, self.name_replacement)
+        return replace_email(content, self.email_replacement)
+
+
+class ReplacementPass(object):
+    """
+    Applies literal and word replacements in one regex pass.
+
+    The output is the same as calling ``str.replace`` and
+    ``replace_word`` one after another. If the needles could
+    interfere with each other or with the replacements, or a text
+    hits an edge case of ``replace_word``, the replacements are
+    applied one after another instead.
+    """
+    def __init__(self, replacements):
+        self.replacements = replacements
+        self.lookup = {}
+        self.regex = None
+        needles = self.get_combinable_needles()
+        if needles:
+            self.regex = re.compile(u'|'.join(
+                re.escape(needle) for needle in needles))
+
+    def get_combinable_needles(self):
+        needles = []
+        word_needles = set()
+        for needle, replacement, word in self.replacements:
+            if not needle or needle in self.lookup:
+                return None
+            if word and '\\' in replacement:
+                return None
+            self.lookup[needle] = (replacement, word)
+            # A full name made of two earlier word needles can
+            # never match after these have been replaced
+            if word and any(needle == u'%s %s' % (a, b)
+                    for a in word_needles for b in word_needles):
+                continue
+            if word:
+                word_needles.add(needle)
+            needles.append(needle)
+
+        for i, needle in enumerate(needles):
+            if _overlaps(needle, needle):
+                return None
+            for other in needles[i + 1:]:
+                if needle in other or other in needle:
+                    return None
+                if _overlaps(other, needle):
+                    return None
+                # An earlier literal running into a later one is
+                # matched first either way
+                if _overlaps(needle, other) and (
+                        needle in word_needles or other in word_needles):
+                    return None
+        for needle in self.lookup:
+            for replacement, _word in self.lookup.values():
+                if replacement and _interferes(needle, replacement):
+                    return None
+        return needles
+
+    def __call__(self, content):
+        if self.regex is None:
+            return self.apply_sequential(content)
+        try:
+            return self.apply_combined(content)
+        except RedactionFallback:
+            return self.apply_sequential(content)
+
+    def apply_combined(self, content):
+        length = len(content)
+        state = {'end': None}
+        ends = {}
+        counts = {}
+
+        def is_word_char(pos):
+            return WORD_CHAR_RE.match(content[pos]) is not None
+
+        def replace(match):
+            needle = match.group(0)
+            replacement, word = self.lookup[needle]
+            start, end = match.span()
+            last_end, state['end'] = state['end'], (end, word)
+            if last_end is not None and last_end[0] == start and (
+                    word or last_end[1]):
+                # touching a word needle, boundaries may change
+                raise RedactionFallback
+            if not word:
+                return replacement
+            if start > 0 and is_word_char(start - 1):
+                return needle
+            if end < length and is_word_char(end):
+                return needle
+            if ends.get(needle) == start:
+                # boundary was consumed by the previous match
+                return needle
+            counts[needle] = counts.get(needle, 0) + 1
+            if counts[needle] > WORD_REPLACE_LIMIT:
+                raise RedactionFallback
+            if end < length and not (end == length - 1 and
+                                      content[end] == '\n'):
+                end += 1
+            ends[needle] = end
+            return replacement
+
+        return self.regex.sub(replace, content)
+
+    def apply_sequential(self, content):
+        for needle, replacement, word in self.replacements:
+            if word:
+                content = replace_word(needle, replacement, content)
+            else:
+                content = content.replace(needle, replacement)
+        return content
+
+
+class Redactor(object):
+    """
+    A compiled chain of redaction steps.
+
+    Consecutive literal and word replacements are merged into one
+    ReplacementPass. Other steps are plain callables that run on the
+    output of the previous step.
+    """
+    def __init__(self):
+        self.steps = []
+        self.pending = []
+
+    def replace_emails(self, name_replacement, email_replacement):
+        self.add_step(EmailRedaction(name_replacement, email_replacement))
+
+    def replace(self, needle, replacement):
+        self.pending.append((needle, str(replacement), False))
+
+    def replace_word(self, needle, replacement):
+        self.pending.append((needle, str(replacement), True))
+
+    def add_step(self, step):
+        self.compile()
+        self.steps.append(step)
+
+    def compile(self):
+        if self.pending:
+            self.steps.append(ReplacementPass(self.pending))
+            self.pending = []
+        return self
+
+    def __call__(self, content):
+        self.compile()
+        for step in self.steps:
+            content = step(content)
+        return content
+
+    def apply_sequential(self, content):
+        """ Reference implementation applying every replacement on its own """
+        self.compile()
+        for step in self.steps:
+            content = getattr(step, 'apply_sequential', step)(content)
+        return content
+
+
+REDACTOR_CACHE_SIZE = 500
+_redactor_cache = {}
+
+
+def get_redactor(key, build):
+    """
+    Returns the compiled redactor for key, calling build to create it
+    """
+    redactor = _redactor_cache.get(key)
+    if redactor is None:
+        if len(_redactor_cache) >= REDACTOR_CACHE_SIZE:
+            _redactor_cache.clear()
+        redactor = build().compile()
+        _redactor_cache[key] = redactor
+    return redactor
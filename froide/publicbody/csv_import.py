@@ -1,10 +1,20 @@
 # -*- encoding: utf-8 -*-
+from itertools import islice
+import hashlib
+import io
+import json
+
 import requests
 
 from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
+from django.db import models, transaction
+from django.db.models import Case, When, Value, F
 from django.template.defaultfilters import slugify
-from django.utils.six import StringIO, BytesIO, PY3
+from django.utils import timezone
+from django.utils import six
+from django.utils.encoding import python_2_unicode_compatible
+from django.utils.six import PY3
 
 from taggit.utils import parse_tags
 
@@ -14,39 +24,231 @@ else:
     import unicodecsv as csv
 
 
-from froide.publicbody.models import (PublicBody, PublicBodyTag, Jurisdiction, FoiLaw)
+from froide.publicbody.models import (PublicBody, PublicBodyTag,
+        TaggedPublicBody, PublicBodySyncRow, Jurisdiction, FoiLaw)
 
 User = get_user_model()
 
+IMPORT_BATCH_SIZE = 500
+OPTIONAL_FIELDS = ('description', 'other_names', 'request_note',
+                   'website_dump')
+
+
+class RowError(Exception):
+    pass
+
+
+def get_row_key(row):
+    if row.get('id'):
+        return u'id:%s' % row['id']
+    return u'slug:%s' % slugify((row.get('name') or '').strip())
+
+
+def get_row_fingerprint(row):
+    # Extra values of too long rows are stored under None
+    data = dict((key, value) for key, value in row.items() if key is not None)
+    data = json.dumps(data, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@python_2_unicode_compatible
+class ImportReport(object):
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.parents_updated = 0
+        # (row number, message) of rows that were skipped
+        self.errors = []
+
+    def add_error(self, row_number, message):
+        self.errors.append((row_number, message))
+
+    def __str__(self):
+        result = u'%d created, %d updated, %d unchanged, %d errors' % (
+            self.created, self.updated, self.unchanged, len(self.errors))
+        if self.removed:
+            result += u', %d removed from source' % self.removed
+        if self.dry_run:
+            result = u'Dry run: ' + result
+        return result
+
+    def get_lines(self, max_errors=None):
+        lines = [six.text_type(self)]
+        errors = self.errors
+        if max_errors is not None:
+            errors = errors[:max_errors]
+        lines.extend(u'Row %d: %s' % error for error in errors)
+        if len(errors) < len(self.errors):
+            lines.append(u'... and %d more errors' % (
+                len(self.errors) - len(errors)))
+        return lines
+
 
 class CSVImporter(object):
-    topic_cache = {}
-    default_topic = None
-    jur_cache = {}
+    """
+    Imports public bodies from CSV in batches: existing bodies of a batch
+    are loaded in one query, only changed ones are written, new ones are
+    bulk created and laws and tags are written to their through tables in
+    bulk. Parents are resolved after all rows are imported, so a parent
+    may come after its children in the file.
 
-    def __init__(self):
+    When importing with a source, a fingerprint of every row is stored
+    and rows whose fingerprint did not change since the last import from
+    the same source are skipped. Bodies whose rows disappeared from the
+    source are only counted, they are not deleted.
+    """
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
         self.user = User.objects.order_by('id')[0]
         self.site = Site.objects.get_current()
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.topic_cache = {}
+        self.jur_cache = {}
+        self.tag_cache = {}
+        self.report = ImportReport(dry_run=dry_run)
+        # public body id -> (current parent id, parent slug, row number)
+        self.parents = {}
+        self.changed_ids = set()
 
-    def import_from_url(self, url):
-        response = requests.get(url)
-        # Force requests to evaluate as UTF-8
-        response.encoding = 'utf-8'
-        csv_file = BytesIO(response.content)
-        self.import_from_file(csv_file)
+    def import_from_url(self, url, sync=False):
+        response = requests.get(url, stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return self.import_from_file(response.raw,
+                                     source=url if sync else None)
 
-    def import_from_file(self, csv_file):
+    def import_from_file(self, csv_file, source=None):
         """
-        csv_file should be encoded in utf-8
+        csv_file should be a binary file encoded in utf-8
         """
         if PY3:
-            csv_file = StringIO(csv_file.read().decode('utf-8'))
-        reader = csv.DictReader(csv_file)
-        for row in reader:
-            self.import_row(row)
+            csv_file = io.TextIOWrapper(csv_file, encoding='utf-8',
+                                        newline='')
+            reader = csv.DictReader(csv_file)
+        else:
+            reader = csv.DictReader(csv_file, encoding='utf-8')
+        return self.import_rows(reader, source=source)
 
     def import_row(self, row):
-        # generate slugs
+        return self.import_rows([row])
+
+    def import_rows(self, rows, source=None):
+        if self.dry_run:
+            with transaction.atomic():
+                self._import_rows(rows, source)
+                transaction.set_rollback(True)
+        else:
+            self._import_rows(rows, source)
+            if self.changed_ids:
+                PublicBody.bulk_changed.send(sender=PublicBody,
+                        public_body_ids=list(self.changed_ids))
+        return self.report
+
+    def _import_rows(self, rows, source=None):
+        started = timezone.now()
+        if source is not None:
+            source = source[:PublicBodySyncRow._meta.get_field('source').max_length]
+        # Row 1 is the header
+        numbered = enumerate(rows, start=2)
+        for batch in chunks(numbered, self.batch_size):
+            with transaction.atomic():
+                if source is None:
+                    self.import_batch(batch)
+                else:
+                    self.sync_batch(source, started, batch)
+        with transaction.atomic():
+            missing_parents = self.update_parents()
+            if source is not None:
+                # Their rows must be imported again once the parent exists
+                for batch in chunks(missing_parents, self.batch_size):
+                    PublicBodySyncRow.objects.filter(source=source,
+                        public_body_id__in=batch).update(fingerprint='')
+                removed = PublicBodySyncRow.objects.filter(source=source,
+                        last_seen__lt=started)
+                self.report.removed = removed.count()
+                removed.delete()
+
+    def sync_batch(self, source, started, numbered_rows):
+        """
+        Imports the rows of the batch that are new or changed since
+        the last sync from source and stores their fingerprints
+        """
+        rows = [(row_number, row, get_row_key(row), get_row_fingerprint(row))
+                for row_number, row in numbered_rows]
+        known = dict((key, (pk, fingerprint, public_body_id))
+            for key, pk, fingerprint, public_body_id in
+            PublicBodySyncRow.objects.filter(source=source,
+                key__in=[key for _, _, key, _ in rows])
+            .values_list('key', 'id', 'fingerprint', 'public_body_id'))
+
+        unchanged = []
+        changed = []
+        for row_number, row, key, fingerprint in rows:
+            pk, known_fingerprint, public_body_id = known.get(key,
+                                                             (None, None, None))
+            if known_fingerprint == fingerprint and public_body_id is not None:
+                unchanged.append(pk)
+            else:
+                changed.append((row_number, row, key, fingerprint))
+        self.report.unchanged += len(unchanged)
+        if unchanged:
+            PublicBodySyncRow.objects.filter(id__in=unchanged).update(
+                last_seen=started)
+        if not changed:
+            return
+
+        public_body_ids = self.import_batch(
+            [(row_number, row) for row_number, row, _, _ in changed])
+        updates = []
+        new = {}
+        failed = []
+        for row_number, row, key, fingerprint in changed:
+            if row_number not in public_body_ids:
+                # Keep the old fingerprint, the row is still in the source
+                if key in known:
+                    failed.append(known[key][0])
+                continue
+            values = (fingerprint, public_body_ids[row_number])
+            if key in known:
+                updates.append((known[key][0],) + values)
+            else:
+                new[key] = values
+        if failed:
+            PublicBodySyncRow.objects.filter(id__in=failed).update(
+                last_seen=started)
+        if updates:
+            PublicBodySyncRow.objects.filter(id__in=[u[0] for u in updates])\
+                .update(
+                    fingerprint=Case(
+                        *[When(id=pk, then=Value(fingerprint))
+                          for pk, fingerprint, _ in updates],
+                        output_field=models.CharField()),
+                    public_body=Case(
+                        *[When(id=pk, then=Value(public_body_id))
+                          for pk, _, public_body_id in updates],
+                        output_field=models.IntegerField()),
+                    last_seen=started)
+        PublicBodySyncRow.objects.bulk_create([
+            PublicBodySyncRow(source=source, key=key, fingerprint=fingerprint,
+                              public_body_id=public_body_id,
+                              last_seen=started)
+            for key, (fingerprint, public_body_id) in new.items()
+        ])
+
+    def prepare_row(self, row_number, row):
+        row = dict(row)
         row['name'] = row['name'].strip()
         row['email'] = row['email'].lower()
         if row['url'] and not row['url'].startswith(('http://', 'https://')):
@@ -55,51 +257,211 @@ class CSVImporter(object):
         row['classification_slug'] = slugify(row['classification'])
 
         tags = parse_tags(row.pop('tags', ''))
+        tag_ids = set(self.get_tag_ids(tags))
         # Backwards compatible handling of topic__slug
         topic_slug = row.pop('topic__slug', None)
         if topic_slug:
-            tags.append(self.get_topic(topic_slug))
+            tag_ids.add(self.get_topic(topic_slug).id)
 
-        # resolve foreign keys
-        row['jurisdiction'] = self.get_jurisdiction(row.pop('jurisdiction__slug'))
+        jurisdiction = self.get_jurisdiction(row.pop('jurisdiction__slug'))
+        row['jurisdiction_id'] = jurisdiction.id
         parent = row.pop('parent__name', None)
-        if parent:
-            row['parent'] = PublicBody.objects.get(slug=slugify(parent))
+        parent_slug = slugify(parent) if parent else None
 
-        # get optional values
-        for n in ('description', 'other_names', 'request_note', 'website_dump'):
+        for n in OPTIONAL_FIELDS:
             row[n] = row.get(n, '')
 
+        pk = row.pop('id', None)
         try:
-            if 'id' in row and row['id']:
-                pb = PublicBody.objects.get(id=row['id'])
+            pk = int(pk) if pk else None
+        except ValueError:
+            raise RowError(u'Invalid id %r' % pk)
+        return {
+            'row': row_number,
+            'id': pk,
+            'values': row,
+            'law_ids': set(jurisdiction.law_ids),
+            'tag_ids': tag_ids,
+            'parent_slug': parent_slug
+        }
+
+    def get_public_bodies(self):
+        # PublicBody.objects hides bodies without email, the import
+        # creates and updates them as well
+        return PublicBody.non_filtered_objects.filter(site=self.site)
+
+    def import_batch(self, numbered_rows):
+        """
+        Imports a list of (row number, row) and returns a dict
+        of row number to public body id of the imported rows
+        """
+        items = []
+        for row_number, row in numbered_rows:
+            try:
+                items.append(self.prepare_row(row_number, row))
+            except (RowError, KeyError, Jurisdiction.DoesNotExist,
+                    PublicBodyTag.DoesNotExist) as e:
+                self.report.add_error(row_number, u'%s: %s' % (
+                    e.__class__.__name__, e))
+        if not items:
+            return {}
+
+        by_id = self.get_public_bodies().in_bulk(
+            [item['id'] for item in items if item['id']])
+        by_slug = {}
+        for pb in self.get_public_bodies().filter(
+                slug__in=[item['values']['slug'] for item in items]):
+            by_slug.setdefault(pb.slug, pb)
+
+        # Later rows for the same body win
+        existing = {}
+        new = {}
+        for item in items:
+            pb = by_id.get(item['id']) or by_slug.get(item['values']['slug'])
+            if pb is not None:
+                existing[pb.id] = (pb, item)
             else:
-                pb = PublicBody.objects.get(slug=row['slug'])
-            # If it exists, update it
-            row.pop('id', None)  # Do not update id though
-            row['_updated_by'] = self.user
-            PublicBody.objects.filter(id=pb.id).update(**row)
-            pb.laws.clear()
-            pb.laws.add(*row['jurisdiction'].laws)
-            pb.tags.set(*tags)
+                new[item['values']['slug']] = item
+
+        changes = {}
+        for pb, item in existing.values():
+            changed = dict((key, value)
+                           for key, value in item['values'].items()
+                           if getattr(pb, key) != value)
+            if changed:
+                changes[pb.id] = changed
+        self.update_bodies(changes)
+
+        now = timezone.now()
+        PublicBody.non_filtered_objects.bulk_create([
+            PublicBody(_created_by=self.user, _updated_by=self.user,
+                       created_at=now, updated_at=now, confirmed=True,
+                       site=self.site, **item['values'])
+            for item in new.values()
+        ])
+        created = list(self.get_public_bodies()
+                       .filter(slug__in=list(new.keys()))
+                       .values_list('slug', 'id'))
+        targets = {}
+        for pk, (pb, item) in existing.items():
+            targets[pk] = (item, pb.parent_id)
+        for slug, pk in created:
+            targets[pk] = (new[slug], None)
+
+        related = self.update_relations(PublicBody.laws.through,
+            'publicbody_id', 'foilaw_id', dict(
+                (pk, item['law_ids']) for pk, (item, _) in targets.items()))
+        related |= self.update_relations(TaggedPublicBody,
+            'content_object_id', 'tag_id', dict(
+                (pk, item['tag_ids']) for pk, (item, _) in targets.items()))
+        # Bodies whose only change are their laws or tags count as updated
+        updated = set(changes.keys()) | (related & set(existing.keys()))
+        self.report.updated += len(updated)
+        self.report.unchanged += len(existing) - len(updated)
+        self.report.created += len(new)
+
+        for pk, (item, parent_id) in targets.items():
+            self.parents[pk] = (parent_id, item['parent_slug'], item['row'])
+        self.changed_ids.update(changes.keys())
+        self.changed_ids.update(pk for slug, pk in created)
+        return dict((item['row'], pk) for pk, (item, _) in targets.items())
+
+    def update_bodies(self, changes):
+        """
+        Writes changed fields of existing bodies with one UPDATE
+        """
+        if not changes:
             return
-        except PublicBody.DoesNotExist:
-            pass
-        row.pop('id', None)  # Remove id if present
-        public_body = PublicBody(**row)
-        public_body._created_by = self.user
-        public_body._updated_by = self.user
-        public_body.confirmed = True
-        public_body.site = self.site
-        public_body.save()
-        public_body.laws.add(*row['jurisdiction'].laws)
-        public_body.tags.set(*list(tags))
+        fields = set()
+        for changed in changes.values():
+            fields.update(changed.keys())
+        kwargs = {}
+        for name in fields:
+            field = PublicBody._meta.get_field(name)
+            output_field = field
+            if field.is_relation:
+                output_field = models.IntegerField()
+            whens = [When(id=pk, then=Value(changed[name]))
+                     for pk, changed in changes.items() if name in changed]
+            kwargs[field.name] = Case(*whens, default=F(field.attname),
+                                      output_field=output_field)
+        self.get_public_bodies().filter(id__in=list(changes.keys())).update(
+            _updated_by=self.user, updated_at=timezone.now(), **kwargs)
+
+    def update_relations(self, through, source, target, wanted):
+        """
+        Makes the through table rows of the source ids match
+        the wanted dict of source id to a set of target ids and
+        returns the source ids whose rows changed
+        """
+        current = {}
+        stale = []
+        changed = set()
+        for pk, source_id, target_id in through.objects.filter(**{
+                    '%s__in' % source: list(wanted.keys())
+                }).values_list('id', source, target):
+            if target_id in wanted[source_id]:
+                current.setdefault(source_id, set()).add(target_id)
+            else:
+                stale.append(pk)
+                changed.add(source_id)
+        if stale:
+            through.objects.filter(id__in=stale).delete()
+        missing = [(source_id, target_id)
+                   for source_id, target_ids in wanted.items()
+                   for target_id in target_ids - current.get(source_id, set())]
+        through.objects.bulk_create([
+            through(**{source: source_id, target: target_id})
+            for source_id, target_id in missing
+        ])
+        changed.update(source_id for source_id, _ in missing)
+        self.changed_ids.update(changed)
+        return changed
+
+    def update_parents(self):
+        """
+        Sets the parents of the imported bodies and returns the ids
+        of bodies whose parent was not found
+        """
+        slugs = set(slug for parent_id, slug, row in self.parents.values()
+                    if slug)
+        parent_ids = {}
+        for batch in chunks(slugs, self.batch_size):
+            for slug, pk in self.get_public_bodies().filter(slug__in=batch)\
+                    .order_by('-id').values_list('slug', 'id'):
+                parent_ids[slug] = pk
+
+        changes = {}
+        missing = []
+        for pk, (current_id, slug, row_number) in self.parents.items():
+            if slug is None:
+                # Like the previous import, a missing parent column
+                # does not remove an existing parent
+                continue
+            if slug not in parent_ids:
+                self.report.add_error(row_number,
+                                      u'Parent %s not found' % slug)
+                missing.append(pk)
+                continue
+            if parent_ids[slug] != current_id:
+                changes[pk] = parent_ids[slug]
+        items = list(changes.items())
+        for batch in chunks(items, self.batch_size):
+            ids = [pk for pk, _ in batch]
+            self.get_public_bodies().filter(id__in=ids).update(
+                parent=Case(*[When(id=pk, then=Value(parent_id))
+                              for pk, parent_id in batch],
+                            output_field=models.IntegerField())
+            )
+        self.report.parents_updated = len(items)
+        self.changed_ids.update(changes.keys())
+        return missing
 
     def get_jurisdiction(self, slug):
         if slug not in self.jur_cache:
             jur = Jurisdiction.objects.get(slug=slug)
-            laws = FoiLaw.objects.filter(jurisdiction=jur)
-            jur.laws = laws
+            jur.law_ids = list(FoiLaw.objects.filter(jurisdiction=jur)
+                               .values_list('id', flat=True))
             self.jur_cache[slug] = jur
         return self.jur_cache[slug]
 
@@ -107,3 +469,15 @@ class CSVImporter(object):
         if slug not in self.topic_cache:
             self.topic_cache[slug] = PublicBodyTag.objects.get(slug=slug, is_topic=True)
         return self.topic_cache[slug]
+
+    def get_tag_ids(self, names):
+        missing = [name for name in names if name not in self.tag_cache]
+        if missing:
+            for tag in PublicBodyTag.objects.filter(name__in=missing):
+                self.tag_cache[tag.name] = tag.id
+            for name in missing:
+                if name not in self.tag_cache:
+                    # Saved one by one so taggit creates a unique slug
+                    tag = PublicBodyTag.objects.create(name=name)
+                    self.tag_cache[name] = tag.id
+        return [self.tag_cache[name] for name in names]
@@ -1,4 +1,6 @@
 # -*- encoding: utf-8 -*-
+import os
+
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.utils import translation
@@ -7,20 +9,36 @@ from django.utils import translation
 class Command(BaseCommand):
     help = "Loads public bodies"
 
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='URL or filename of the CSV')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help='Report what would change without changing anything')
+        parser.add_argument('--sync', action='store_true', default=False,
+            help='Skip rows that did not change since the last sync '
+                 'from the same source')
+        parser.add_argument('--batch-size', type=int, default=None,
+            help='Number of rows per transaction')
+
     def handle(self, *args, **options):
         translation.activate(settings.LANGUAGE_CODE)
 
-        from froide.publicbody.csv_import import CSVImporter
+        from froide.publicbody.csv_import import CSVImporter, IMPORT_BATCH_SIZE
 
-        importer = CSVImporter()
+        importer = CSVImporter(
+            batch_size=options['batch_size'] or IMPORT_BATCH_SIZE,
+            dry_run=options['dry_run'])
 
-        if len(args) != 1:
-            self.stderr.write((u"Give URL or filename!\n").encode('utf-8'))
-            return 1
-
-        if args[0].startswith('http://') or args[0].startswith('https://'):
-            importer.import_from_url(args[0])
+        source = options['source']
+        if source.startswith('http://') or source.startswith('https://'):
+            report = importer.import_from_url(source, sync=options['sync'])
         else:
-            importer.import_from_file(open(args[0], 'rb'))
-
+            sync_source = None
+            if options['sync']:
+                sync_source = os.path.abspath(source)
+            with open(source, 'rb') as csv_file:
+                report = importer.import_from_file(csv_file,
+                                                   source=sync_source)
+
+        for line in report.get_lines():
+            self.stdout.write(line)
         self.stdout.write(u"Import done.\n")
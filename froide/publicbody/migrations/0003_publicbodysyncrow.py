@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('publicbody', '0002_auto_20151127_1754'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PublicBodySyncRow',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('source', models.CharField(max_length=255, verbose_name='Source')),
+                ('key', models.CharField(max_length=255, verbose_name='Row key')),
+                ('fingerprint', models.CharField(max_length=40, verbose_name='Fingerprint')),
+                ('last_seen', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Last seen')),
+                ('public_body', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, verbose_name='Public Body', to='publicbody.PublicBody', null=True)),
+            ],
+            options={
+                'verbose_name': 'Public Body sync row',
+                'verbose_name_plural': 'Public Body sync rows',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='publicbodysyncrow',
+            unique_together=set([('source', 'key')]),
+        ),
+    ]
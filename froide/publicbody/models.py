@@ -3,6 +3,9 @@ import json
 from datetime import timedelta
 
 from django.db import models
+import django.dispatch
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.sites.models import Site
 from django.contrib.sites.managers import CurrentSiteManager
@@ -25,6 +28,9 @@ from froide.helper.date_utils import (
 from froide.helper.templatetags.markup import markdown
 from froide.helper.form_generator import FormGenerator
 from froide.helper.csv_utils import export_csv
+from froide.helper.cache import ReferenceCache, copy_instance
+
+reference_cache = ReferenceCache('publicbody')
 
 
 class JurisdictionManager(models.Manager):
@@ -35,6 +41,14 @@ class JurisdictionManager(models.Manager):
     def get_list(self):
         return self.get_visible().annotate(num_publicbodies=models.Count('publicbody'))
 
+    def get_cached_visible(self):
+        return [copy_instance(j) for j in reference_cache.get(
+            'jurisdictions', lambda: list(self.get_visible()))]
+
+    def get_cached_list(self):
+        return [copy_instance(j) for j in reference_cache.get(
+            'jurisdiction_list', lambda: list(self.get_list()))]
+
 
 @python_2_unicode_compatible
 class Jurisdiction(models.Model):
@@ -149,12 +163,35 @@ class FoiLaw(models.Model):
     @classmethod
     def get_default_law(cls, pb=None):
         if pb:
-            return cls.objects.filter(jurisdiction=pb.jurisdiction).order_by('-meta')[0]
+            laws = cls.get_jurisdiction_laws()
+            if pb.jurisdiction_id not in laws:
+                # Like indexing the empty law queryset did before
+                raise IndexError('No law in jurisdiction %s' %
+                                 pb.jurisdiction_id)
+            return copy_instance(laws[pb.jurisdiction_id])
+        return copy_instance(reference_cache.get('default_law',
+                                                 cls._get_configured_law))
+
+    @classmethod
+    def _get_configured_law(cls):
         try:
-            return FoiLaw.objects.get(id=settings.FROIDE_CONFIG.get("default_law", 1))
-        except FoiLaw.DoesNotExist:
+            return cls.objects.get(id=settings.FROIDE_CONFIG.get("default_law", 1))
+        except cls.DoesNotExist:
             return None
 
+    @classmethod
+    def get_jurisdiction_laws(cls):
+        """
+        Returns a dict of jurisdiction id to its default law,
+        meta laws come first.
+        """
+        def build():
+            laws = {}
+            for law in cls.objects.order_by('-meta', 'pk'):
+                laws.setdefault(law.jurisdiction_id, law)
+            return laws
+        return reference_cache.get('jurisdiction_laws', build)
+
     def as_dict(self):
         return {
             "pk": self.pk, "name": self.name,
@@ -190,6 +227,10 @@ class PublicBodyTagManager(models.Manager):
             .annotate(num_publicbodies=models.Count('publicbodies'))
         )
 
+    def get_cached_topic_list(self):
+        return [copy_instance(t) for t in reference_cache.get(
+            'topic_list', lambda: list(self.get_topic_list()))]
+
 
 class PublicBodyTag(TagBase):
     is_topic = models.BooleanField(_('as topic'), default=False)
@@ -293,6 +334,9 @@ class PublicBody(models.Model):
     objects = PublicBodyManager()
     published = objects
 
+    # Sent after bulk imports that bypass post_save
+    bulk_changed = django.dispatch.Signal(providing_args=["public_body_ids"])
+
     class Meta:
         ordering = ('name',)
         verbose_name = _("Public Body")
@@ -373,3 +417,102 @@ class PublicBody(models.Model):
         )
 
         return export_csv(queryset, fields)
+
+
+@python_2_unicode_compatible
+class PublicBodySyncRow(models.Model):
+    """
+    Fingerprint of a CSV row the last time it was imported from a source,
+    so syncs can skip rows that did not change.
+    """
+    source = models.CharField(_("Source"), max_length=255)
+    key = models.CharField(_("Row key"), max_length=255)
+    fingerprint = models.CharField(_("Fingerprint"), max_length=40)
+    public_body = models.ForeignKey(PublicBody, null=True,
+            on_delete=models.SET_NULL, verbose_name=_("Public Body"))
+    last_seen = models.DateTimeField(_("Last seen"), default=timezone.now)
+
+    class Meta:
+        unique_together = (('source', 'key'),)
+        verbose_name = _("Public Body sync row")
+        verbose_name_plural = _("Public Body sync rows")
+
+    def __str__(self):
+        return u"%s %s" % (self.source, self.key)
+
+
+def invalidate_reference_cache(sender, **kwargs):
+    if kwargs.get('raw', False):
+        return
+    reference_cache.invalidate()
+
+
+@receiver(PublicBody.bulk_changed,
+        dispatch_uid='reference_cache_bulk_changed')
+def invalidate_reference_cache_bulk(sender, **kwargs):
+    reference_cache.invalidate()
+
+
+SEARCH_INDEX_BATCH_SIZE = 500
+
+
+@receiver(PublicBody.bulk_changed,
+        dispatch_uid='search_index_bulk_changed')
+def update_search_index_bulk(sender, public_body_ids=None, **kwargs):
+    """
+    Reindexes only the given public bodies, through celery when
+    celery_haystack is installed
+    """
+    try:
+        from celery_haystack.utils import get_update_task
+    except ImportError:
+        get_update_task = None
+    from haystack import connections
+    from haystack.constants import DEFAULT_ALIAS
+    from haystack.utils import get_identifier
+
+    public_body_ids = list(public_body_ids)
+    if get_update_task is not None:
+        task = get_update_task()
+        for public_body_id in public_body_ids:
+            task.delay('update', get_identifier(PublicBody(id=public_body_id)))
+        return
+    connection = connections[DEFAULT_ALIAS]
+    index = connection.get_unified_index().get_index(PublicBody)
+    backend = connection.get_backend()
+    for i in range(0, len(public_body_ids), SEARCH_INDEX_BATCH_SIZE):
+        batch = public_body_ids[i:i + SEARCH_INDEX_BATCH_SIZE]
+        backend.update(index, index.index_queryset().filter(id__in=batch))
+
+
+for model in (FoiLaw, Jurisdiction, PublicBodyTag, TaggedPublicBody,
+              PublicBody):
+    post_delete.connect(invalidate_reference_cache, sender=model,
+        dispatch_uid='reference_cache_delete_%s' % model.__name__)
+    if model is not PublicBody:
+        post_save.connect(invalidate_reference_cache, sender=model,
+            dispatch_uid='reference_cache_save_%s' % model.__name__)
+
+
+@receiver(post_init, sender=PublicBody,
+        dispatch_uid='reference_cache_init_PublicBody')
+def remember_publicbody_jurisdiction(sender, instance=None, **kwargs):
+    # Read from __dict__ to not load a deferred field
+    instance._reference_jurisdiction_id = instance.__dict__.get(
+        'jurisdiction_id')
+
+
+@receiver(post_save, sender=PublicBody,
+        dispatch_uid='reference_cache_save_PublicBody')
+def invalidate_reference_cache_publicbody(sender, instance=None,
+                                          created=False, **kwargs):
+    """
+    Public bodies are saved for every new request, the cached lists
+    only depend on the number of public bodies per jurisdiction
+    """
+    if kwargs.get('raw', False):
+        return
+    jurisdiction_id = instance.__dict__.get('jurisdiction_id')
+    if created or jurisdiction_id != instance._reference_jurisdiction_id:
+        reference_cache.invalidate()
+    instance._reference_jurisdiction_id = jurisdiction_id
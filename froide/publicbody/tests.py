@@ -1,18 +1,63 @@
 import json
 import tempfile
+import threading
 import unittest
 
 from django.utils import six
+from django.utils.six.moves import BaseHTTPServer
 from django.test import TestCase
+from django.db import connection
+from django.test.utils import override_settings, CaptureQueriesContext
 from django.core.urlresolvers import reverse
 
 from froide.foirequest.tests import factories
 from froide.helper.csv_utils import export_csv_bytes
 
-from .models import PublicBody, FoiLaw, Jurisdiction
+from .models import (PublicBody, PublicBodyTag, PublicBodySyncRow, FoiLaw,
+                     Jurisdiction, reference_cache)
 from .csv_import import CSVImporter
 
 
+SYNC_CSV = u'''name,email,jurisdiction__slug,tags,url,parent__name,classification,contact,address
+Sync Body 79,sync@79.example.com,bund,,,,Ministry,,
+Other Sync Body 79,other@79.example.com,bund,,,,Ministry,,'''
+
+
+class CSVRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    content = b''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalCSVServer(object):
+    """
+    Serves a CSV over HTTP on localhost in a thread
+    """
+    def __init__(self, content):
+        handler = type('Handler', (CSVRequestHandler,), {'content': content})
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), handler)
+        self.url = 'http://127.0.0.1:%d/data.csv' % self.server.server_port
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
 class PublicBodyTest(TestCase):
     def setUp(self):
         self.site = factories.make_world()
@@ -47,6 +92,23 @@ class PublicBodyTest(TestCase):
         self.assertEqual(PublicBody.objects.all().count() + 1,
             len(csv.splitlines()))
 
+    def test_csv_export_queries(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                csv = export_csv_bytes(PublicBody.export_csv(
+                    PublicBody.objects.all()))
+            return len(ctx.captured_queries), csv
+
+        query_count, csv = count_queries()
+        for i in range(5):
+            pb = factories.PublicBodyFactory.create(site=self.site)
+            pb.tags.add('export tag %d' % i)
+        more_query_count, more_csv = count_queries()
+        self.assertEqual(query_count, more_query_count)
+        self.assertIn(b'export tag 4', more_csv)
+        self.assertEqual(PublicBody.objects.all().count() + 1,
+            len(more_csv.splitlines()))
+
     def test_csv_export_import(self):
         csv = export_csv_bytes(PublicBody.export_csv(PublicBody.objects.all()))
         prev_count = PublicBody.objects.all().count()
@@ -79,6 +141,154 @@ Public Body X 76,pb-76@76.example.com,bund,,,,http://example.com,,Ministry,Some
         now_count = PublicBody.objects.all().count()
         self.assertEqual(now_count - 1, prev_count)
 
+    def test_csv_bulk_import(self):
+        csv = u'''name,email,jurisdiction__slug,other_names,description,tags,url,parent__name,classification,contact,address,website_dump,request_note
+Child Body 77,child@77.example.com,bund,,,"tag 77, other 77",http://example.com,Parent Body 77,Ministry,,,,
+Parent Body 77,parent@77.example.com,bund,,,tag 77,example.com,,Ministry,,,,'''
+        prev_count = PublicBody.objects.all().count()
+        imp = CSVImporter(batch_size=1)
+        report = imp.import_from_file(six.BytesIO(csv.encode('utf-8')))
+        self.assertEqual(report.created, 2)
+        self.assertEqual(report.errors, [])
+        self.assertEqual(PublicBody.objects.all().count(), prev_count + 2)
+        child = PublicBody.objects.get(slug='child-body-77')
+        parent = PublicBody.objects.get(slug='parent-body-77')
+        self.assertEqual(child.parent, parent)
+        self.assertEqual(parent.url, 'http://example.com')
+        self.assertEqual(set(t.name for t in child.tags.all()),
+                         set(['tag 77', 'other 77']))
+        self.assertEqual(set(child.laws.all()),
+                         set(FoiLaw.objects.filter(
+                             jurisdiction=child.jurisdiction)))
+
+        report = CSVImporter().import_from_file(
+            six.BytesIO(csv.encode('utf-8')))
+        self.assertEqual(report.created, 0)
+        self.assertEqual(report.unchanged, 2)
+
+        changed = csv.replace('parent@77', 'new-parent@77')
+        changed = changed.replace('"tag 77, other 77"', 'other 77')
+        # The parent's email and the child's tags changed
+        report = CSVImporter(dry_run=True).import_from_file(
+            six.BytesIO(changed.encode('utf-8')))
+        self.assertEqual(report.updated, 2)
+        self.assertEqual(report.unchanged, 0)
+        self.assertEqual(PublicBody.objects.get(id=parent.id).email,
+                         'parent@77.example.com')
+        self.assertEqual(child.tags.count(), 2)
+
+        report = CSVImporter().import_from_file(
+            six.BytesIO(changed.encode('utf-8')))
+        self.assertEqual(report.updated, 2)
+        self.assertEqual(PublicBody.objects.get(id=parent.id).email,
+                         'new-parent@77.example.com')
+        self.assertEqual([t.name for t in child.tags.all()], ['other 77'])
+
+    def test_csv_sync(self):
+        report = CSVImporter().import_from_file(
+            six.BytesIO(SYNC_CSV.encode('utf-8')), source='sync.csv')
+        self.assertEqual(report.created, 2)
+        self.assertEqual(PublicBodySyncRow.objects.filter(
+            source='sync.csv').count(), 2)
+
+        imp = CSVImporter()
+        report = imp.import_from_file(
+            six.BytesIO(SYNC_CSV.encode('utf-8')), source='sync.csv')
+        self.assertEqual(report.unchanged, 2)
+        self.assertEqual(report.created + report.updated, 0)
+        self.assertEqual(imp.changed_ids, set())
+
+        changed = SYNC_CSV.splitlines()[:2]
+        changed[1] = changed[1].replace('sync@79', 'new-sync@79')
+        imp = CSVImporter()
+        report = imp.import_from_file(
+            six.BytesIO(u'\n'.join(changed).encode('utf-8')),
+            source='sync.csv')
+        pb = PublicBody.objects.get(slug='sync-body-79')
+        self.assertEqual(pb.email, 'new-sync@79.example.com')
+        self.assertEqual(report.updated, 1)
+        self.assertEqual(report.removed, 1)
+        self.assertEqual(imp.changed_ids, set([pb.id]))
+        # Removed rows do not delete bodies
+        self.assertTrue(PublicBody.objects.filter(
+            slug='other-sync-body-79').exists())
+
+    def test_csv_import_blank_email(self):
+        csv = u'''name,email,jurisdiction__slug,tags,url,parent__name,classification,contact,address
+Blank Body 80,,bund,tag 80,,Blank Parent 80,Ministry,,
+Blank Parent 80,,bund,,,,Ministry,,'''
+        imp = CSVImporter()
+        report = imp.import_from_file(
+            six.BytesIO(csv.encode('utf-8')), source='blank.csv')
+        self.assertEqual(report.created, 2)
+        self.assertEqual(report.errors, [])
+        child = PublicBody.non_filtered_objects.get(slug='blank-body-80')
+        parent = PublicBody.non_filtered_objects.get(slug='blank-parent-80')
+        self.assertEqual(child.parent, parent)
+        self.assertEqual([t.name for t in child.tags.all()], ['tag 80'])
+        self.assertEqual(set(child.laws.all()),
+                         set(FoiLaw.objects.filter(
+                             jurisdiction=child.jurisdiction)))
+        self.assertEqual(imp.changed_ids, set([child.id, parent.id]))
+        self.assertEqual(PublicBodySyncRow.objects.filter(
+            source='blank.csv').count(), 2)
+
+        report = CSVImporter().import_from_file(
+            six.BytesIO(csv.encode('utf-8')), source='blank.csv')
+        self.assertEqual(report.unchanged, 2)
+        self.assertEqual(report.created, 0)
+        self.assertEqual(PublicBody.non_filtered_objects.filter(
+            slug='blank-body-80').count(), 1)
+
+    def test_csv_sync_missing_parent(self):
+        csv = u'''name,email,jurisdiction__slug,tags,url,parent__name,classification,contact,address
+Child Sync 81,child@81.example.com,bund,,,Parent Sync 81,Ministry,,'''
+        report = CSVImporter().import_from_file(
+            six.BytesIO(csv.encode('utf-8')), source='parent.csv')
+        self.assertEqual(report.created, 1)
+        self.assertEqual([row for row, message in report.errors], [2])
+
+        # The row is not skipped while its parent is missing
+        report = CSVImporter().import_from_file(
+            six.BytesIO(csv.encode('utf-8')), source='parent.csv')
+        self.assertEqual([row for row, message in report.errors], [2])
+
+        csv += u'\nParent Sync 81,parent@81.example.com,bund,,,,Ministry,,'
+        report = CSVImporter().import_from_file(
+            six.BytesIO(csv.encode('utf-8')), source='parent.csv')
+        self.assertEqual(report.errors, [])
+        child = PublicBody.objects.get(slug='child-sync-81')
+        self.assertEqual(child.parent.slug, 'parent-sync-81')
+
+        report = CSVImporter().import_from_file(
+            six.BytesIO(csv.encode('utf-8')), source='parent.csv')
+        self.assertEqual(report.unchanged, 2)
+
+    def test_csv_sync_from_url(self):
+        with LocalCSVServer(SYNC_CSV.encode('utf-8')) as server:
+            report = CSVImporter().import_from_url(server.url, sync=True)
+            self.assertEqual(report.created, 2)
+            report = CSVImporter().import_from_url(server.url, sync=True)
+            self.assertEqual(report.unchanged, 2)
+            self.assertEqual(PublicBodySyncRow.objects.filter(
+                source=server.url).count(), 2)
+
+    def test_csv_import_errors(self):
+        csv = u'''name,email,jurisdiction__slug,tags,url,parent__name,classification,contact,address
+Body 78,body@78.example.com,not-there,,,,Ministry,,
+Other Body 78,other@78.example.com,bund,,,Missing 78,Ministry,,'''
+        report = CSVImporter().import_from_file(
+            six.BytesIO(csv.encode('utf-8')))
+        self.assertEqual(report.created, 1)
+        self.assertEqual([row for row, message in report.errors], [2, 3])
+        pb = PublicBody.objects.get(slug='other-body-78')
+        self.assertIsNone(pb.parent)
+        lines = report.get_lines(max_errors=1)
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('Row 2: '))
+        self.assertEqual(lines[2], '... and 1 more errors')
+        self.assertEqual(len(report.get_lines()), 3)
+
     @unittest.skip('call_command broken with django configurations')
     def test_csv_command(self):
         from django.core.management import call_command
@@ -132,6 +342,58 @@ Public Body X 76,pb-76@76.example.com,bund,,,,http://example.com,,Ministry,Some
                 kwargs={'jurisdiction': juris.slug}))
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(REFERENCE_DATA_CACHE_TIMEOUT=60)
+    def test_reference_cache(self):
+        reference_cache.invalidate()
+        jurisdictions = Jurisdiction.objects.get_cached_visible()
+        topics = PublicBodyTag.objects.get_cached_topic_list()
+        pb = PublicBody.objects.all()[0]
+        law = FoiLaw.get_default_law(pb)
+        with self.assertNumQueries(0):
+            self.assertEqual(Jurisdiction.objects.get_cached_visible(),
+                             jurisdictions)
+            self.assertEqual(PublicBodyTag.objects.get_cached_topic_list(),
+                             topics)
+            self.assertEqual(FoiLaw.get_default_law(pb), law)
+
+        # A new process reads the shared cache
+        reference_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(Jurisdiction.objects.get_cached_visible(),
+                             jurisdictions)
+
+        new_juris = factories.JurisdictionFactory.create(name='peculiar')
+        self.assertIn(new_juris, Jurisdiction.objects.get_cached_visible())
+        new_juris.hidden = True
+        new_juris.save()
+        self.assertNotIn(new_juris, Jurisdiction.objects.get_cached_visible())
+
+    @override_settings(REFERENCE_DATA_CACHE_TIMEOUT=60)
+    def test_reference_cache_public_body_save(self):
+        reference_cache.invalidate()
+        pb = PublicBody.objects.all()[0]
+        jurisdiction_list = Jurisdiction.objects.get_cached_list()
+        # Saves like the request count updates do not invalidate
+        pb = PublicBody.objects.get(id=pb.id)
+        pb.number_of_requests += 1
+        pb.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(Jurisdiction.objects.get_cached_list(),
+                             jurisdiction_list)
+
+        other = factories.JurisdictionFactory.create(name='other')
+        pb = PublicBody.objects.get(id=pb.id)
+        pb.jurisdiction = other
+        pb.save()
+        counts = dict((j.id, j.num_publicbodies)
+                      for j in Jurisdiction.objects.get_cached_list())
+        self.assertEqual(counts[other.id], 1)
+
+        # Cached instances are handed out as copies
+        law = FoiLaw.get_default_law()
+        law.name = 'changed'
+        self.assertNotEqual(FoiLaw.get_default_law().name, 'changed')
+
 
 class ApiTest(TestCase):
     def setUp(self):
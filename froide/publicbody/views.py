@@ -17,6 +17,8 @@ from .models import (PublicBody,
     PublicBodyTag, FoiLaw, Jurisdiction)
 from .csv_import import CSVImporter
 
+MAX_IMPORT_ERROR_MESSAGES = 20
+
 
 def index(request, jurisdiction=None, topic=None):
     if jurisdiction is not None:
@@ -48,10 +50,10 @@ def index(request, jurisdiction=None, topic=None):
 
     return render(request, 'publicbody/list.html', {
         'object_list': publicbodies,
-        'jurisdictions': Jurisdiction.objects.get_list(),
+        'jurisdictions': Jurisdiction.objects.get_cached_list(),
         'jurisdiction': jurisdiction,
         'topic': topic,
-        'topics': PublicBodyTag.objects.get_topic_list(),
+        'topics': PublicBodyTag.objects.get_cached_topic_list(),
         'query': query,
     })
 
@@ -122,17 +124,26 @@ def import_csv(request):
         return render_403(request)
     if not request.method == 'POST':
         return render_403(request)
-    importer = CSVImporter()
+    importer = CSVImporter(dry_run=bool(request.POST.get('dry_run')))
     url = request.POST.get('url')
     try:
         if not url:
             raise ValueError(_('You need to provide a url.'))
-        importer.import_from_url(url)
+        report = importer.import_from_url(url,
+                sync=bool(request.POST.get('sync')))
     except Exception as e:
         messages.add_message(request, messages.ERROR, str(e))
     else:
-        messages.add_message(request, messages.SUCCESS,
-            _('Public Bodies were imported.'))
+        if report.dry_run:
+            messages.add_message(request, messages.INFO,
+                _('Nothing was imported, this is a dry run.'))
+        else:
+            messages.add_message(request, messages.SUCCESS,
+                _('Public Bodies were imported.'))
+        level = messages.WARNING if report.errors else messages.INFO
+        # Messages are kept in a cookie, so not every error fits
+        for line in report.get_lines(max_errors=MAX_IMPORT_ERROR_MESSAGES):
+            messages.add_message(request, level, line)
     return redirect('admin:publicbody_publicbody_changelist')
 
 
@@ -10,6 +10,14 @@ from .models import PublicBody, Jurisdiction
 class PublicBodySelect(forms.Widget):
     initial_jurisdiction = None
     initial_search = None
+    initial_public_body = None
+    jurisdictions = None
+
+    def set_initial_public_body(self, public_body):
+        self.initial_public_body = public_body
+
+    def set_jurisdictions(self, jurisdictions):
+        self.jurisdictions = jurisdictions
 
     def set_initial_jurisdiction(self, juris):
         self.initial_jurisdiction = juris
@@ -20,10 +28,15 @@ class PublicBodySelect(forms.Widget):
     def render(self, name, value=None, attrs=None, choices=()):
         pb, pb_desc = None, None
         juris_widget = None
-        jurisdictions = Jurisdiction.objects.get_visible()
+        jurisdictions = self.jurisdictions
+        if jurisdictions is None:
+            jurisdictions = Jurisdiction.objects.get_cached_visible()
         if value is not None:
             try:
-                pb = PublicBody.objects.get(pk=int(value))
+                value_id = int(value)
+                pb = self.initial_public_body
+                if pb is None or pb.pk != value_id:
+                    pb = PublicBody.objects.get(pk=value_id)
                 pb_desc = pb.get_label()
             except (ValueError, PublicBody.DoesNotExist):
                 pass
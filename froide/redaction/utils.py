@@ -1,24 +1,162 @@
 import os
 import base64
-import tempfile
+from datetime import datetime, timedelta
+import glob
+import logging
+from multiprocessing.pool import ThreadPool
+import shutil
 import subprocess
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+logger = logging.getLogger(__name__)
+
+PNG_DATA_PREFIX = 'data:image/png;base64,'
+REDACTION_DIRECTORY = 'redactions'
+REDACTION_JOB_MAX_AGE = timedelta(days=1)
+
+
+def make_redaction_dir():
+    return tempfile.mkdtemp(prefix='froide_redaction_')
+
 
+def remove_redaction_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
 
-def convert_to_pdf(post):
-    path = tempfile.mkdtemp()
+
+def make_redaction_job():
+    return uuid.uuid4().hex
+
+
+def get_redaction_job_dir(job_id):
+    return '%s/%s' % (REDACTION_DIRECTORY, job_id)
+
+
+def list_redaction_job(job_id, storage=default_storage):
+    try:
+        return sorted(storage.listdir(get_redaction_job_dir(job_id))[1])
+    except OSError:
+        return []
+
+
+def store_pages(data, files, job_id, storage=default_storage):
+    """
+    Stores the pages page_1, page_2, ... of a redaction submission one
+    at a time in the job directory of the storage, which the workers
+    share with the web hosts. Pages are uploaded PNG files or, from
+    older clients, base64 PNG data URLs. Returns the number of stored
+    pages.
+    """
+    directory = get_redaction_job_dir(job_id)
     pagenr = 1
     while True:
-        data = post.get('page_%s' % pagenr)
-        if data is None:
+        name = 'page_%s' % pagenr
+        if name in files:
+            content = files[name]
+        elif name in data:
+            value = data[name]
+            if not value.startswith(PNG_DATA_PREFIX):
+                break
+            content = ContentFile(
+                base64.b64decode(value[len(PNG_DATA_PREFIX):]))
+        else:
             break
-        if not data.startswith('data:image/png;base64,'):
-            continue
-        prefix, data = data.split(',', 1)
-        filename = os.path.join(path, 'page_%03d.png' % pagenr)
-        open(filename, 'w').write(base64.b64decode(data))
+        storage.save('%s/page_%04d.png' % (directory, pagenr), content)
         pagenr += 1
-    filename = os.path.join(path, 'page_*')
-    output_file = os.path.join(path, 'final.pdf')
+    return pagenr - 1
+
+
+def fetch_pages(job_id, path, storage=default_storage):
+    """
+    Copies the stored pages of the job to the local directory
+    path, returns the number of pages
+    """
+    directory = get_redaction_job_dir(job_id)
+    filenames = list_redaction_job(job_id, storage=storage)
+    for filename in filenames:
+        with storage.open('%s/%s' % (directory, filename)) as source:
+            with open(os.path.join(path, filename), 'wb') as f:
+                for chunk in source.chunks():
+                    f.write(chunk)
+    return len(filenames)
+
+
+def remove_redaction_job(job_id, storage=default_storage):
+    directory = get_redaction_job_dir(job_id)
+    for filename in list_redaction_job(job_id, storage=storage):
+        storage.delete('%s/%s' % (directory, filename))
+    try:
+        # File system storages keep the empty directory
+        os.rmdir(storage.path(directory))
+    except (NotImplementedError, OSError):
+        pass
+
+
+def remove_stale_redaction_jobs(max_age=REDACTION_JOB_MAX_AGE,
+                                storage=default_storage):
+    """
+    Removes jobs that were not processed, e.g. because their task was
+    lost, and returns their number
+    """
+    try:
+        job_ids = storage.listdir(REDACTION_DIRECTORY)[0]
+    except OSError:
+        return 0
+    oldest = datetime.now() - max_age
+    count = 0
+    for job_id in job_ids:
+        directory = get_redaction_job_dir(job_id)
+        filenames = list_redaction_job(job_id, storage=storage)
+        if any(storage.modified_time('%s/%s' % (directory, filename)) > oldest
+               for filename in filenames):
+            continue
+        remove_redaction_job(job_id, storage=storage)
+        count += 1
+    return count
+
+
+def convert_page(filename):
+    output_file = filename.rsplit('.', 1)[0] + '.pdf'
     if subprocess.call(["convert", filename, output_file]) == 0:
         return output_file
+    logger.error('Converting redacted page %s failed', filename)
+    return None
+
+
+def convert_to_pdf(path, workers=None):
+    """
+    Converts the stored pages in path to single page PDFs with at most
+    workers conversions running at the same time and joins them without
+    rasterizing them again. Returns the path of the PDF or None.
+    """
+    if workers is None:
+        workers = settings.REDACTION_PAGE_WORKERS
+    pages = sorted(glob.glob(os.path.join(path, 'page_*.png')))
+    if not pages:
+        return None
+    pool = ThreadPool(max(1, min(workers, len(pages))))
+    try:
+        page_files = pool.map(convert_page, pages)
+    finally:
+        pool.close()
+        pool.join()
+    if None in page_files:
+        return None
+    output_file = os.path.join(path, 'final.pdf')
+    arguments = [
+        "gs", "-q", "-dBATCH", "-dNOPAUSE", "-dSAFER",
+        "-sDEVICE=pdfwrite",
+        # Keep the page images as they are
+        "-dAutoFilterColorImages=false", "-dColorImageFilter=/FlateEncode",
+        "-dAutoFilterGrayImages=false", "-dGrayImageFilter=/FlateEncode",
+        "-dDownsampleColorImages=false", "-dDownsampleGrayImages=false",
+        "-sOutputFile=%s" % output_file
+    ] + page_files
+    if subprocess.call(arguments) == 0:
+        return output_file
+    logger.error('Joining redacted pages in %s failed', path)
     return None
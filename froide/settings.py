@@ -55,6 +55,13 @@ class Base(Configuration):
     ])
 
     CACHES = values.CacheURLValue('dummy://')
+    # Seconds to keep rendered messages of public requests for
+    # anonymous users, 0 disables it
+    FOI_REQUEST_FRAGMENT_CACHE_TIMEOUT = values.IntegerValue(15 * 60)
+    # Seconds to keep the number of requests per list filter, 0 disables it
+    FOI_REQUEST_LIST_COUNT_CACHE_TIMEOUT = values.IntegerValue(5 * 60)
+    # Seconds to keep laws, jurisdictions and topics, 0 disables it
+    REFERENCE_DATA_CACHE_TIMEOUT = values.IntegerValue(24 * 60 * 60)
 
     # ############# Site Configuration #########
 
@@ -314,6 +321,19 @@ class Base(Configuration):
     }
     CELERY_TIMEZONE = TIME_ZONE
 
+    # Number of pages of a redacted document converted at the same time
+    REDACTION_PAGE_WORKERS = values.IntegerValue(4)
+    # Converter processes per worker process and seconds per document
+    DOC_CONVERSION_WORKERS = values.IntegerValue(1)
+    DOC_CONVERSION_TIMEOUT = values.IntegerValue(5 * 60)
+    # Python with the LibreOffice uno bindings for the converters,
+    # defaults to the Python running Celery
+    DOC_CONVERSION_PYTHON = values.Value('')
+    # Celery queue of low priority conversions like bulk conversions
+    # from the admin, needs a worker that consumes it. Empty uses
+    # the default queue.
+    DOC_CONVERSION_LOW_PRIORITY_QUEUE = values.Value('')
+
     # ######## Haystack ###########
 
     HAYSTACK_CONNECTIONS = {
@@ -368,6 +388,12 @@ class Base(Configuration):
     EMAIL_HOST_PASSWORD = values.Value("")
     EMAIL_USE_TLS = values.BooleanValue(True)
 
+    # Batches of queued mails are sent over this many
+    # connections per mail server
+    EMAIL_QUEUE_CONNECTIONS = values.IntegerValue(4)
+    # Maximum mails per second to one recipient domain, 0 disables it
+    EMAIL_QUEUE_DOMAIN_RATE = values.FloatValue(10.0)
+
     # Froide special case settings
     # IMAP settings for fetching mail
     FOI_EMAIL_PORT_IMAP = values.IntegerValue(993)
@@ -375,6 +401,12 @@ class Base(Configuration):
     FOI_EMAIL_ACCOUNT_NAME = values.Value("foi@example.com")
     FOI_EMAIL_ACCOUNT_PASSWORD = values.Value("")
     FOI_EMAIL_USE_SSL = values.BooleanValue(True)
+    # Number of mails per UID FETCH and parallel IMAP connections
+    FOI_EMAIL_FETCH_BATCH_SIZE = values.IntegerValue(20)
+    FOI_EMAIL_FETCH_CONNECTIONS = values.IntegerValue(2)
+    # Attachments of incoming mail larger than this many bytes
+    # are written to temporary files while the mail is parsed
+    FOI_EMAIL_MAX_MEMORY_SIZE = values.IntegerValue(1024 * 1024)
 
     # SMTP settings for sending FoI mail
     FOI_EMAIL_HOST_USER = values.Value(FOI_EMAIL_ACCOUNT_NAME)
@@ -447,6 +479,12 @@ class Test(Base):
 
     MESSAGE_STORAGE = 'django.contrib.messages.storage.cookie.CookieStorage'
     CACHES = values.CacheURLValue('locmem://')
+    FOI_REQUEST_FRAGMENT_CACHE_TIMEOUT = 0
+    FOI_REQUEST_LIST_COUNT_CACHE_TIMEOUT = 0
+    REFERENCE_DATA_CACHE_TIMEOUT = 0
+    # Keep the order of sent mails in the outbox
+    EMAIL_QUEUE_CONNECTIONS = 1
+    EMAIL_QUEUE_DOMAIN_RATE = 0
 
     TEST_SELENIUM_DRIVER = values.Value('phantomjs')
 
@@ -89,26 +89,61 @@ PDFRedact.prototype.updateProgress = function(percent){
     .find('.sr-only').text(rounded + '% complete');
 };
 
-PDFRedact.prototype.submitRedactions = function(form){
+PDFRedact.prototype.submitRedactions = function(form, failed){
 
   var self = this;
 
   self.canvas.style.display = 'none';
 
-  var addKV = function(k,v){
-    var inp = document.createElement('input');
-    inp.type = 'hidden';
-    inp.name = k;
-    inp.value = v;
-    form.append(inp);
+  var data = new FormData(form[0]);
+
+  var dataURLToBlob = function(dataURL) {
+    var binary = atob(dataURL.split(',')[1]);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i += 1) {
+      bytes[i] = binary.charCodeAt(i);
+    }
+    return new Blob([bytes], {type: 'image/png'});
+  };
+
+  var pollStatus = function(statusUrl) {
+    $.getJSON(statusUrl).done(function(result){
+      if (result.url) {
+        window.location.href = result.url;
+      } else {
+        window.setTimeout(function(){ pollStatus(statusUrl); }, 2000);
+      }
+    }).fail(function(){
+      failed();
+    });
+  };
+
+  var submit = function() {
+    $.ajax({
+      url: form.attr('action') || window.location.href,
+      type: 'POST',
+      data: data,
+      processData: false,
+      contentType: false,
+      dataType: 'json'
+    }).done(function(result){
+      if (result.url) {
+        window.location.href = result.url;
+      } else {
+        pollStatus(result.status_url);
+      }
+    }).fail(function(){
+      failed();
+    });
   };
 
   var extractImage = function(pagenumber) {
-    self.applyRedaction(pagenumber, function(data){
-      addKV('page_' + pagenumber, data);
+    self.applyRedaction(pagenumber, function(dataURL){
+      data.append('page_' + pagenumber, dataURLToBlob(dataURL),
+                  'page_' + pagenumber + '.png');
       self.updateProgress(pagenumber / self.pdfviewer.numPages * 100);
       if (pagenumber === self.pdfviewer.numPages) {
-        form.submit();
+        submit();
       } else {
         extractImage(pagenumber + 1);
       }